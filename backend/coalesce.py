@@ -0,0 +1,108 @@
+import logging
+import os
+import threading
+
+from metrics import LLM_COALESCED
+
+logger = logging.getLogger(__name__)
+
+# Set to 0 to make every request call GPT-4o itself, even when an identical call is in flight
+COALESCE_ENABLED = os.environ.get("COALESCE", "1") == "1"
+
+# Longest a request waits for an identical call in flight before making its own (the generators' deadline)
+COALESCE_WAIT = float(os.environ.get("COALESCE_WAIT", 90))
+
+
+class Flight:
+    """One call in flight, with the result or error it ended with once `done` is set."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Process-wide single-flight of identical calls: the first caller of a key makes the
+    call, callers arriving with the same key while it is in flight wait (up to `wait`
+    seconds) and get its result, or its error, instead of making their own.
+
+    Keys are the answer cache's keys, which cover the call, the normalized prompt (with
+    its conversation context) and the dataset version. Coalescing complements the cache:
+    the cache serves answers already given, coalescing the ones still being generated.
+    """
+
+    def __init__(self, wait=COALESCE_WAIT, enabled=COALESCE_ENABLED):
+        self.wait = wait
+        self.enabled = enabled
+        self.saved = 0
+        self.timeouts = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """(flight, True) for the caller who must make the call and finish() it, (flight, False) for the others."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = Flight()
+                return flight, True
+            flight.waiters += 1
+            return flight, False
+
+    def finish(self, key, flight, result=None, error=None):
+        """Hand the call's result (or error) to its waiters. Without either they make their own calls."""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.result = result
+        flight.error = error
+        flight.done.set()
+
+    def follow(self, call, flight):
+        """
+        Wait for a flight joined as a waiter. Returns its result or raises its error; returns
+        None if it took longer than `wait` or ended without a result, then the caller calls itself.
+        """
+        if not flight.done.wait(self.wait):
+            self.timeouts += 1
+            LLM_COALESCED.labels(call, "timeout").inc()
+            logger.warning(f"Identical {call} call still running after {self.wait}s, calling GPT-4o again.")
+            return None
+        if flight.error is not None:
+            self.saved += 1
+            LLM_COALESCED.labels(call, "error").inc()
+            raise flight.error
+        if flight.result is None:
+            LLM_COALESCED.labels(call, "abandoned").inc()
+            return None
+        self.saved += 1
+        LLM_COALESCED.labels(call, "shared").inc()
+        return flight.result
+
+    def do(self, call, key, fn):
+        """Return fn(), made once for all concurrent callers of the same key."""
+        if not self.enabled:
+            return fn()
+        flight, leader = self.join(key)
+        if not leader:
+            result = self.follow(call, flight)
+            return result if result is not None else fn()
+        try:
+            result = fn()
+        except Exception as e:
+            self.finish(key, flight, error=e)
+            raise
+        except BaseException:
+            self.finish(key, flight)
+            raise
+        self.finish(key, flight, result=result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._flights)
+            waiting = sum(flight.waiters for flight in self._flights.values())
+        return {"in_flight": in_flight, "waiting": waiting, "saved": self.saved, "timeouts": self.timeouts}
@@ -0,0 +1,245 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from gpt import MAX_HISTORY_LENGTH, compress_summary, summarize_exchanges
+
+logger = logging.getLogger(__name__)
+
+# Backend of the server-side conversation store: "memory" (per process) or "sqlite" (shared by all workers)
+CONVERSATION_STORE = os.environ.get("CONVERSATION_STORE", "memory")
+CONVERSATION_DB = os.environ.get("CONVERSATION_DB", "conversations.db")
+
+# Per-session caps, older exchanges beyond them are compacted into the session's summary
+CONVERSATION_MAX_TURNS = int(os.environ.get("CONVERSATION_MAX_TURNS", MAX_HISTORY_LENGTH))
+CONVERSATION_MAX_BYTES = int(os.environ.get("CONVERSATION_MAX_BYTES", 64 * 1024))
+CONVERSATION_MAX_SUMMARY_CHARS = int(os.environ.get("CONVERSATION_MAX_SUMMARY_CHARS", 2000))
+
+# Set to 1 to have GPT-4o rewrite summaries longer than CONVERSATION_COMPRESS_CHARS in the background
+CONVERSATION_LLM_SUMMARY = os.environ.get("CONVERSATION_LLM_SUMMARY", "0") == "1"
+CONVERSATION_COMPRESS_CHARS = int(os.environ.get("CONVERSATION_COMPRESS_CHARS", 1500))
+
+# Sessions idle for longer than this many seconds are deleted
+CONVERSATION_IDLE_TTL = float(os.environ.get("CONVERSATION_IDLE_TTL", 24 * 3600))
+
+# Minimum number of seconds between two sweeps for idle sessions
+EXPIRY_INTERVAL = 60
+
+
+class ConversationHistory(list):
+    """Exchanges of a session kept in full, with `summary` holding the exchanges compacted out of it."""
+
+    def __init__(self, turns=(), summary=""):
+        super().__init__(turns)
+        self.summary = summary
+
+
+def _truncate_summary(summary, max_chars):
+    """Keep the most recent end of a summary that grew past max_chars, cut at a word boundary."""
+    if len(summary) <= max_chars:
+        return summary
+    cut = summary[-max_chars:]
+    if summary[-max_chars - 1] == " ":
+        return cut
+    space = cut.find(" ")
+    return cut[space + 1:] if 0 <= space < len(cut) - 1 else cut
+
+
+def compact(history, max_turns=CONVERSATION_MAX_TURNS, max_bytes=CONVERSATION_MAX_BYTES,
+            max_summary_chars=CONVERSATION_MAX_SUMMARY_CHARS):
+    """
+    Fold the oldest exchanges of a history into its rolling summary so it fits the caps.
+
+    An exchange is folded once, as a short extractive line, when it leaves the last
+    max_turns (by default the MAX_HISTORY_LENGTH exchanges prompts include in full), so
+    building a prompt only reads the stored summary. Exchanges are then folded one at a
+    time while the history exceeds max_bytes.
+    """
+    turns = list(history)
+    cut = max(len(turns) - max_turns, 0)
+    folded, turns = turns[:cut], turns[cut:]
+    while len(turns) > 1 and len(json.dumps(turns)) + len(history.summary) > max_bytes:
+        folded.append(turns.pop(0))
+    if not folded:
+        return history
+    summary = " ".join(part for part in (history.summary, summarize_exchanges(folded)) if part)
+    return ConversationHistory(turns, _truncate_summary(summary, max_summary_chars))
+
+
+def _splice(current, old, new):
+    """current with its leading `old` replaced by `new`, or None if exchanges folded since changed that part."""
+    if not current.startswith(old):
+        return None
+    return " ".join(part for part in (new, current[len(old):].strip()) if part)
+
+
+# Summaries are compressed one at a time, off the request path
+_compress_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+_compressing = set()
+_compressing_lock = threading.Lock()
+
+
+def schedule_compression(store, sid, summary, enabled=None, min_chars=CONVERSATION_COMPRESS_CHARS):
+    """
+    Have GPT-4o rewrite a session's summary in the background once it grows past min_chars.
+    The rewrite replaces the summary it was made from, keeping anything folded in meanwhile.
+    """
+    if not (CONVERSATION_LLM_SUMMARY if enabled is None else enabled) or len(summary) <= min_chars:
+        return None
+    with _compressing_lock:
+        if sid in _compressing:
+            return None
+        _compressing.add(sid)
+    return _compress_executor.submit(_compress, store, sid, summary)
+
+
+def _compress(store, sid, summary):
+    try:
+        if not store.replace_summary(sid, summary, compress_summary(summary)):
+            logger.info("Conversation summary changed while it was compressed, keeping it.")
+    except Exception as e:
+        # The extractive summary stays, it is already bounded
+        logger.warning(f"Conversation summary compression failed: {e}")
+    finally:
+        with _compressing_lock:
+            _compressing.discard(sid)
+
+
+class MemoryConversationStore:
+    """Conversations held in this process, for a single worker or local development."""
+
+    def __init__(self, idle_ttl=CONVERSATION_IDLE_TTL):
+        self.idle_ttl = idle_ttl
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._last_expiry = time.monotonic()
+
+    def load(self, sid):
+        with self._lock:
+            self._maybe_expire()
+            entry = self._sessions.get(sid)
+            if entry is None:
+                return ConversationHistory()
+            _, turns, summary = entry
+            return ConversationHistory(turns, summary)
+
+    def append(self, sid, user_input, answer):
+        with self._lock:
+            _, turns, summary = self._sessions.get(sid, (0, [], ""))
+            history = compact(ConversationHistory(turns + [{"user": user_input, "assistant": answer}], summary))
+            self._sessions[sid] = (time.monotonic(), list(history), history.summary)
+        if history.summary != summary:
+            schedule_compression(self, sid, history.summary)
+
+    def replace_summary(self, sid, old, new):
+        """Replace the leading `old` of a session's summary by `new`. False if it no longer starts with it."""
+        with self._lock:
+            entry = self._sessions.get(sid)
+            summary = _splice(entry[2], old, new) if entry else None
+            if summary is None:
+                return False
+            self._sessions[sid] = (entry[0], entry[1], summary)
+            return True
+
+    def reset(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def _maybe_expire(self):
+        now = time.monotonic()
+        if now - self._last_expiry < EXPIRY_INTERVAL:
+            return
+        self._last_expiry = now
+        idle = [sid for sid, (updated_at, _, _) in self._sessions.items() if now - updated_at > self.idle_ttl]
+        for sid in idle:
+            del self._sessions[sid]
+
+
+class SQLiteConversationStore:
+    """Conversations in a SQLite file, shared by every worker process of the container."""
+
+    def __init__(self, path=CONVERSATION_DB, idle_ttl=CONVERSATION_IDLE_TTL):
+        self.path = path
+        self.idle_ttl = idle_ttl
+        self._local = threading.local()
+        self._last_expiry = 0.0
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "sid TEXT PRIMARY KEY, turns TEXT NOT NULL, summary TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def _connection(self):
+        # One connection per thread (and per process, as it is only opened on first use in that thread)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def load(self, sid):
+        conn = self._connection()
+        self._maybe_expire(conn)
+        row = conn.execute("SELECT turns, summary FROM conversations WHERE sid = ?", (sid,)).fetchone()
+        if row is None:
+            return ConversationHistory()
+        return ConversationHistory(json.loads(row[0]), row[1])
+
+    def append(self, sid, user_input, answer):
+        conn = self._connection()
+        # Read-modify-write under a write lock so concurrent requests of a session don't lose turns
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT turns, summary FROM conversations WHERE sid = ?", (sid,)).fetchone()
+            turns, summary = (json.loads(row[0]), row[1]) if row else ([], "")
+            history = compact(ConversationHistory(turns + [{"user": user_input, "assistant": answer}], summary))
+            conn.execute(
+                "INSERT OR REPLACE INTO conversations (sid, turns, summary, updated_at) VALUES (?, ?, ?, ?)",
+                (sid, json.dumps(list(history)), history.summary, time.time()),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if history.summary != summary:
+            schedule_compression(self, sid, history.summary)
+
+    def replace_summary(self, sid, old, new):
+        """Replace the leading `old` of a session's summary by `new`. False if it no longer starts with it."""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT summary FROM conversations WHERE sid = ?", (sid,)).fetchone()
+            summary = _splice(row[0], old, new) if row else None
+            if summary is not None:
+                conn.execute("UPDATE conversations SET summary = ? WHERE sid = ?", (summary, sid))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return summary is not None
+
+    def reset(self, sid):
+        self._connection().execute("DELETE FROM conversations WHERE sid = ?", (sid,))
+
+    def _maybe_expire(self, conn):
+        now = time.monotonic()
+        if now - self._last_expiry < EXPIRY_INTERVAL:
+            return
+        self._last_expiry = now
+        conn.execute("DELETE FROM conversations WHERE updated_at < ?", (time.time() - self.idle_ttl,))
+
+
+def create_conversation_store(kind=CONVERSATION_STORE):
+    if kind == "sqlite":
+        return SQLiteConversationStore()
+    if kind != "memory":
+        logger.warning(f"Unknown CONVERSATION_STORE {kind!r}, using memory.")
+    return MemoryConversationStore()
@@ -1,53 +1,434 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
 import pandas as pd
 from gpt import *
+from keyword_index import KeywordIndex
+from planner import TypedColumns, plan_query_text, select_rows
+from prompt import CONTEXT_LEVELS, RowContext
+from snapshot import load_or_build_snapshot
+from stats import load_profile
 from tqdm import tqdm
+from vectors import HYBRID_ALPHA, VectorIndex, content_version, hybrid_scores
+
+logger = logging.getLogger(__name__)
 #columns: Index(['name', 'short_description', 'long_description', 'genres',
 # 'minimum_system_requirement', 'recommend_system_requirement',
 # 'release_date', 'developer', 'publisher', 'overall_player_rating',
 # 'number_of_reviews_from_purchased_people', 'number_of_english_reviews',
 # 'link'],dtype='object')
 
+# Source csv for row-based retrieval
+DATASET_CSV = "games_description.csv"
+
+# Column summaries (metadata) generated from the games csv by data_info_col
+SUMMARY_CSV = "column_summary_info.csv"
+
+# Minimum number of seconds between two checks of the csv on disk for changes
+DATASET_CHECK_INTERVAL = float(os.environ.get("DATASET_CHECK_INTERVAL", 5))
+
+# Most cells (queries x rows) of the score matrix a batch retrieval pass holds at once
+BATCH_SCORE_CELLS = 2**24
+
+
+class DatasetSnapshot:
+    """
+    Read-only view of the games csv at one version, opened from its binary snapshot
+    (see snapshot.py) so nothing is parsed at startup.
+
+    The snapshot's files are memory-mapped: the keyword index, typed columns, titles,
+    prompt context blocks and row vectors are used straight from them, and the rows a
+    query retrieves are decoded cell by cell.
+    The whole dataframe is only decoded if something asks for `df`. A snapshot is never
+    modified once opened; when the file changes the store opens a new snapshot and swaps
+    it in, so readers always see a consistent dataset.
+    """
+
+    def __init__(self, path, table, version, load_seconds):
+        self.path = path
+        self.table = table
+        self.version = version
+        self.columns = table.columns
+        self.rows = table.rows
+        self.load_seconds = load_seconds
+        self.loaded_at = time.time()
+
+        # Inverted keyword index over all columns for ranked retrieval
+        self.index = KeywordIndex.from_state(table.arrays("index"))
+
+        # Statistics of the dataset for answering aggregate questions without GPT-4o
+        self.profile = load_profile(table.meta["profile"])
+
+        # Parsed dates, rating ranks, review counts and genre memberships for filtering and sorting
+        self.typed = TypedColumns.from_state(table.arrays("typed"))
+
+        # Game, developer and publisher names, for the query router to tell questions about particular games
+        self.titles = frozenset(table.array("titles").tolist())
+        self.studios = frozenset(table.array("studios").tolist())
+
+        # Prompt context blocks of every row at each level, rendered when the snapshot was built
+        self.context = table.arrays("context")
+
+        # Memory-mapped row embeddings for semantic retrieval (None when disabled or unavailable)
+        self.vectors = VectorIndex.from_snapshot(table)
+
+        # Bytes of the snapshot's files, shared by every worker through the page cache
+        self.memory_bytes = table.nbytes
+
+    @property
+    def df(self):
+        return self.table.frame()
+
+    def records(self, rows):
+        """Rows as dictionaries carrying their context blocks (RowContext), decoding only their cells."""
+        tokens = self.context["tokens"]
+        return [
+            RowContext(record, {
+                level: (self.context[level][row], int(tokens[row, i])) for i, level in enumerate(CONTEXT_LEVELS)
+            })
+            for row, record in zip(rows, self.table.records(rows))
+        ]
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "version": self.version,
+            "rows": self.rows,
+            "terms": len(self.index),
+            "vectors": self.vectors.meta if self.vectors is not None else None,
+            "snapshot": self.table.directory,
+            "load_ms": round(self.load_seconds * 1000, 2),
+            "memory_bytes": self.memory_bytes,
+            "loaded_at": self.loaded_at,
+        }
+
+
+def _open_snapshot(path, raw, version):
+    start = time.perf_counter()
+    table = load_or_build_snapshot(path, raw, version)
+    snapshot = DatasetSnapshot(path, table, version, load_seconds=0.0)
+    snapshot.load_seconds = time.perf_counter() - start
+    return snapshot
+
+
+class DatasetStore:
+    """
+    Process-wide holder of the current DatasetSnapshot for one csv.
+
+    The csv stays the source of truth: its snapshot is opened once, and a new one is
+    built and opened only when the file's mtime/size changes and its content hash
+    differs from the loaded version. Checks are throttled to
+    one every `check_interval` seconds so the hot path is a single attribute read.
+    Once a snapshot is loaded, checks and rebuilds run on a background thread and
+    requests keep being served from the current snapshot until the new one is swapped in.
+    """
+
+    def __init__(self, path, check_interval=DATASET_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.loads = 0
+        self._snapshot = None
+        self._signature = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+        self._reloading = threading.Lock()
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self.refresh()
+        if time.monotonic() - self._last_check >= self.check_interval and self._reloading.acquire(blocking=False):
+            threading.Thread(target=self._reload, name="dataset-reload", daemon=True).start()
+        return snapshot
+
+    def _reload(self):
+        try:
+            self.refresh()
+        finally:
+            self._reloading.release()
+
+    def after_fork(self):
+        """Reset the locks in a forked worker, the parent's reload thread (if any) was not forked with it."""
+        self._lock = threading.Lock()
+        self._reloading = threading.Lock()
+
+    def refresh(self, force=False):
+        """Reopen the csv's snapshot if the csv changed on disk (or always, with force). Returns the current snapshot."""
+        with self._lock:
+            now = time.monotonic()
+            current = self._snapshot
+            # Another thread may have refreshed while we waited for the lock
+            if not force and current is not None and now - self._last_check < self.check_interval:
+                return current
+            self._last_check = now
+
+            try:
+                stat = os.stat(self.path)
+                signature = (stat.st_mtime_ns, stat.st_size)
+                if not force and current is not None and signature == self._signature:
+                    return current
+
+                with open(self.path, "rb") as f:
+                    raw = f.read()
+                version = content_version(raw)
+                if not force and current is not None and version == current.version:
+                    # File was touched but its content did not change
+                    self._signature = signature
+                    return current
+
+                snapshot = _open_snapshot(self.path, raw, version)
+            except Exception:
+                if current is None:
+                    raise
+                logger.exception(f"Failed to reload {self.path}, keeping version {current.version}")
+                return current
+
+            # Single reference assignment, readers see either the old or the new snapshot
+            self._snapshot = snapshot
+            self._signature = signature
+            self.loads += 1
+            logger.info(
+                f"Loaded {self.path}: {snapshot.rows} rows, version {snapshot.version}, "
+                f"{snapshot.load_seconds * 1000:.1f} ms, {snapshot.memory_bytes / 2**20:.1f} MiB mapped"
+            )
+            return snapshot
+
+    def stats(self):
+        snapshot = self._snapshot
+        stats = snapshot.stats() if snapshot is not None else {"path": self.path}
+        stats["loads"] = self.loads
+        return stats
+
+
+_dataset_stores = {}
+_dataset_stores_lock = threading.Lock()
+
+
+def dataset_store(csv=DATASET_CSV):
+    """Return the process-wide DatasetStore for a csv path, creating it on first use."""
+    key = os.path.abspath(csv)
+    store = _dataset_stores.get(key)
+    if store is None:
+        with _dataset_stores_lock:
+            store = _dataset_stores.setdefault(key, DatasetStore(csv))
+    return store
+
+
+def after_fork():
+    """Make the stores usable in a worker forked from the process that loaded them."""
+    for store in list(_dataset_stores.values()):
+        store.after_fork()
+
+
+def get_dataset(csv=DATASET_CSV):
+    """Return the current DatasetSnapshot for a csv, reloading it in the background if the file changed."""
+    return dataset_store(csv).get()
+
+
+_file_versions = {}
+
+def file_version(path):
+    """Content hash of a file, recomputed only when its mtime or size changes. Empty if the file is missing."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return ""
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _file_versions.get(path)
+    if cached is None or cached[0] != signature:
+        with open(path, "rb") as f:
+            cached = (signature, hashlib.sha1(f.read()).hexdigest()[:12])
+        _file_versions[path] = cached
+    return cached[1]
+
+
+def dataset_version(csv=DATASET_CSV, summary_csv=SUMMARY_CSV):
+    """Version of everything answers are generated from: the games csv and its column summaries."""
+    return f"{get_dataset(csv).version}-{file_version(summary_csv)}"
+
+
 #retrieve row according to keywaord matching w query. keyword generation done by gpt 4o for accuracy
 def retrieve_relevant_rows(query, csv, top_n=3):
-    df=pd.read_csv(csv)
-    #generate keywords using gpt 4o for accuracy
+    #generate a list of keywords using gpt 4o for accuracy
     keywords = generate_keywords(query)
+    return retrieve_rows_for_keywords(keywords, csv, top_n=top_n, query=query)
+
+#retrieve rows for keywords that were already generated (e.g. concurrently with query classification)
+def retrieve_rows_for_keywords(keywords, csv, top_n=3, query=None):
+    snapshot = get_dataset(csv)
+
+    # Rank rows by BM25 score of the keywords over all columns using the snapshot's inverted index
+    scores = snapshot.index.scores(keywords)
 
-    def row_contains_keywords(row):
-        return any(keyword in str(value).lower() for value in row for keyword in keywords)
+    # Blend in cosine similarity to the query so paraphrases without a keyword match are found too
+    if query and snapshot.vectors is not None and HYBRID_ALPHA < 1:
+        scores = hybrid_scores(scores, snapshot.vectors.scores(" ".join([query] + list(keywords))))
 
-    # Filter the DataFrame for rows where any column contains any keyword
-    matching_rows = df[df.apply(row_contains_keywords, axis=1)]
+    # Apply the filters, order and number of games the query asks for ("highly rated RPGs after 2022") before relevance
+    rows = select_rows(query_plan(query, snapshot), snapshot.typed, scores, top_n)
 
     # Return the top N matching rows as dictionaries
-    return matching_rows.head(top_n).to_dict(orient='records')
+    return snapshot.records(rows)
+
+#filters, sort order and limit a query asks for, read from its text
+def query_plan(query, snapshot):
+    plan = plan_query_text(query, snapshot.typed)
+    if plan:
+        logger.info(f"Query plan: {plan}")
+    return plan
+
+#retrieve rows for the keywords of many queries at once, scoring all of them in one pass over the dataset
+def retrieve_rows_for_keyword_batch(keyword_lists, csv, top_n=3, queries=None):
+    """
+    Batch version of retrieve_rows_for_keywords: returns the top rows for each keyword list.
+
+    BM25 scores of all the queries are stacked into a (queries, rows) matrix and the
+    queries' vectors are compared with every row in a single matrix product, then the
+    hybrid scores and top rows are computed on the whole matrix. Very large batches are
+    scored in slices of at most BATCH_SCORE_CELLS cells to bound memory.
+    """
+    snapshot = get_dataset(csv)
+    step = max(1, BATCH_SCORE_CELLS // max(snapshot.rows, 1))
+    results = []
+    for start in range(0, len(keyword_lists), step):
+        keywords_slice = [list(keywords) for keywords in keyword_lists[start:start + step]]
+        scores = np.vstack([snapshot.index.scores(keywords) for keywords in keywords_slice])
+        if queries is not None and snapshot.vectors is not None and HYBRID_ALPHA < 1:
+            texts = [" ".join([query] + keywords) for query, keywords in zip(queries[start:start + step], keywords_slice)]
+            scores = hybrid_scores(scores, snapshot.vectors.scores_many(texts))
+        queries_slice = queries[start:start + step] if queries is not None else [None] * len(keywords_slice)
+        for query, row_scores in zip(queries_slice, scores):
+            rows = select_rows(query_plan(query, snapshot), snapshot.typed, row_scores, top_n)
+            results.append(snapshot.records(rows))
+    return results
+
+# Most characters of column content sent to GPT-4o in one summarization prompt
+SUMMARY_CHUNK_CHARS = int(os.environ.get("SUMMARY_CHUNK_CHARS", 12000))
+
+# Most chunks summarized per column, values are sampled evenly when a column has more
+SUMMARY_MAX_CHUNKS = int(os.environ.get("SUMMARY_MAX_CHUNKS", 4))
+
+# Longest a single value may be in a summarization prompt
+SUMMARY_VALUE_CHARS = 500
+
+# Number of columns summarized at the same time
+SUMMARY_WORKERS = int(os.environ.get("SUMMARY_WORKERS", 4))
+
+
+#split a column into prompt-sized chunks of distinct values, sampled evenly if they don't all fit
+def column_chunks(values, chunk_chars=SUMMARY_CHUNK_CHARS, max_chunks=SUMMARY_MAX_CHUNKS, value_chars=SUMMARY_VALUE_CHARS):
+    distinct = list(dict.fromkeys(
+        " ".join(str(value).split())[:value_chars] for value in values if pd.notna(value) and str(value).strip()
+    ))
+    total_chars = sum(len(value) + 2 for value in distinct)
+    budget = chunk_chars * max_chunks
+    if total_chars > budget:
+        # Deterministic sample so an interrupted run resumes with the same chunks
+        step = -(-total_chars // budget)
+        distinct = distinct[::step]
+
+    chunks, chunk, size = [], [], 0
+    for value in distinct:
+        if chunk and size + len(value) + 2 > chunk_chars:
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(value)
+        size += len(value) + 2
+    if chunk:
+        chunks.append(chunk)
+    return chunks[:max_chunks]
+
+
+#summarise one column map-reduce style: summarise each chunk, then merge the chunk summaries
+def summarise_column(name, values):
+    chunks = column_chunks(values)
+    if not chunks:
+        return summarise_cols(name, [])
+    summaries = [summarise_cols(name, chunk) for chunk in chunks]
+    if len(summaries) == 1:
+        return summaries[0]
+    return combine_col_summaries(name, summaries)
+
+
+def _load_checkpoint(path, version):
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # Summaries of another version of the dataset can't be reused
+    if checkpoint.get("version") != version:
+        return {}
+    return checkpoint.get("columns", {})
+
+
+def _save_checkpoint(path, version, summaries):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": version, "columns": summaries}, f)
+    os.replace(tmp_path, path)
+
 
 # Create .csv of metadata so we can perform column-wide queries
-def data_info_col(csv, output_csv="column_summary_info.csv"):
-    # Load the CSV file into a DataFrame
-    df = pd.read_csv(csv)
+def data_info_col(csv, output_csv=SUMMARY_CSV, workers=SUMMARY_WORKERS):
+    """
+    Summarises every column with GPT-4o and saves the summaries to output_csv.
+
+    Columns are summarised concurrently by up to `workers` threads, each column
+    from a bounded sample of its distinct values split into chunks (map-reduce).
+    Every finished column is written to a checkpoint next to output_csv, so an
+    interrupted run only redoes the columns that were not finished.
+    """
+    # Reuse the parsed dataset instead of reading the CSV file again
+    snapshot = get_dataset(csv)
+    df = snapshot.df
     
     # Prepare data for summary information
     column_names = df.columns.tolist()
     total_rows = len(df)
-    
-    # Generate summaries for each column
-    column_summaries = []
-    for col in tqdm(column_names, desc="Processing metadata"):
-        column_data = df[col].tolist()
+
+    checkpoint_path = f"{output_csv}.checkpoint.json"
+    summaries = _load_checkpoint(checkpoint_path, snapshot.version)
+    if summaries:
+        logger.info(f"Resuming column summaries, {len(summaries)} of {len(column_names)} columns already done")
+    lock = threading.Lock()
+
+    def summarise(col):
         #call gpt 4o to generate summary per column and their respective column name for context
-        summary = summarise_cols(col,column_data)
-        column_summaries.append(summary)
+        summary = summarise_column(col, df[col].tolist())
+        with lock:
+            summaries[col] = summary
+            _save_checkpoint(checkpoint_path, snapshot.version, summaries)
+
+    # Generate summaries for the remaining columns
+    remaining = [col for col in column_names if col not in summaries]
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="summarise") as executor:
+        futures = [executor.submit(summarise, col) for col in remaining]
+        try:
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Processing metadata"):
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
     
     # Create a DataFrame to store the summary information
     summary_df = pd.DataFrame({
         "Column Name": column_names,
-        "Description": column_summaries,
+        "Description": [summaries[col] for col in column_names],
         "Total Rows": [total_rows] * len(column_names)  # Same count for each column
     })
     
     # Save the summary information to a CSV file
     summary_df.to_csv(output_csv, index=False)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
     
     return column_names, total_rows, output_csv
 
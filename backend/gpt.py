@@ -1,26 +1,100 @@
-from openai import OpenAI
 from dotenv import load_dotenv
+import json
 import os
+import re
+import time
+import data
 from data import *
+from keyword_index import STOPWORDS, tokenize
+from coalesce import SingleFlight
+from llm import LLMGateway
+from llm_cache import create_llm_cache
+from metrics import record_cache_lookup, record_stage, stage
+from prompt import PROMPT_TOKEN_BUDGET, PromptBuilder
+from stats import profile_facts
+import logging
 load_dotenv()
 
-#initialize openai client
-client = OpenAI(
-    api_key=os.environ.get("openai-api-key"),
-)
+logger = logging.getLogger(__name__)
+
+#gateway to gpt 4o: pooled client, per call deadlines, retries, concurrency limit and circuit breaker
+gateway = LLMGateway(api_key=os.environ.get("openai-api-key"))
+
+#cache of gpt 4o answers, keyed on the prompt and the version of the dataset it was answered from
+llm_cache = create_llm_cache(version=lambda: data.dataset_version())
+
+#identical gpt 4o calls in flight at the same time are made once and their answer shared
+flights = SingleFlight()
+
+#gpt 4o completion served from the cache when the same prompt was answered before for the same data
+def chat_completion(call, messages, model="gpt-4o", **params):
+    with stage(call):
+        key = llm_cache.key(call, model, messages, **params)
+        answer = llm_cache.get(key)
+        record_cache_lookup(call, answer is not None)
+        if answer is None:
+            answer = flights.do(call, key, lambda: _complete_and_cache(call, key, model, messages, **params))
+    return answer
+
+def _complete_and_cache(call, key, model, messages, **params):
+    answer = gateway.complete(call, model, messages, **params)
+    llm_cache.set(key, answer)
+    return answer
 
 #Maximium history length such that out context length does not exceed token length
 MAX_HISTORY_LENGTH = 10  # Limit for recent exchanges in full to prevent exceeding token length
 
+# Most words of a question, and of the first sentence of its answer, kept in a conversation summary
+SUMMARY_QUESTION_WORDS = 25
+SUMMARY_ANSWER_WORDS = 30
+
 #summarize older convos to retain key info and to keep exchanges longer based on max history length set in script
 def summarize_conversation(conversation):
-    """Summarize older exchanges into a single line"""
-    summary = " ".join([f"{exchange['user']} asked about {exchange['assistant']}." for exchange in conversation[:-MAX_HISTORY_LENGTH]])
+    """
+    Summarize older exchanges into a single line, after the summary stored with the conversation (if any).
+
+    Stored conversations fold every exchange into their summary once it leaves the last
+    MAX_HISTORY_LENGTH (see conversation.py), so this only reads the stored summary.
+    """
+    stored = getattr(conversation, "summary", "")
+    summary = " ".join(part for part in (stored, summarize_exchanges(conversation[:-MAX_HISTORY_LENGTH])) if part)
     return summary
 
+#one line summary of a list of exchanges
+def summarize_exchanges(exchanges):
+    return " ".join([summarize_exchange(exchange) for exchange in exchanges])
+
+#extractive summary of one exchange: the question and the first sentence of the answer, both shortened
+def summarize_exchange(exchange):
+    question = _clip_words(exchange['user'], SUMMARY_QUESTION_WORDS)
+    answer = re.split(r"(?<=[.!?])\s", " ".join(str(exchange['assistant']).split()), maxsplit=1)[0]
+    return f"Q: {question} A: {_clip_words(answer, SUMMARY_ANSWER_WORDS)}"
+
+def _clip_words(text, words):
+    parts = str(text).split()
+    return " ".join(parts[:words]) + ("…" if len(parts) > words else "")
+
+#gpt 4o compression of a conversation's rolling summary, run in the background once it grows long
+def compress_summary(summary, max_words=120):
+    answer = gateway.complete(
+        "compress_summary",
+        model="gpt-4o",
+        messages=[
+            {
+                "role": "user",
+                "content": f"""Rewrite this summary of an earlier conversation about video games in at most {max_words} words.
+                Keep the games, genres and preferences the user mentioned and the key facts they were told, oldest first.
+
+                Summary: {summary}"""
+            },
+        ],
+    )
+    return answer.strip()
+
 #gpt 4o function to summarise columns for metadata
 def summarise_cols(name,col):
-    response = client.chat.completions.create(
+    answer = gateway.complete(
+        "summarise_cols",
         model="gpt-4o",
         messages=[
             {
@@ -34,33 +108,38 @@ def summarise_cols(name,col):
             },
         ],
     )
-    answer = response.choices[0].message.content
+    return answer
+
+#gpt 4o function to merge the summaries of several chunks of one column into a single summary
+def combine_col_summaries(name, summaries):
+    joined = "\n\n".join(f"- {summary}" for summary in summaries)
+    answer = gateway.complete(
+        "combine_col_summaries",
+        model="gpt-4o",
+        messages=[
+            {
+                "role": "user",
+                "content": f"""The following summaries each describe a sample of the same column in a dataset about game descriptions.
+                Combine them into one concise and general summary that describes the main purpose of this column.
+
+                Column Name: {name}
+                Summaries:
+                {joined}
+
+                The summary should briefly explain what information this column contains without going into extensive detail."""
+            },
+        ],
+    )
     return answer
 
 
 #function for row based queries
 def generator_rag_rowbase(conversation_history, user_input, relevant_data):
-    # Convert retrieved data (rows) to readable text block for gpt 4o to understand context
-    context = "\n\n".join([
-    f"Game: {row['name']}\n"
-    f"Short Description: {row['short_description']}\n"
-    f"Long Description: {row['long_description']}\n"
-    f"Genres: {row['genres']}\n"
-    f"Minimum System Requirement: {row['minimum_system_requirement']}\n"
-    f"Recommended System Requirement: {row['recommend_system_requirement']}\n"
-    f"Release Date: {row['release_date']}\n"
-    f"Developer: {row['developer']}\n"
-    f"Publisher: {row['publisher']}\n"
-    f"Overall Player Rating: {row['overall_player_rating']}\n"
-    f"Number of Reviews from Purchased People: {row['number_of_reviews_from_purchased_people']}\n"
-    f"Number of English Reviews: {row['number_of_english_reviews']}\n"
-    f"Link: {row['link']}"
-    for row in relevant_data
-    ])
-    #generate a prompt with summarized older exchanges, full recent exchanges AND rows retrieved
-    prompt = generate_prompt_row(conversation_history, user_input, context)
-    response = client.chat.completions.create(
-        model="gpt-4o",
+    #generate a prompt with summarized older exchanges, full recent exchanges AND rows retrieved, within the token budget
+    with stage("prompt"):
+        prompt = generate_prompt_row(conversation_history, user_input, relevant_data)
+    answer = chat_completion(
+        "generator_rag_rowbase",
         messages=[
             {
                 "role": "user",
@@ -68,44 +147,110 @@ def generator_rag_rowbase(conversation_history, user_input, relevant_data):
             },
         ],
     )
-    answer = response.choices[0].message.content
     return answer
 
 
+#streaming version of generator_rag_rowbase, yields the answer in pieces as gpt 4o produces them
+def stream_rag_rowbase(conversation_history, user_input, relevant_data):
+    with stage("prompt"):
+        prompt = generate_prompt_row(conversation_history, user_input, relevant_data)
+    return stream_completion("generator_rag_rowbase", prompt)
+
+
+#stream a gpt 4o completion for a prompt, yielding text deltas. Closing the generator closes the upstream stream.
+def stream_completion(call, prompt, model="gpt-4o"):
+    messages = [
+        {
+            "role": "user",
+            "content": f"{prompt}"
+        },
+    ]
+    # A cached answer is sent as a single piece; streamed answers are cached once complete
+    start = time.perf_counter()
+    key = llm_cache.key(call, model, messages)
+    answer = llm_cache.get(key)
+    record_cache_lookup(call, answer is not None)
+    if answer is not None:
+        record_stage(call, time.perf_counter() - start)
+        yield answer
+        return
+
+    # The same answer being streamed to another request is sent as a single piece once complete
+    flight, leader = flights.join(key) if flights.enabled else (None, False)
+    if flight is not None and not leader:
+        answer = flights.follow(call, flight)
+        if answer is not None:
+            record_stage(call, time.perf_counter() - start)
+            yield answer
+            return
+
+    answer = None
+    try:
+        stream = gateway.stream(call, model, messages)
+        parts = []
+        try:
+            for text in stream:
+                parts.append(text)
+                yield text
+        finally:
+            stream.close()
+            record_stage(call, time.perf_counter() - start)
+        answer = "".join(parts)
+        llm_cache.set(key, answer)
+    finally:
+        # Waiters of an answer that failed or was abandoned by its client make their own calls
+        if leader:
+            flights.finish(key, flight, result=answer or None)
+
+
 #Gives context from retrieved rows and history from chat to gpt 4o as a prompt for contextual response
-def generate_prompt_row(conversation, user_input, context):
+def generate_prompt_row(conversation, user_input, relevant_data, budget=PROMPT_TOKEN_BUDGET):
     """
     Generates a prompt with summarized older exchanges and full recent exchanges,
     along with context (row data) and the latest user input.
+
+    The prompt is kept within `budget` tokens, filled in priority order: the latest
+    user input, recent exchanges (newest first), the retrieved rows (most relevant
+    first, long fields excerpted) and finally the summary of older exchanges.
+    `relevant_data` may also be an already formatted context string.
     """
+    builder = PromptBuilder(budget)
+    header = builder.require("instructions", "This is a conversation about video games. Here is some context:\n\n")
 
-    # Summarize older exchanges
-    summary = summarize_conversation(conversation)
+    # add the latest user input
+    latest = builder.require("user_input", f"User: {user_input}\nAssistant:")
 
-    # Keep only recent exchanges in full detail
-    recent_conversation = conversation[-MAX_HISTORY_LENGTH:]
+    # add recent number of (MAX HISTORY LENGTH) conversation exchanges in full detail
+    recent = builder.add_turns("recent_turns", conversation[-MAX_HISTORY_LENGTH:])
 
-    # Build the prompt
-    prompt = f"This is a conversation about video games. Here is some context:\n\n{context}\n\n"
-    
-    # add summarized history if it exists
-    if summary:
-        prompt += f"Summary of previous conversation: {summary}\n\n"
+    # add the retrieved rows, followed by a blank line
+    separator = builder.require("instructions", "\n\n")
+    if isinstance(relevant_data, str):
+        context = builder.fit("rows", relevant_data)
+    else:
+        context = builder.add_rows("rows", relevant_data, query=user_input)
 
-    # add recent number of (MAX HISTORY LENGTH) conversation exchanges in full detail
-    for exchange in recent_conversation:
-        prompt += f"User: {exchange['user']}\nAssistant: {exchange['assistant']}\n"
-    
-    # add the latest user input
-    prompt += f"User: {user_input}\nAssistant:"
+    # add summarized history if it exists and there is room left
+    summary = builder.fit_section("summary", "Summary of previous conversation: ", summarize_conversation(conversation))
+
+    # Build the prompt
+    prompt = f"{header}{context}{separator}{summary}{recent}{latest}"
+    log_prompt_report("generate_prompt_row", builder)
     return prompt
 
+#log the tokens each section of a prompt took
+def log_prompt_report(name, builder):
+    report = builder.report()
+    logger.info(f"{name} tokens: {report['total']}/{report['budget']} {report['sections']}")
+    return report
+
 #function for response to col-based queries
 def generator_rag_colbase(conversation_history, user_input,csv_summary):
 
-    prompt = generate_prompt_col(conversation_history, user_input,csv_summary)
-    response = client.chat.completions.create(
-        model="gpt-4o",
+    with stage("prompt"):
+        prompt = generate_prompt_col(conversation_history, user_input,csv_summary, facts=dataset_facts())
+    answer = chat_completion(
+        "generator_rag_colbase",
         messages=[
             {
                 "role": "user",
@@ -113,48 +258,107 @@ def generator_rag_colbase(conversation_history, user_input,csv_summary):
             },
         ],
     )
-    answer = response.choices[0].message.content
     return answer
 
 
+#streaming version of generator_rag_colbase
+def stream_rag_colbase(conversation_history, user_input, csv_summary):
+    with stage("prompt"):
+        prompt = generate_prompt_col(conversation_history, user_input, csv_summary, facts=dataset_facts())
+    return stream_completion("generator_rag_colbase", prompt)
+
+
+#exact statistics of the current dataset (counts, top values, ranges) for the metadata prompt
+def dataset_facts():
+    return profile_facts(data.get_dataset().profile)
+
 #gives context in terms of meta data, convo history and summarise history for convos that exceed length. 
-def generate_prompt_col(conversation, user_input,csv_summary):
+def generate_prompt_col(conversation, user_input,csv_summary, budget=PROMPT_TOKEN_BUDGET, facts=""):
     """
     Generates a prompt with summarized older exchanges and full recent exchanges,
     along with context and the latest user input.
-    """
-    # Format the CSV summary data (meta data) as part of the context
-    csv_context = "\n\n".join([
-        f"{col_summary['Column Name']}: {col_summary['Description']}: {col_summary['Total Rows']}:"
-        for col_summary in csv_summary
-    ])
 
-
-    # Summarize older exchanges
-    summary = summarize_conversation(conversation)
-
-    # Keep only recent exchanges in full detail
-    recent_conversation = conversation[-MAX_HISTORY_LENGTH:]
-
-    # Build the prompt
-    prompt = f"""You are a knowledgeable assistant for a dataset about video games.
+    The prompt is kept within `budget` tokens, filled in priority order: the latest
+    user input, recent exchanges (newest first), the dataset facts, the column
+    summaries and finally the summary of older exchanges.
+    """
+    builder = PromptBuilder(budget)
+    header = builder.require("instructions", """You are a knowledgeable assistant for a dataset about video games.
     Please respond concisely to the user's question based on the information provided.
     Do not reference this context explicitly unless the user asks for details.
     Here is the dataset context:
-    {csv_context}"""
-    
-    # add summarized history if it exists
-    if summary:
-        prompt += f"Summary of previous conversation: {summary}\n\n"
+    """)
 
-    # add recent number of (MAX HISTORY LENGTH) conversation exchanges in full detail
-    for exchange in recent_conversation:
-        prompt += f"User: {exchange['user']}\nAssistant: {exchange['assistant']}\n"
-    
     # add the latest user input
-    prompt += f"User: {user_input}\nAssistant:"
+    latest = builder.require("user_input", f"User: {user_input}\nAssistant:")
+
+    # add recent number of (MAX HISTORY LENGTH) conversation exchanges in full detail
+    recent = builder.add_turns("recent_turns", conversation[-MAX_HISTORY_LENGTH:])
+
+    # add exact statistics computed from the dataset
+    facts = builder.fit_section("facts", "Dataset statistics:\n", facts)
+
+    # Format the CSV summary data (meta data) as part of the context. The row count is left to the
+    # dataset statistics, the summaries' count is stale once the csv is reloaded
+    csv_context = builder.fit_section("columns", "", "\n\n".join([
+        f"{col_summary['Column Name']}: {col_summary['Description']}"
+        for col_summary in csv_summary
+    ]))
+
+    # add summarized history if it exists and there is room left
+    summary = builder.fit_section("summary", "Summary of previous conversation: ", summarize_conversation(conversation))
+
+    # Build the prompt
+    prompt = f"{header}{facts}{csv_context}{summary}{recent}{latest}"
+    log_prompt_report("generate_prompt_col", builder)
     return prompt
 
+#Limits on the keywords generate_keywords hands to retrieval
+MAX_KEYWORDS = 10
+MAX_KEYWORD_LENGTH = 50
+
+#turn the model's keyword answer into a clean list of terms
+def parse_keywords(text):
+    """
+    Parses keywords from a model answer into a normalized, deduplicated list.
+
+    Accepts JSON ({"keywords": [...]} or a bare list) and falls back to splitting
+    free text on commas, semicolons and newlines, dropping labels, list markers
+    and quotes. Keywords are lowercased with whitespace collapsed.
+    """
+    text = re.sub(r"^\s*```(?:json)?|```\s*$", "", str(text or "")).strip()
+    items = None
+    try:
+        parsed = json.loads(text)
+        if isinstance(parsed, dict):
+            # A JSON object without a keyword list has no keywords, its text isn't one
+            parsed = parsed.get("keywords") or []
+        if isinstance(parsed, list):
+            items = parsed
+        elif isinstance(parsed, str):
+            text = parsed
+    except ValueError:
+        pass
+    if items is None:
+        text = re.sub(r"^\s*keywords\s*:", "", text, flags=re.IGNORECASE)
+        items = re.split(r"[,;\n]", text)
+
+    keywords = []
+    for item in items:
+        if not isinstance(item, str):
+            continue
+        keyword = re.sub(r"^\s*(?:\d+[.)]|[-*\u2022])\s*", "", item)
+        keyword = " ".join(keyword.strip().strip("\"'`").lower().split())
+        if keyword and len(keyword) <= MAX_KEYWORD_LENGTH and keyword not in keywords:
+            keywords.append(keyword)
+        if len(keywords) >= MAX_KEYWORDS:
+            break
+    return keywords
+
+#keywords taken straight from the query, used when the model gives nothing usable
+def fallback_keywords(query):
+    return list(dict.fromkeys(token for token in tokenize(query) if token not in STOPWORDS))[:MAX_KEYWORDS]
+
 #keyword generator for row based retrieval. 
 def generate_keywords(query):
     """
@@ -163,27 +367,35 @@ def generate_keywords(query):
     Parameters:
     - query (str): The user's query.
     Returns:
-    - answer (str): The response content generated by GPT-4o.
+    - keywords (list of str): Normalized, deduplicated keywords generated by GPT-4o,
+      or terms from the query itself if generation fails.
     """
-    system_message = "Generate keywords from the user query to perform keyword matching and retrieve relevant rows."
+    system_message = (
+        "Generate keywords from the user query to perform keyword matching and retrieve relevant rows "
+        "from a dataset of video games (names, genres, developers, publishers, descriptions). "
+        f"Respond with a JSON object of the form {{\"keywords\": [\"...\"]}} containing at most {MAX_KEYWORDS} "
+        "short keywords or phrases, most important first."
+    )
     user_message = query
 
     # Generate response using GPT-4
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
+        answer = chat_completion(
+            "generate_keywords",
             messages=[
                 {"role": "system", "content": system_message},
                 {"role": "user", "content": user_message},
-            ]
+            ],
+            response_format={"type": "json_object"},
         )
-        # Extract and return the answer content
-        answer = response.choices[0].message.content
-        return answer
+        # Parse the answer content
+        keywords = parse_keywords(answer)
     
     except Exception as e:
-        print(f"Error in GPT-4o generation: {e}")
-        return "An error occurred while processing the query."
+        logger.warning(f"Error in GPT-4o generation: {e}")
+        keywords = []
+
+    return keywords or fallback_keywords(query)
 
 #determine if the query is asking row based or column based questions. Allow us to determine if we retreive rows or look at overall data as meta
 def query_type(query, conversation):
@@ -195,8 +407,8 @@ def query_type(query, conversation):
     # Get the previous user query or assistant response as context, if available
     previous_context = conversation[-1]['user'] if conversation else ""
     
-    response = client.chat.completions.create(
-        model="gpt-4o",
+    answer = chat_completion(
+        "query_type",
         messages=[
             {
                 "role": "system",
@@ -226,5 +438,92 @@ def query_type(query, conversation):
             },
         ],
     )
-    answer = response.choices[0].message.content.strip()
-    return answer
\ No newline at end of file
+    return parse_query_type(answer)
+
+#read the label out of the model's answer to query_type, which may come with extra wording or formatting
+def parse_query_type(text):
+    """
+    Returns "Metadata" or "Row-specific" for answers like "**Metadata**" or "The query is
+    Row-specific." Whichever label is mentioned first wins; answers naming neither are Row-specific.
+    """
+    text = str(text or "").lower()
+    metadata = text.find("metadata")
+    row = re.search(r"row[\s-]*(specific|based|wise)", text)
+    if metadata >= 0 and (row is None or metadata < row.start()):
+        return "Metadata"
+    if row is None:
+        logger.warning(f"Unexpected query type answer {text[:80]!r}, treating it as Row-specific")
+    return "Row-specific"
+
+#read the per query types and keywords out of the model's answer to plan_queries
+def parse_query_plans(text, count):
+    """
+    Parses a plan_queries answer ({"results": [{"id": 0, "type": ..., "keywords": [...]}]})
+    into a list of `count` (row_col, keywords) pairs, in query order. row_col is None and
+    keywords are empty for queries the answer leaves out or garbles.
+    """
+    text = re.sub(r"^\s*```(?:json)?|```\s*$", "", str(text or "")).strip()
+    try:
+        parsed = json.loads(text)
+    except ValueError:
+        parsed = None
+    items = parsed.get("results") if isinstance(parsed, dict) else parsed
+
+    plans = [(None, [])] * count
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        try:
+            i = int(item.get("id"))
+        except (TypeError, ValueError):
+            continue
+        if not 0 <= i < count:
+            continue
+        kind = str(item.get("type", "")).strip().lower()
+        row_col = "Metadata" if kind.startswith("meta") else "Row-specific" if kind.startswith("row") else None
+        keywords = item.get("keywords")
+        plans[i] = (row_col, parse_keywords(json.dumps(keywords)) if isinstance(keywords, list) else [])
+    return plans
+
+#classify several queries and generate their keywords in a single gpt 4o call, for batches of queries
+def plan_queries(queries, conversation):
+    """
+    Does the work of query_type and generate_keywords for several queries at once,
+    packing them into one GPT-4o call.
+
+    Returns:
+    - list of (row_col, keywords) in the order of `queries`. Queries the model left out
+      are classified on their own with query_type; missing keywords fall back to terms
+      from the query itself.
+    """
+    previous_context = conversation[-1]['user'] if conversation else ""
+    system_message = (
+        "You are planning retrieval for several user queries about a dataset of video games. For each query, decide "
+        "whether it asks for Metadata (general information about the dataset, such as the number of games, the "
+        "columns or the types of data in them) or Row-specific information (details about individual games), and "
+        "generate keywords to match rows of the dataset (names, genres, developers, publishers, descriptions). "
+        "Use the previous context to clarify vague queries. Respond with a JSON object of the form "
+        '{"results": [{"id": 0, "type": "Metadata" or "Row-specific", "keywords": ["..."]}]} '
+        f"with one result per query and at most {MAX_KEYWORDS} short keywords or phrases each, most important first."
+    )
+    user_message = json.dumps({
+        "previous_context": previous_context,
+        "queries": [{"id": i, "query": query} for i, query in enumerate(queries)],
+    })
+
+    answer = chat_completion(
+        "plan_queries",
+        messages=[
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": user_message},
+        ],
+        response_format={"type": "json_object"},
+    )
+
+    plans = []
+    for query, (row_col, keywords) in zip(queries, parse_query_plans(answer, len(queries))):
+        if row_col is None:
+            logger.warning("Query left out of the batch plan, classifying it on its own.")
+            row_col = query_type(query, conversation)
+        plans.append((row_col, keywords or fallback_keywords(query)))
+    return plans
@@ -0,0 +1,74 @@
+import gc
+import logging
+import os
+import shutil
+
+# Production server settings, used by the Docker image: gunicorn -c gunicorn.conf.py main:app
+# Local development can still run `python main.py` (Flask's development server).
+
+# Workers write their metrics here so /metrics aggregates all of them. Set up before the app is imported,
+# and emptied since the files of a previous run would be added to this one's.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus-metrics")
+shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 6000)}"
+
+# The Fargate task (main.tf) has 0.25 vCPU and 512 MB. Requests mostly wait on GPT-4o, so a few
+# processes with many threads each serve more users than one process per CPU would, and every
+# extra process costs memory. WEB_CONCURRENCY/GUNICORN_THREADS override this for bigger tasks.
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+# Import main (secret key, column summaries, dataset snapshot, keyword and vector indexes) once in the
+# master before forking, so workers share those pages copy-on-write instead of each loading its own.
+preload_app = True
+
+# A worker that doesn't report back for this long is restarted. Streams run in their own thread, so
+# long answers don't trip it.
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+
+# On SIGTERM (ECS stopping the task), workers finish in-flight requests for up to this long. Kept
+# below the task's stopTimeout (30s) so they exit before being killed.
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 25))
+
+# Longer than the ALB's idle timeout (60s), so the ALB always closes idle connections first and
+# never sends a request on a connection gunicorn just closed (which it would answer with a 502)
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 75))
+
+# Recycle workers now and then to bound memory growth, staggered so they don't restart together
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = 100
+
+accesslog = "-"
+errorlog = "-"
+
+
+def when_ready(server):
+    if workers > 1 and os.environ.get("CONVERSATION_STORE", "memory") == "memory":
+        logging.getLogger(__name__).warning(
+            "CONVERSATION_STORE=memory with several workers: each worker keeps its own conversations, use sqlite."
+        )
+
+    # Move everything the preloaded app allocated out of the garbage collector's generations, so
+    # collections in the workers don't write to (and copy) the shared pages
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import data
+    import gpt
+
+    # A dataset reload running in the master while it forked must not leave its locks held in the worker
+    data.after_fork()
+
+    # Connections the master's OpenAI client may have opened while preloading must not be shared
+    gpt.gateway.after_fork()
+
+
+def child_exit(server, worker):
+    import metrics
+
+    metrics.mark_process_dead(worker.pid)
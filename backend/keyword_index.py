@@ -0,0 +1,272 @@
+import bisect
+import math
+import re
+from collections import Counter
+
+import numpy as np
+
+# Tokens are runs of letters and digits in any script, e.g. "Action-RPG" -> ["action", "rpg"], "Café" -> ["café"]
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+# How much a keyword hit in each column counts towards a row's score
+FIELD_WEIGHTS = {
+    "name": 3.0,
+    "genres": 2.0,
+    "short_description": 1.5,
+    "developer": 1.5,
+    "publisher": 1.2,
+    "long_description": 1.0,
+    "release_date": 1.0,
+    "overall_player_rating": 0.8,
+    "minimum_system_requirement": 0.3,
+    "recommend_system_requirement": 0.3,
+    "number_of_reviews_from_purchased_people": 0.2,
+    "number_of_english_reviews": 0.2,
+    "link": 0.1,
+}
+DEFAULT_FIELD_WEIGHT = 1.0
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Terms matched only through a prefix count for less than exact matches
+PREFIX_WEIGHT = 0.5
+MIN_PREFIX_LENGTH = 3
+MAX_PREFIX_EXPANSIONS = 50
+
+# Endings a query word the index knows is still matched with ("king" -> "kings", but not "kingdom")
+INFLECTIONS = ("s", "es")
+
+# Words that carry no meaning for retrieval and are dropped from queries
+STOPWORDS = frozenset("""
+a about all an and any are as at be by can do does for from game games give has have how i in is it
+keyword keywords like me more of on or please related show some tell than that the their there these
+this to what which with you your
+""".split())
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(str(text).casefold())
+
+
+class KeywordIndex:
+    """
+    Inverted index over the text of every column, built once per dataset snapshot.
+
+    Each term maps to a pair of arrays (row ids, precomputed BM25 contributions),
+    where a row's term frequency is the sum over columns of the column's field
+    weight times the number of occurrences. Scores are accumulated over the postings
+    of the query terms only (matches and search), so their cost depends on how many
+    rows contain the terms rather than on the number of rows; scores() then spreads
+    them over a dense array of every row, for blending with vector similarities.
+    """
+
+    def __init__(self, columns, field_weights=None):
+        weights = FIELD_WEIGHTS if field_weights is None else field_weights
+        self.rows = 0
+        frequencies = {}
+        doc_length = None
+
+        for col, values in columns.items():
+            values = list(values)
+            if doc_length is None:
+                self.rows = len(values)
+                doc_length = np.zeros(self.rows, dtype=np.float64)
+            weight = weights.get(col, DEFAULT_FIELD_WEIGHT)
+            if weight <= 0:
+                continue
+            for row, text in enumerate(values):
+                tokens = tokenize(text)
+                doc_length[row] += weight * len(tokens)
+                for term, count in Counter(tokens).items():
+                    postings = frequencies.setdefault(term, {})
+                    postings[row] = postings.get(row, 0.0) + weight * count
+
+        if doc_length is None:
+            doc_length = np.zeros(0, dtype=np.float64)
+        average_length = doc_length.mean() if self.rows and doc_length.mean() > 0 else 1.0
+        length_norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_length / average_length)
+
+        # Postings of all terms back to back in sorted term order, term i's are [offsets[i]:offsets[i + 1]]
+        terms = sorted(frequencies)
+        rows, scores = [], []
+        for term in terms:
+            postings = frequencies[term]
+            term_rows = np.fromiter(postings.keys(), dtype=np.int32, count=len(postings))
+            tf = np.fromiter(postings.values(), dtype=np.float64, count=len(postings))
+            idf = self._idf(len(term_rows))
+            rows.append(term_rows)
+            scores.append((idf * tf * (BM25_K1 + 1) / (tf + length_norm[term_rows])).astype(np.float32))
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(term_rows) for term_rows in rows], out=offsets[1:])
+        self._set_postings(
+            terms,
+            offsets,
+            np.concatenate(rows) if rows else np.zeros(0, dtype=np.int32),
+            np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32),
+        )
+
+    def _set_postings(self, terms, offsets, rows, scores):
+        # Sorted vocabulary, a list or any sequence of strings (e.g. a snapshot's memory-mapped StringColumn)
+        self.terms = terms
+        self._offsets = offsets
+        self._rows = rows
+        self._scores = scores
+        self.memory_bytes = offsets.nbytes + rows.nbytes + scores.nbytes
+
+    def state(self):
+        """Arrays to save the index with (see snapshot.py), the vocabulary as a list of strings."""
+        return {
+            "documents": np.array(self.rows),
+            "terms": list(self.terms),
+            "offsets": self._offsets,
+            "rows": self._rows,
+            "scores": self._scores,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """Index over saved arrays, which are used as they are (memory-mapped ones stay on disk until read)."""
+        index = cls.__new__(cls)
+        index.rows = int(state["documents"])
+        index._set_postings(state["terms"], state["offsets"], state["rows"], state["scores"])
+        return index
+
+    def __len__(self):
+        return len(self.terms)
+
+    def _idf(self, matching):
+        return math.log(1 + (self.rows - matching + 0.5) / (matching + 0.5))
+
+    def _position(self, term):
+        i = bisect.bisect_left(self.terms, term)
+        return i if i < len(self.terms) and self.terms[i] == term else None
+
+    def _postings(self, position):
+        start, end = self._offsets[position], self._offsets[position + 1]
+        return self._rows[start:end], self._scores[start:end]
+
+    def lookup(self, term):
+        """Return (row ids, scores) for an exact term, or None."""
+        position = self._position(term)
+        return None if position is None else self._postings(position)
+
+    def prefix_terms(self, prefix, limit=MAX_PREFIX_EXPANSIONS):
+        """Return indexed terms starting with prefix, in sorted order."""
+        start = bisect.bisect_left(self.terms, prefix)
+        matches = []
+        for i in range(start, min(start + limit, len(self.terms))):
+            term = self.terms[i]
+            if not term.startswith(prefix):
+                break
+            matches.append(term)
+        return matches
+
+    def query_words(self, keywords, prefix=True):
+        """
+        Expand keywords into one {indexed term: weight} per distinct query word, skipping
+        words that match nothing.
+
+        Keywords may be a string or a list of strings. A keyword ending in "*"
+        is always prefix-matched; with prefix=True every term of at least
+        MIN_PREFIX_LENGTH characters also matches longer terms at PREFIX_WEIGHT.
+        Terms that are words of the index themselves only match their INFLECTIONS
+        that way, so "war" finds "wars" but not "warhammer" or "warships".
+        """
+        if isinstance(keywords, str):
+            keywords = [keywords]
+        words = {}
+        for keyword in keywords:
+            keyword = str(keyword).strip()
+            tokens = [token for token in tokenize(keyword) if token not in STOPWORDS]
+            for i, token in enumerate(tokens):
+                weights = words.setdefault(token, {})
+                known = self._position(token) is not None
+                if known:
+                    weights[token] = 1.0
+                explicit = keyword.endswith("*") and i == len(tokens) - 1
+                if explicit or (prefix and len(token) >= MIN_PREFIX_LENGTH and not known):
+                    expansions = self.prefix_terms(token)
+                elif prefix and len(token) >= MIN_PREFIX_LENGTH:
+                    expansions = [token + ending for ending in INFLECTIONS if self._position(token + ending) is not None]
+                else:
+                    expansions = []
+                for term in expansions:
+                    if term != token:
+                        weights[term] = max(weights.get(term, 0.0), PREFIX_WEIGHT)
+        return [weights for weights in words.values() if weights]
+
+    def query_terms(self, keywords, prefix=True):
+        """Expand keywords into {indexed term: weight}, merging the terms of every query word (see query_words)."""
+        return _merge(self.query_words(keywords, prefix=prefix))
+
+    def matches(self, keywords, prefix=True):
+        """
+        Return (row ids in ascending order, scores) of the rows matching any of the keywords.
+
+        A row's score is its BM25 score times the share of the query's words it matches, each
+        word weighted by its idf, so a row matching the rare word of "monkey king" ranks above
+        rows matching only the common one, even in their name.
+        """
+        words = self.query_words(keywords, prefix=prefix)
+        postings = [(self.lookup(term), weight) for term, weight in _merge(words).items()]
+        if not postings:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        rows = np.concatenate([term_rows for (term_rows, _), _ in postings])
+        scores = np.concatenate([term_scores.astype(np.float64) * weight for (_, term_scores), weight in postings])
+        # Sum the contributions of each row's terms, in term order like a dense accumulation would
+        order = np.argsort(rows, kind="stable")
+        rows, scores = rows[order], scores[order]
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        rows, scores = rows[starts].astype(np.int64), np.add.reduceat(scores, starts)
+
+        if len(words) > 1:
+            coverage = np.zeros(len(rows), dtype=np.float64)
+            total = 0.0
+            for terms in words:
+                word_rows = np.unique(np.concatenate([self.lookup(term)[0] for term in terms]))
+                idf = self._idf(len(word_rows))
+                coverage[np.searchsorted(rows, word_rows)] += idf
+                total += idf
+            scores = scores * coverage / total
+        return rows, scores
+
+    def scores(self, keywords, prefix=True):
+        """Return a dense array with the BM25 score of every row for the keywords."""
+        rows, scores = self.matches(keywords, prefix=prefix)
+        totals = np.zeros(self.rows, dtype=np.float64)
+        totals[rows] = scores
+        return totals
+
+    def search(self, keywords, top_n=3, prefix=True):
+        """Return up to top_n (row id, score) pairs, best first. Ties keep file order."""
+        return top_matches(*self.matches(keywords, prefix=prefix), top_n=top_n)
+
+
+def _merge(words):
+    """One {term: weight} from several, keeping each term's highest weight."""
+    weights = {}
+    for terms in words:
+        for term, weight in terms.items():
+            weights[term] = max(weights.get(term, 0.0), weight)
+    return weights
+
+
+def top_scores(totals, top_n=3):
+    """Return up to top_n (row id, score) pairs with a positive score, best first. Ties keep file order."""
+    candidates = np.flatnonzero(totals > 0)
+    return top_matches(candidates, totals[candidates], top_n)
+
+
+def top_matches(rows, scores, top_n=3):
+    """top_scores over the matched rows only, given as row ids in ascending order and their scores."""
+    if top_n <= 0:
+        return []
+    positive = scores > 0
+    rows, scores = rows[positive], scores[positive]
+    if len(rows) > top_n:
+        best = np.sort(np.argpartition(-scores, top_n - 1)[:top_n])
+        rows, scores = rows[best], scores[best]
+    order = np.argsort(-scores, kind="stable")
+    return [(int(rows[i]), float(scores[i])) for i in order]
@@ -0,0 +1,292 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import httpx
+from openai import APIConnectionError, APITimeoutError, InternalServerError, OpenAI, RateLimitError
+
+from metrics import (
+    LLM_CALL_SECONDS, LLM_CIRCUIT_OPEN, LLM_ERRORS, LLM_REJECTED, LLM_RETRIES, record_usage,
+)
+
+logger = logging.getLogger(__name__)
+
+# OpenAI-compatible endpoint, e.g. http://127.0.0.1:8089/v1 for the fake server in fake_openai.py. Empty for OpenAI.
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL") or None
+
+# Connection pool of the HTTP client, per worker process
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 32))
+LLM_MAX_KEEPALIVE = int(os.environ.get("LLM_MAX_KEEPALIVE", 16))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", 5))
+
+# Most GPT-4o calls in flight per process, and how long a call waits for a free slot before giving up
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 16))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", 5))
+
+# Retries on rate limits (429), server errors (5xx) and connection failures, with full-jitter exponential backoff
+LLM_BACKOFF_SECONDS = float(os.environ.get("LLM_BACKOFF_SECONDS", 0.5))
+LLM_BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", 8))
+
+# Consecutive failed calls after which the circuit opens, and seconds before a trial call is let through
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", 5))
+LLM_BREAKER_RESET_SECONDS = float(os.environ.get("LLM_BREAKER_RESET_SECONDS", 30))
+
+# (deadline in seconds, attempts) per call type. The deadline covers all attempts and backoff;
+# for streamed answers it bounds the wait for the response and for each following chunk.
+CALL_POLICIES = {
+    "query_type": (15, 3),
+    "generate_keywords": (15, 3),
+    "plan_queries": (30, 3),
+    "generator_rag_rowbase": (90, 3),
+    "generator_rag_colbase": (90, 3),
+    "summarise_cols": (180, 6),
+    "combine_col_summaries": (180, 6),
+    "compress_summary": (60, 2),
+}
+DEFAULT_POLICY = (60, 3)
+
+# Deadline overrides as JSON, e.g. LLM_DEADLINES='{"query_type": 10}'
+LLM_DEADLINES = json.loads(os.environ.get("LLM_DEADLINES", "{}"))
+
+# Errors worth another attempt: the service was rate limiting, failing or unreachable
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+
+
+class LLMUnavailable(Exception):
+    """GPT-4o can't be called right now (circuit open or too many calls in flight). Answered with a 503."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMTimeout(TimeoutError):
+    """A call's deadline passed before GPT-4o answered."""
+
+
+def backoff_delay(attempt, error=None, base=LLM_BACKOFF_SECONDS, cap=LLM_BACKOFF_MAX):
+    """Full-jitter exponential backoff, but at least the Retry-After the service asked for."""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    retry_after = getattr(getattr(error, "response", None), "headers", {}).get("retry-after")
+    if retry_after:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            pass
+    return delay
+
+
+class CircuitBreaker:
+    """
+    Opens after `failures` consecutive failed calls so requests fail fast instead of piling
+    up on a broken upstream. After `reset_seconds` a single trial call is let through
+    (half-open): its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, failures=LLM_BREAKER_FAILURES, reset_seconds=LLM_BREAKER_RESET_SECONDS):
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opens = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise LLMUnavailable if the call may not go upstream."""
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self.state == "open":
+                wait = self._opened_at + self.reset_seconds - time.monotonic()
+                if wait > 0:
+                    raise LLMUnavailable("GPT-4o circuit is open", retry_after=wait)
+                self.state = "half_open"
+                self._trial = False
+            if self._trial:
+                raise LLMUnavailable("GPT-4o circuit is half-open, waiting for the trial call", retry_after=1)
+            self._trial = True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info("GPT-4o circuit closed")
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self._trial = False
+            LLM_CIRCUIT_OPEN.set(0)
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.consecutive_failures >= self.failures):
+                logger.warning(f"GPT-4o circuit opened after {self.consecutive_failures} consecutive failures")
+                self.state = "open"
+                self.opens += 1
+                self._opened_at = time.monotonic()
+                LLM_CIRCUIT_OPEN.set(1)
+            self._trial = False
+
+    def release(self):
+        """End a call that says nothing about the upstream's health (e.g. a bug on our side)."""
+        with self._lock:
+            self._trial = False
+
+
+class LLMGateway:
+    """
+    Single way out to GPT-4o. Every call goes through a pooled HTTP client and gets a
+    deadline for its call type, retries with backoff on 429/5xx/connection errors, a slot
+    of a bounded semaphore and the circuit breaker's verdict.
+    """
+
+    def __init__(self, api_key=None, base_url=OPENAI_BASE_URL, max_concurrency=LLM_MAX_CONCURRENCY,
+                 breaker=None, policies=None, deadlines=LLM_DEADLINES):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.breaker = breaker or CircuitBreaker()
+        self.policies = dict(CALL_POLICIES, **(policies or {}))
+        for call, deadline in deadlines.items():
+            self.policies[call] = (float(deadline), self.policy(call)[1])
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self.client = self._create_client()
+
+    def _create_client(self):
+        http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE,
+                keepalive_expiry=30,
+            ),
+            timeout=httpx.Timeout(DEFAULT_POLICY[0], connect=LLM_CONNECT_TIMEOUT),
+        )
+        # Retries are ours (with jitter, deadlines and the circuit breaker), not the SDK's
+        return OpenAI(api_key=self.api_key, base_url=self.base_url, http_client=http_client, max_retries=0)
+
+    def after_fork(self):
+        """Give a forked worker its own connection pool, connections opened by the parent must not be shared."""
+        self.client = self._create_client()
+
+    def policy(self, call):
+        return self.policies.get(call, DEFAULT_POLICY)
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _acquire(self, call, timeout):
+        if not self._slots.acquire(timeout=max(timeout, 0)):
+            self._count("rejected")
+            LLM_REJECTED.labels(call, "concurrency").inc()
+            raise LLMUnavailable("Too many GPT-4o calls in flight", retry_after=1)
+
+    def _run(self, call, request, slot=True):
+        """Call request(timeout) until it succeeds, retrying within the call type's deadline and attempts."""
+        deadline_seconds, attempts = self.policy(call)
+        deadline = time.monotonic() + deadline_seconds
+        for attempt in range(attempts):
+            if slot:
+                self._acquire(call, min(LLM_QUEUE_TIMEOUT, deadline - time.monotonic()))
+            try:
+                try:
+                    self.breaker.before_call()
+                except LLMUnavailable:
+                    LLM_REJECTED.labels(call, "circuit_open").inc()
+                    raise
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.breaker.release()
+                    self._count("timeouts")
+                    raise LLMTimeout(f"{call} deadline of {deadline_seconds}s passed")
+                self._count("calls")
+                start = time.perf_counter()
+                try:
+                    result = request(remaining)
+                except RETRYABLE_ERRORS as e:
+                    self.breaker.record_failure()
+                    self._count("failures")
+                    LLM_CALL_SECONDS.labels(call, "retryable_error").observe(time.perf_counter() - start)
+                    LLM_ERRORS.labels(call, type(e).__name__).inc()
+                    error = e
+                except Exception as e:
+                    self.breaker.release()
+                    LLM_CALL_SECONDS.labels(call, "error").observe(time.perf_counter() - start)
+                    LLM_ERRORS.labels(call, type(e).__name__).inc()
+                    raise
+                else:
+                    self.breaker.record_success()
+                    LLM_CALL_SECONDS.labels(call, "ok").observe(time.perf_counter() - start)
+                    return result
+            finally:
+                if slot:
+                    self._slots.release()
+
+            delay = backoff_delay(attempt, error)
+            if attempt == attempts - 1 or time.monotonic() + delay >= deadline:
+                if isinstance(error, APITimeoutError):
+                    self._count("timeouts")
+                    raise LLMTimeout(f"{call} timed out after {deadline_seconds}s") from error
+                raise error
+            self._count("retries")
+            LLM_RETRIES.labels(call).inc()
+            logger.warning(f"{call} failed ({type(error).__name__}), retrying in {delay:.2f}s")
+            time.sleep(delay)
+
+    def complete(self, call, model, messages, **params):
+        """Text of a chat completion."""
+        response = self._run(
+            call,
+            lambda timeout: self.client.chat.completions.create(model=model, messages=messages, timeout=timeout, **params),
+        )
+        record_usage(call, response.usage)
+        return response.choices[0].message.content
+
+    def stream(self, call, model, messages, **params):
+        """
+        Yield the text deltas of a streamed chat completion. Failures are retried until
+        the response starts; the call keeps its concurrency slot until the stream ends.
+        """
+        self._acquire(call, LLM_QUEUE_TIMEOUT)
+        try:
+            stream = self._run(
+                call,
+                lambda timeout: self.client.chat.completions.create(
+                    model=model, messages=messages, stream=True, timeout=timeout,
+                    # The last chunk then carries the token usage
+                    stream_options={"include_usage": True}, **params
+                ),
+                slot=False,
+            )
+            try:
+                for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+                    record_usage(call, getattr(chunk, "usage", None))
+            except httpx.TimeoutException as e:
+                self._count("timeouts")
+                raise LLMTimeout(f"{call} stream stalled") from e
+            finally:
+                stream.close()
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "circuit": self.breaker.state,
+            "circuit_opens": self.breaker.opens,
+        }
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Seconds a cached answer is served before GPT-4o is asked again
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", 3600))
+
+# Bounds of the in-process cache, the least recently used answers are evicted first
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 2048))
+LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", 32 * 2**20))
+
+# Shared backend, e.g. redis://localhost:6379/0, so every task serves the same hits. Empty means in-process only.
+LLM_CACHE_URL = os.environ.get("LLM_CACHE_URL", "")
+
+
+def normalize_text(text):
+    """Casefold, collapse whitespace and drop trailing punctuation so trivially different prompts share a key."""
+    return re.sub(r"\s+", " ", str(text)).strip().casefold().rstrip("?!. ")
+
+
+class MemoryBackend:
+    """In-process LRU cache with per-entry expiry, bounded by entry count and total size."""
+
+    def __init__(self, max_entries=LLM_CACHE_MAX_ENTRIES, max_bytes=LLM_CACHE_MAX_BYTES, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value, size = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                self.bytes -= size
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        size = len(key) + len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self._entries[key] = (self.clock() + ttl, value, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+
+class RedisBackend:
+    """
+    Shared cache in Redis (or anything speaking its protocol), so ECS tasks reuse each other's answers.
+    Redis errors are logged and treated as misses, a cache outage must not fail queries.
+    """
+
+    def __init__(self, url):
+        # Optional dependency, only needed when LLM_CACHE_URL is set
+        import redis
+
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+    def __len__(self):
+        return 0
+
+    def get(self, key):
+        try:
+            value = self._client.get(key)
+        except Exception as e:
+            logger.warning(f"LLM cache get failed: {e}")
+            return None
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key, value, ttl):
+        try:
+            self._client.set(key, value, ex=max(int(ttl), 1))
+        except Exception as e:
+            logger.warning(f"LLM cache set failed: {e}")
+
+    def clear(self):
+        # Keys carry the dataset version, stale ones are never read again and expire through their TTL
+        pass
+
+
+class LLMCache:
+    """
+    Cache of LLM answers keyed on call type, model, normalized messages, request
+    parameters and the dataset version, so answers are invalidated whenever the
+    data they were generated from changes.
+    """
+
+    def __init__(self, backend, version=lambda: "", ttl=LLM_CACHE_TTL, namespace="llm"):
+        self.backend = backend
+        self.version = version
+        self.ttl = ttl
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+
+    def key(self, call, model, messages, **params):
+        version = self.version()
+        if version != self._version:
+            # Drop answers generated from an older dataset from the local backend
+            if self._version is not None:
+                self.backend.clear()
+            self._version = version
+        payload = json.dumps(
+            {
+                "call": call,
+                "model": model,
+                "messages": [{"role": m["role"], "content": normalize_text(m["content"])} for m in messages],
+                "params": params,
+            },
+            sort_keys=True,
+        )
+        return f"{self.namespace}:{version}:{call}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if value:
+            self.backend.set(key, value, self.ttl)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": len(self.backend),
+            "version": self._version,
+        }
+
+
+def create_llm_cache(version=lambda: "", url=LLM_CACHE_URL):
+    """Create the cache with the shared backend if LLM_CACHE_URL is set, falling back to in-process memory."""
+    backend = None
+    if url:
+        try:
+            backend = RedisBackend(url)
+        except ImportError:
+            logger.warning("LLM_CACHE_URL is set but the redis package is not installed, using in-process cache.")
+    return LLMCache(backend or MemoryBackend(), version=version)
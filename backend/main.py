@@ -1,13 +1,19 @@
+import json
 import os
 import secrets
-from flask import Flask, request, jsonify, session
+import time
+from flask import Flask, Response, g, request, jsonify, session
 from dotenv import load_dotenv
 from pathlib import Path
 import pandas as pd
 from data import *
 from gpt import *
+from conversation import create_conversation_store
+from pipeline import BATCH_MAX_QUERIES, BATCH_WINDOW, answer_batch, answer_locally, plan_query, stream_answer
 import logging
 from openai import OpenAIError
+from llm import LLMUnavailable
+import metrics
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -37,54 +43,139 @@ else:
 app = Flask(__name__)
 app.secret_key = secret_key
 
-# File path for the metadata CSV
-SUMMARY_CSV = "column_summary_info.csv"
-
 # Generate or load the metadata CSV once
 def load_summary_data():
     if not os.path.exists(SUMMARY_CSV):
-        data_info_col("games_description.csv", output_csv=SUMMARY_CSV)
+        data_info_col(DATASET_CSV, output_csv=SUMMARY_CSV)
     return pd.read_csv(SUMMARY_CSV).to_dict(orient="records")
 
 # Load the meta data once when the app starts
 summary_data = load_summary_data()
 
-@app.route("/")
-def home():
-    return "You have successfully called the base API! "
+# Parse the games dataset once when the app starts, later requests reuse the snapshot
+get_dataset(DATASET_CSV)
 
-# POST request for RAG of rows as context (plus chat history) for question answering or metadata as context (plus chat history) for column based queries
-@app.route('/query', methods=['POST'])
-def querykeywordmatching():
+# Seconds of silence after which /query/stream sends an SSE comment, so neither the client nor the
+# ALB in front of the service (60s idle timeout) drops the connection while GPT-4o is working
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", 15))
+
+# Conversations are kept server-side by session id, the session cookie only carries the id
+conversation_store = create_conversation_store()
+
+# Validate the JSON body of a query request, returns (user_input, None) or (None, error response)
+def get_user_input():
     # Ensure request is JSON
     if not request.is_json:
         logger.warning("Request must be in JSON format.")
-        return jsonify({"error": "Request must be in JSON format"}), 400
+        return None, (jsonify({"error": "Request must be in JSON format"}), 400)
 
     data = request.get_json()
-    user_input = data.get('query', None)
+    user_input = data.get('query', None) if isinstance(data, dict) else None
 
     # Handle empty or non-string query
     if not isinstance(user_input, str):
-        return jsonify({"error": "Query must be a string."}), 400
+        return None, (jsonify({"error": "Query must be a string."}), 400)
     if user_input is None or user_input.strip() == "":
-        return jsonify({"error": "Query field is required and cannot be empty."}), 400
-    
-    user_input = user_input.strip()
+        return None, (jsonify({"error": "Query field is required and cannot be empty."}), 400)
 
-    try:
-        # Initialize session memory if it doesn't exist
-        if 'conversation' not in session:
-            session['conversation'] = []
+    return user_input.strip(), None
+
+# Validate the JSON body of a batch request, returns ((queries, stateless, window), None) or (None, error response)
+def get_batch_input():
+    if not request.is_json:
+        logger.warning("Request must be in JSON format.")
+        return None, (jsonify({"error": "Request must be in JSON format"}), 400)
+
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return None, (jsonify({"error": "Queries must be a non-empty list of strings."}), 400)
+    queries = data.get('queries', None)
+    if not isinstance(queries, list) or not queries:
+        return None, (jsonify({"error": "Queries must be a non-empty list of strings."}), 400)
+    if len(queries) > BATCH_MAX_QUERIES:
+        return None, (jsonify({"error": f"A batch can have at most {BATCH_MAX_QUERIES} queries."}), 400)
+    for i, query in enumerate(queries):
+        if not isinstance(query, str) or query.strip() == "":
+            return None, (jsonify({"error": f"Query {i} must be a non-empty string."}), 400)
+
+    stateless = data.get('stateless', False)
+    window = data.get('concurrency', BATCH_WINDOW)
+    if not isinstance(stateless, bool):
+        return None, (jsonify({"error": "Stateless must be true or false."}), 400)
+    if not isinstance(window, int) or isinstance(window, bool) or window < 1:
+        return None, (jsonify({"error": "Concurrency must be a positive integer."}), 400)
+
+    return ([query.strip() for query in queries], stateless, window), None
+
+# Return the session id, creating one for new sessions
+def get_session_id():
+    if 'sid' not in session:
+        session['sid'] = secrets.token_hex(16)
+    return session['sid']
+
+# Map an exception raised while answering to the same message the JSON endpoint would return
+def error_message(e):
+    if isinstance(e, KeyError):
+        return f"Missing field: {str(e)}"
+    if isinstance(e, ValueError):
+        return str(e)
+    if isinstance(e, LLMUnavailable):
+        return "The query API service is unavailable. Please try again later."
+    if isinstance(e, OpenAIError):
+        return "Failed to connect to query API service"
+    if isinstance(e, TimeoutError):
+        return "The query API service timed out. Please try again later."
+    return "An internal error occurred. Please try again later."
+
+# Format one Server-Sent Event
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-        # Retrieve relevant data from CSV for row-based retrieval
-        relevant_data = retrieve_relevant_rows(user_input, 'games_description.csv')
+# Start timing the request and collecting the stages it goes through
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+    g.timings = metrics.start_request()
 
-        # Retrieve conversation history from session
-        conversation_history = session['conversation']
+# Record the request's latency and status, and list its stages in a Server-Timing header
+@app.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    if endpoint != "/metrics" and "start" in g:
+        elapsed = time.perf_counter() - g.start
+        metrics.REQUEST_SECONDS.labels(endpoint).observe(elapsed)
+        metrics.REQUESTS.labels(endpoint, request.method, str(response.status_code)).inc()
+        if metrics.SERVER_TIMING and g.timings:
+            response.headers["Server-Timing"] = metrics.server_timing(g.timings + [("total", elapsed)])
+    return response
+
+@app.route("/")
+def home():
+    return "You have successfully called the base API! "
+
+# POST request for RAG of rows as context (plus chat history) for question answering or metadata as context (plus chat history) for column based queries
+@app.route('/query', methods=['POST'])
+def querykeywordmatching():
+    user_input, error = get_user_input()
+    if error:
+        return error
+
+    try:
+        # Retrieve conversation history of this session from the conversation store
+        sid = get_session_id()
+        with metrics.stage("load_history"):
+            conversation_history = conversation_store.load(sid)
         
-        # Determine if the query is asking for metadata (column-wise) or row-based data
-        row_col = query_type(user_input, conversation_history)
+        # Answer common aggregate questions directly from the dataset statistics
+        answer = answer_locally(user_input, DATASET_CSV)
+        if answer is not None:
+            with metrics.stage("store_history"):
+                conversation_store.append(sid, user_input, answer)
+            return jsonify({"response": answer})
+
+        # Determine if the query is asking for metadata (column-wise) or row-based data, generating
+        # keywords concurrently and retrieving relevant rows from the dataset only for row-based queries
+        row_col, relevant_data = plan_query(user_input, conversation_history, DATASET_CSV)
         
         if row_col == 'Metadata':
             # Generate response based on column-wise (metadata) information
@@ -93,9 +184,9 @@ def querykeywordmatching():
             # Generate response based on row-wise retrieval
             answer = generator_rag_rowbase(conversation_history, user_input, relevant_data)  
 
-        # Update conversation history in session
-        conversation_history.append({"user": user_input, "assistant": answer})
-        session['conversation'] = conversation_history
+        # Update conversation history in the conversation store
+        with metrics.stage("store_history"):
+            conversation_store.append(sid, user_input, answer)
 
         return jsonify({"response": answer})
 
@@ -105,6 +196,10 @@ def querykeywordmatching():
     except ValueError as e:
         logger.error(f"Invalid value: {e}")
         return jsonify({"error": str(e)}), 400
+    except LLMUnavailable as e:
+        logger.error(f"Query API service unavailable: {e}")
+        headers = {"Retry-After": str(max(int(e.retry_after or 1), 1))}
+        return jsonify({"error": "The query API service is unavailable. Please try again later."}), 503, headers
     except OpenAIError as e:
         logger.error(f"Query API service error: {e}")
         return jsonify({"error": "Failed to connect to query API service"}), 502
@@ -115,9 +210,87 @@ def querykeywordmatching():
         logger.error(f"Unexpected error: {e}")
         return jsonify({"error": "An internal error occurred. Please try again later."}), 500
 
+# POST request like /query, but the answer is streamed as Server-Sent Events while GPT-4o generates it
+@app.route('/query/stream', methods=['POST'])
+def querykeywordmatching_stream():
+    user_input, error = get_user_input()
+    if error:
+        return error
+
+    sid = get_session_id()
+    conversation_history = conversation_store.load(sid)
+
+    def generate():
+        # Send a first byte straight away so clients and proxies see the stream is open
+        yield ": stream opened\n\n"
+        for event, payload in stream_answer(user_input, conversation_history, summary_data, DATASET_CSV, heartbeat=SSE_HEARTBEAT_SECONDS):
+            if event == "heartbeat":
+                yield ": keep-alive\n\n"
+            elif event == "token":
+                yield sse_event("token", {"text": payload})
+            elif event == "done":
+                # Store the full answer so the next request of this session sees it in its history
+                conversation_store.append(sid, user_input, payload)
+                yield sse_event("done", {"response": payload})
+            else:
+                logger.error(f"Streaming query failed: {payload}")
+                yield sse_event("error", {"error": error_message(payload)})
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(generate(), mimetype="text/event-stream", headers=headers)
+
+# POST a list of queries, answered together and streamed back as one JSON line per query as soon as it is answered
+@app.route('/query/batch', methods=['POST'])
+def querykeywordmatching_batch():
+    batch, error = get_batch_input()
+    if error:
+        return error
+    queries, stateless, window = batch
+
+    # Stateless batches neither see nor add to the session's conversation; otherwise every query
+    # is answered with the history as it was when the batch started
+    sid = None if stateless else get_session_id()
+    conversation_history = [] if stateless else conversation_store.load(sid)
+
+    def generate():
+        distinct = answered = failed = 0
+        for indices, answer, exc in answer_batch(queries, conversation_history, summary_data, DATASET_CSV, window=window):
+            distinct += 1
+            if exc is None and sid is not None:
+                conversation_store.append(sid, queries[indices[0]], answer)
+            elif exc is not None:
+                logger.error(f"Batch query failed: {exc}")
+            for i in indices:
+                line = {"index": i, "query": queries[i]}
+                if exc is None:
+                    line["response"] = answer
+                    answered += 1
+                else:
+                    line["error"] = error_message(exc)
+                    failed += 1
+                yield json.dumps(line) + "\n"
+        yield json.dumps({"done": True, "queries": len(queries), "distinct": distinct, "answered": answered, "failed": failed}) + "\n"
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(generate(), mimetype="application/x-ndjson", headers=headers)
+
+# Latency histograms, token counts, cache lookups and upstream errors in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    content, content_type = metrics.render()
+    return Response(content, content_type=content_type)
+
+# Hit/miss counts of the GPT-4o answer cache
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(dict(llm_cache.stats(), coalescing=flights.stats()))
+
 @app.route('/reset', methods=['POST'])
 def reset():
+    # Drop any history left in cookies issued before conversations moved server-side
     session.pop('conversation', None)
+    if 'sid' in session:
+        conversation_store.reset(session['sid'])
     return jsonify({"message": "Conversation reset."})
 
 @app.errorhandler(404)
@@ -128,5 +301,6 @@ def page_not_found(e):
 def method_not_allowed(e):
     return jsonify({"error": "Method not allowed"}), 405
 
+# Development server; production runs gunicorn -c gunicorn.conf.py main:app
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=6000)
\ No newline at end of file
@@ -0,0 +1,103 @@
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+
+# Directory where every gunicorn worker writes its metrics so /metrics reports all of them (set by
+# gunicorn.conf.py). Unset, metrics are kept in this process only.
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+# Set to 0 to leave out the Server-Timing header with the stages of each request
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "1") == "1"
+
+# Seconds, from cache hits and index lookups (milliseconds) to long generations
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REQUESTS = Counter("api_requests_total", "HTTP requests handled", ["endpoint", "method", "status"])
+REQUEST_SECONDS = Histogram(
+    "api_request_seconds", "Time until the response started, per endpoint", ["endpoint"], buckets=LATENCY_BUCKETS
+)
+STAGE_SECONDS = Histogram(
+    "api_stage_seconds", "Time spent in each stage of answering a query", ["stage"], buckets=LATENCY_BUCKETS
+)
+
+LLM_CALL_SECONDS = Histogram(
+    "llm_call_seconds", "Latency of each upstream GPT-4o attempt", ["call", "outcome"], buckets=LATENCY_BUCKETS
+)
+LLM_TOKENS = Counter("llm_tokens_total", "Tokens reported by GPT-4o", ["call", "kind"])
+LLM_ERRORS = Counter("llm_errors_total", "Failed upstream GPT-4o attempts", ["call", "error"])
+LLM_RETRIES = Counter("llm_retries_total", "GPT-4o attempts retried after a failure", ["call"])
+LLM_REJECTED = Counter("llm_rejected_total", "GPT-4o calls failed fast without going upstream", ["call", "reason"])
+LLM_CIRCUIT_OPEN = Gauge("llm_circuit_open", "1 while the GPT-4o circuit breaker is open", multiprocess_mode="livemax")
+LLM_CACHE_LOOKUPS = Counter("llm_cache_lookups_total", "LLM answer cache lookups", ["call", "result"])
+LLM_COALESCED = Counter(
+    "llm_coalesced_total", "Calls that waited for an identical GPT-4o call in flight (shared and error ones were saved)", ["call", "result"]
+)
+
+ROUTER_DECISIONS = Counter("router_decisions_total", "Queries classified, by who decided (llm when the router wasn't sure)", ["source", "label"])
+ROUTER_AGREEMENT = Counter("router_agreement_total", "Router guesses compared with GPT-4o's label", ["source", "result"])
+
+# Stages recorded for the current request, as (name, seconds)
+_timings = contextvars.ContextVar("timings", default=None)
+
+
+def start_request():
+    """Start collecting the stage timings of a request. Returns the list they are added to."""
+    timings = []
+    _timings.set(timings)
+    return timings
+
+
+def record_stage(name, seconds):
+    STAGE_SECONDS.labels(name).observe(seconds)
+    timings = _timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+@contextmanager
+def stage(name):
+    """Time a block as one stage of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def record_cache_lookup(call, hit):
+    LLM_CACHE_LOOKUPS.labels(call, "hit" if hit else "miss").inc()
+
+
+def record_usage(call, usage):
+    """Count the tokens of a completion, from the usage object of the response (if it has one)."""
+    if usage is None:
+        return
+    LLM_TOKENS.labels(call, "prompt").inc(getattr(usage, "prompt_tokens", 0) or 0)
+    LLM_TOKENS.labels(call, "completion").inc(getattr(usage, "completion_tokens", 0) or 0)
+
+
+def server_timing(timings):
+    """Server-Timing header value, e.g. "query_type;dur=412.3, retrieval;dur=1.8"."""
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings)
+
+
+def render():
+    """Metrics in the Prometheus text format, with (content, content type)."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """Drop the live gauges of a worker process that exited."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,246 @@
+import contextvars
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+
+from data import DATASET_CSV, get_dataset, retrieve_rows_for_keyword_batch, retrieve_rows_for_keywords
+from llm_cache import normalize_text
+from metrics import stage
+from router import ROUTER_ENABLED, record_decision, route_query
+from stats import answer_from_profile
+from gpt import (
+    generate_keywords, generator_rag_colbase, generator_rag_rowbase, plan_queries, query_type,
+    stream_rag_colbase, stream_rag_rowbase,
+)
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on LLM calls the query pipeline runs in the background per process
+PIPELINE_WORKERS = int(os.environ.get("PIPELINE_WORKERS", 8))
+
+# Most queries accepted in one batch request
+BATCH_MAX_QUERIES = int(os.environ.get("BATCH_MAX_QUERIES", 500))
+
+# Queries of a batch classified and given keywords together in one GPT-4o call
+BATCH_PLAN_SIZE = int(os.environ.get("BATCH_PLAN_SIZE", 20))
+
+# Most GPT-4o calls one batch has in flight (its default and largest concurrency window), and threads shared by all batches
+BATCH_WINDOW = int(os.environ.get("BATCH_WINDOW", 8))
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", 16))
+
+# Threads are only started on first submit, so creating the pools at import is safe before a fork
+_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="pipeline")
+_batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch")
+
+
+#answer aggregate questions ("How many games are in the dataset?") from the dataset statistics, None otherwise
+def answer_locally(user_input, csv=DATASET_CSV):
+    with stage("local_answer"):
+        answer = answer_from_profile(user_input, get_dataset(csv).profile)
+    if answer is not None:
+        logger.info("Answered from dataset statistics without GPT-4o.")
+    return answer
+
+
+#classify the query and retrieve rows for it, locally when the router is sure and otherwise with both LLM calls at the same time
+def plan_query(user_input, conversation_history, csv=DATASET_CSV, top_n=3):
+    """
+    Determines whether the query is Metadata or Row-specific and retrieves rows for it.
+
+    The local router classifies obvious queries without GPT-4o: Metadata queries then
+    need no LLM call at all and Row-specific ones only the keyword call. When the router
+    isn't sure, keyword generation is started in the background while GPT-4o classifies
+    the query in the calling thread, so the two round-trips overlap; for Metadata queries
+    the keyword call is cancelled if it has not started yet and its result is discarded
+    otherwise. Retrieval only runs for Row-specific queries.
+
+    Returns:
+    - (row_col, relevant_data): the classification and the retrieved rows ([] for Metadata).
+    """
+    decision = None
+    if ROUTER_ENABLED:
+        with stage("route"):
+            snapshot = get_dataset(csv)
+            decision = route_query(
+                user_input, conversation_history, snapshot.titles, studios=snapshot.studios, typed=snapshot.typed,
+            )
+
+    if decision is not None and decision.label is not None:
+        row_col = decision.label
+        record_decision(decision, classify=partial(query_type, user_input, conversation_history))
+        if row_col == 'Metadata':
+            return row_col, []
+        keywords = generate_keywords(user_input)
+    else:
+        # Run in a copy of this context so the keyword call's timing is recorded with this request's stages
+        keywords_future = _executor.submit(contextvars.copy_context().run, generate_keywords, user_input)
+        try:
+            row_col = query_type(user_input, conversation_history)
+        except BaseException:
+            keywords_future.cancel()
+            raise
+        if decision is not None:
+            record_decision(decision, llm_label=row_col)
+
+        if row_col == 'Metadata':
+            if not keywords_future.cancel():
+                logger.debug("Keyword generation already running, discarding its result.")
+            return row_col, []
+
+        with stage("keywords_wait"):
+            keywords = keywords_future.result()
+
+    with stage("retrieval"):
+        relevant_data = retrieve_rows_for_keywords(keywords, csv, top_n=top_n, query=user_input)
+    return row_col, relevant_data
+
+
+#stream the answer to a query as it is generated, with heartbeats while nothing is produced
+def stream_answer(user_input, conversation_history, summary_data, csv=DATASET_CSV, heartbeat=15.0):
+    """
+    Plans the query and streams GPT-4o's answer, yielding (event, payload) pairs:
+    - ("token", text) for each piece of the answer, as soon as it arrives
+    - ("done", answer) with the full answer once the stream has finished
+    - ("error", exception) if classification, retrieval or generation failed
+    - ("heartbeat", None) whenever nothing was produced for `heartbeat` seconds
+
+    The work runs on its own thread so heartbeats keep flowing while GPT-4o is
+    still thinking. Closing this generator (e.g. the client disconnected) stops
+    reading the upstream stream and closes it.
+    """
+    events = queue.Queue()
+    cancelled = threading.Event()
+
+    def produce():
+        try:
+            answer = answer_locally(user_input, csv)
+            if answer is not None:
+                events.put(("token", answer))
+                events.put(("done", answer))
+                return
+            row_col, relevant_data = plan_query(user_input, conversation_history, csv)
+            if row_col == 'Metadata':
+                tokens = stream_rag_colbase(conversation_history, user_input, summary_data)
+            else:
+                tokens = stream_rag_rowbase(conversation_history, user_input, relevant_data)
+            parts = []
+            try:
+                for token in tokens:
+                    if cancelled.is_set():
+                        return
+                    parts.append(token)
+                    events.put(("token", token))
+            finally:
+                tokens.close()
+            events.put(("done", "".join(parts)))
+        except Exception as e:
+            events.put(("error", e))
+
+    threading.Thread(target=produce, name="pipeline-stream", daemon=True).start()
+    try:
+        while True:
+            try:
+                event, payload = events.get(timeout=heartbeat)
+            except queue.Empty:
+                yield "heartbeat", None
+                continue
+            yield event, payload
+            if event in ("done", "error"):
+                return
+    finally:
+        cancelled.set()
+
+
+#run (key, function) tasks on the batch pool with at most `window` running, yielding (key, result, error) as each finishes
+def _bounded(tasks, window):
+    tasks = iter(tasks)
+    pending = {}
+
+    def submit_next():
+        for key, fn in tasks:
+            pending[_batch_executor.submit(fn)] = key
+            return
+
+    try:
+        for _ in range(window):
+            submit_next()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                submit_next()
+                error = future.exception()
+                yield key, None if error else future.result(), error
+    finally:
+        # The caller stopped reading (e.g. the client disconnected), drop the work not started yet
+        for future in pending:
+            future.cancel()
+
+
+#answer many queries at once, yielding each distinct query's answer as soon as it is ready
+def answer_batch(queries, conversation_history, summary_data, csv=DATASET_CSV, window=BATCH_WINDOW):
+    """
+    Answers a batch of queries with as few GPT-4o round-trips as possible, yielding
+    (indices, answer, error) once per distinct query, in the order they finish:
+    - identical queries (up to case, whitespace and trailing punctuation) are answered once,
+      `indices` lists every position of the batch they appear at
+    - aggregate questions are answered from the dataset statistics first
+    - the other queries are classified and given keywords BATCH_PLAN_SIZE at a time,
+      in one GPT-4o call each
+    - rows for all Row-specific queries are retrieved in one pass over the dataset
+    - answers are generated with at most `window` (capped at BATCH_WINDOW) calls in flight
+
+    `error` is the exception a query failed with (answer is None then); one failed query
+    does not stop the others.
+    """
+    window = max(1, min(window, BATCH_WINDOW))
+    distinct = {}
+    for i, query in enumerate(queries):
+        distinct.setdefault(normalize_text(query), (query, []))[1].append(i)
+
+    pending = []
+    for query, indices in distinct.values():
+        answer = answer_locally(query, csv)
+        if answer is not None:
+            yield indices, answer, None
+        else:
+            pending.append((query, indices))
+
+    chunks = [pending[i:i + BATCH_PLAN_SIZE] for i in range(0, len(pending), BATCH_PLAN_SIZE)]
+    planned = []
+    tasks = (
+        (chunk, partial(plan_queries, [query for query, _ in chunk], conversation_history))
+        for chunk in chunks
+    )
+    for chunk, plans, error in _bounded(tasks, window):
+        if error is not None:
+            for _, indices in chunk:
+                yield indices, None, error
+            continue
+        planned.extend((query, indices, row_col, keywords) for (query, indices), (row_col, keywords) in zip(chunk, plans))
+
+    rows = [item for item in planned if item[2] != 'Metadata']
+    relevant = {}
+    if rows:
+        try:
+            with stage("retrieval"):
+                retrieved = retrieve_rows_for_keyword_batch(
+                    [keywords for _, _, _, keywords in rows], csv, queries=[query for query, _, _, _ in rows]
+                )
+            relevant = {query: data for (query, _, _, _), data in zip(rows, retrieved)}
+        except Exception as e:
+            for _, indices, _, _ in rows:
+                yield indices, None, e
+            planned = [item for item in planned if item[2] == 'Metadata']
+
+    tasks = (
+        (indices, partial(generator_rag_colbase, conversation_history, query, summary_data)
+            if row_col == 'Metadata'
+            else partial(generator_rag_rowbase, conversation_history, query, relevant[query]))
+        for query, indices, row_col, _ in planned
+    )
+    for indices, answer, error in _bounded(tasks, window):
+        yield indices, answer, error
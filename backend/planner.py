@@ -0,0 +1,347 @@
+import logging
+import operator
+import re
+
+import numpy as np
+import pandas as pd
+
+from keyword_index import top_scores
+from stats import parse_count_column, parse_date_column, parse_list_column
+
+logger = logging.getLogger(__name__)
+
+# Steam review summaries from worst to best, their position is the rating's rank.
+# Games with too few reviews for a summary ("7 user reviews") have no rank.
+RATING_SCALE = [
+    "Overwhelmingly Negative", "Very Negative", "Negative", "Mostly Negative", "Mixed",
+    "Mostly Positive", "Positive", "Very Positive", "Overwhelmingly Positive",
+]
+RATING_RANKS = {label.lower(): rank for rank, label in enumerate(RATING_SCALE)}
+
+# "Highly rated" means at least Very Positive, "poorly rated" at most Mixed
+HIGH_RATING = RATING_RANKS["very positive"]
+LOW_RATING = RATING_RANKS["mixed"]
+
+# Typed column -> source column in the csv
+NUMBER_COLUMNS = {
+    "reviews": "number_of_reviews_from_purchased_people",
+    "english_reviews": "number_of_english_reviews",
+}
+
+# Most rows a query can ask for ("top 50 games" gets this many)
+MAX_PLAN_LIMIT = 20
+
+OPERATORS = {">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le, "==": operator.eq}
+
+NUMBER_WORDS = {
+    "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10,
+    "eleven": 11, "twelve": 12, "fifteen": 15, "twenty": 20,
+}
+MULTIPLIERS = {"k": 1e3, "thousand": 1e3, "m": 1e6, "million": 1e6}
+
+# e.g. "10k", "10,000", "1.5 million"
+NUMBER = r"(\d[\d,]*(?:\.\d+)?)\s*(k|m|thousand|million)?"
+REVIEW_FILTER = re.compile(
+    r"\b(over|more than|above|at least|greater than|fewer than|less than|under|below|at most)\s+"
+    + NUMBER + r"\s+(english\s+)?(?:user\s+|player\s+)?reviews\b"
+)
+REVIEW_OPERATORS = {
+    "over": ">", "more than": ">", "above": ">", "greater than": ">", "at least": ">=",
+    "fewer than": "<", "less than": "<", "under": "<", "below": "<", "at most": "<=",
+}
+YEAR_RANGE = re.compile(r"\bbetween\s+((?:19|20)\d{2})\s+and\s+((?:19|20)\d{2})\b")
+YEAR_FILTER = re.compile(r"\b(after|since|before|from|in|during)\s+((?:19|20)\d{2})\b")
+YEAR_OPERATORS = {"after": ">", "since": ">=", "from": ">=", "before": "<", "in": "==", "during": "=="}
+# A rating label only filters next to a rating word ("mixed reviews", "rated very positive"),
+# so "mixed martial arts" or "a positive story" don't; longest labels first so "very positive" beats "positive"
+RATING_LABEL_PATTERNS = [
+    (RATING_RANKS[label], re.compile(
+        r"\b(?:rated|ratings?(?:\s+(?:of|is))?|reviewed(?:\s+as)?|reviews\s+(?:are|of))\s+" + label + r"\b"
+        r"|\b" + label + r"[\s-](?:(?:steam|user|player)\s+)?(?:rated|ratings?|reviews?|reviewed)\b"
+    ))
+    for label in sorted(RATING_RANKS, key=len, reverse=True)
+]
+HIGH_RATING_PATTERN = re.compile(
+    r"\b(highly|well|top|best|highest)[\s-](rated|reviewed)\b|\bcritically acclaimed\b|\bgood reviews\b"
+)
+LOW_RATING_PATTERN = re.compile(r"\b(poorly|badly|low|lowest|worst)[\s-](rated|reviewed)\b|\bbad reviews\b")
+LIMIT_PATTERN = re.compile(
+    r"\b(?:top|first|best|list|show(?: me)?|give me|recommend|name)\s+(\d+|" + "|".join(NUMBER_WORDS) + r")\b"
+    r"|\b(\d+|" + "|".join(NUMBER_WORDS) + r")\s+(?:[a-z-]+\s+){0,2}(?:games|titles)\b"
+)
+
+# A genre asked for as a kind of game ("RPGs", "roguelike games", "which shooter") filters the rows,
+# one mentioned in passing ("an epic story", "is it a war game?") only raises the relevance of the rows tagged with it
+GENRE_REQUEST_BEFORE = re.compile(r"\b(which|what)\s+$")
+GENRE_REQUEST_AFTER = re.compile(r"\s+(games|titles)\b")
+
+# Relevance of rows tagged with every genre mentioned in passing is multiplied by 1 + GENRE_BOOST
+GENRE_BOOST = 0.5
+
+# A sorted answer only orders the rows scoring at least this share of the most relevant row's score,
+# so "the newest Final Fantasy" is the newest of the Final Fantasy games and not of the whole dataset
+SORT_RELEVANCE = 0.5
+
+# (pattern, (typed column, descending)) for the orders a query can ask for
+SORT_PATTERNS = [
+    (re.compile(r"\b(highest|best|top)[\s-]rated\b|\bbest reviewed\b|\bhighest rating\b"), ("rating", True)),
+    (re.compile(r"\b(lowest|worst)[\s-]rated\b|\bworst reviewed\b|\blowest rating\b"), ("rating", False)),
+    (re.compile(r"\bmost (reviewed|reviews|popular|played)\b"), ("reviews", True)),
+    (re.compile(r"\b(least|fewest) (reviewed|reviews|popular|played)\b"), ("reviews", False)),
+    (re.compile(r"\b(newest|latest|most recent|recently released|new releases)\b"), ("release_date", True)),
+    (re.compile(r"\b(oldest|earliest)\b"), ("release_date", False)),
+]
+
+
+def _number(digits, unit=None):
+    return float(digits.replace(",", "")) * MULTIPLIERS.get(unit or "", 1)
+
+
+def _to_float(series):
+    return series.astype("float64").to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+class TypedColumns:
+    """
+    Typed views of the columns queries filter and sort on, parsed once per dataset snapshot:
+    release dates (days since 1970 and years), rating ranks, review counts and the rows
+    tagged with each genre. Every numeric column also has its ascending and descending
+    row orders built up front (missing values last), so sorted queries are a slice.
+    """
+
+    def __init__(self, df):
+        self.rows = len(df)
+        self.numbers = {}
+        if "release_date" in df.columns:
+            released = parse_date_column(df["release_date"])
+            self.numbers["release_date"] = _to_float((released - pd.Timestamp("1970-01-01")).dt.days)
+            self.numbers["release_year"] = _to_float(released.dt.year)
+        if "overall_player_rating" in df.columns:
+            labels = df["overall_player_rating"].astype(object).where(df["overall_player_rating"].notna(), "")
+            self.numbers["rating"] = _to_float(labels.astype(str).str.strip().str.lower().map(RATING_RANKS))
+        for name, col in NUMBER_COLUMNS.items():
+            if col in df.columns:
+                self.numbers[name] = _to_float(parse_count_column(df[col]))
+
+        self._orders = {}
+        for name, values in self.numbers.items():
+            # Ties are broken by the number of reviews, then by file order
+            ties = self.numbers.get("reviews", np.zeros(self.rows))
+            self._orders[name, False] = np.lexsort((-ties, values)).astype(np.int32)
+            self._orders[name, True] = np.lexsort((-ties, -values)).astype(np.int32)
+
+        self.genres = {}
+        if "genres" in df.columns:
+            for row, genres in enumerate(parse_list_column(df["genres"])):
+                for genre in genres:
+                    self.genres.setdefault(genre.lower(), []).append(row)
+        self.genres = {genre: np.unique(np.array(rows, dtype=np.int32)) for genre, rows in self.genres.items()}
+        self._finish()
+
+    def _finish(self):
+        # Longest names first, so "action rpg" is matched before "rpg"
+        names = sorted(self.genres, key=len, reverse=True)
+        self.genre_pattern = re.compile(
+            r"\b(" + "|".join(re.escape(name) for name in names) + r")s?\b"
+        ) if names else None
+
+        self.memory_bytes = sum(values.nbytes for values in self.numbers.values()) + sum(
+            order.nbytes for order in self._orders.values()
+        ) + sum(rows.nbytes for rows in self.genres.values())
+
+    def state(self):
+        """Arrays to save the columns with (see snapshot.py), genre names as a list of strings."""
+        genres = sorted(self.genres)
+        offsets = np.zeros(len(genres) + 1, dtype=np.int64)
+        np.cumsum([len(self.genres[genre]) for genre in genres], out=offsets[1:])
+        state = {
+            "rows": np.array(self.rows),
+            "genres": genres,
+            "genre_offsets": offsets,
+            "genre_rows": np.concatenate([self.genres[genre] for genre in genres]) if genres else np.zeros(0, dtype=np.int32),
+        }
+        for name, values in self.numbers.items():
+            state[f"number.{name}"] = values
+            state[f"ascending.{name}"] = self._orders[name, False]
+            state[f"descending.{name}"] = self._orders[name, True]
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        """Typed columns over saved arrays, which are used as they are."""
+        typed = cls.__new__(cls)
+        typed.rows = int(state["rows"])
+        typed.numbers, typed._orders = {}, {}
+        for key, values in state.items():
+            kind, _, name = key.partition(".")
+            if kind == "number":
+                typed.numbers[name] = values
+            elif kind in ("ascending", "descending"):
+                typed._orders[name, kind == "descending"] = values
+        offsets = state["genre_offsets"]
+        typed.genres = {genre: state["genre_rows"][offsets[i]:offsets[i + 1]] for i, genre in enumerate(state["genres"])}
+        typed._finish()
+        return typed
+
+    def order(self, column, descending=False):
+        """Row ids sorted by a numeric column, missing values last."""
+        return self._orders[column, descending]
+
+    def predicate(self, column, op, value):
+        """Boolean mask of the rows satisfying one filter. Rows missing the value never match."""
+        if column == "genres":
+            mask = np.zeros(self.rows, dtype=bool)
+            mask[self.genres.get(value, [])] = True
+            return mask
+        return OPERATORS[op](self.numbers[column], value)
+
+
+class QueryPlan:
+    """
+    Filters, sort order and row limit asked for by a query, run against TypedColumns.
+
+    Filters are (column, operator, value) with column "genres" (operator "has") or one of
+    the numeric typed columns; sort is (column, descending) or None; limit is None when
+    the query doesn't ask for a number of games; boosts are genres that only raise the
+    relevance of the rows tagged with them.
+    """
+
+    def __init__(self, filters=(), sort=None, limit=None, boosts=()):
+        self.filters = list(filters)
+        self.sort = sort
+        self.limit = limit
+        self.boosts = list(boosts)
+
+    def __bool__(self):
+        return bool(self.filters or self.sort or self.limit or self.boosts)
+
+    def __repr__(self):
+        return f"QueryPlan(filters={self.filters}, sort={self.sort}, limit={self.limit}, boosts={self.boosts})"
+
+    def mask(self, typed):
+        """Rows passing every filter, or None when there are no filters."""
+        if not self.filters:
+            return None
+        mask = np.ones(typed.rows, dtype=bool)
+        for column, op, value in self.filters:
+            mask &= typed.predicate(column, op, value)
+        return mask
+
+
+def plan_query_text(query, typed):
+    """Extract a QueryPlan from a natural language query, e.g. "highly rated RPGs released after 2022 with over 10k reviews"."""
+    text = " ".join(str(query or "").lower().split())
+    filters = []
+    if not text:
+        return QueryPlan()
+
+    for match in REVIEW_FILTER.finditer(text):
+        column = "english_reviews" if match.group(4) else "reviews"
+        if column in typed.numbers:
+            filters.append((column, REVIEW_OPERATORS[match.group(1)], _number(match.group(2), match.group(3))))
+    # Review counts are taken out so "over 2,000 reviews" isn't read as a year
+    text_without_counts = REVIEW_FILTER.sub(" ", text)
+
+    if "release_year" in typed.numbers:
+        for match in YEAR_RANGE.finditer(text_without_counts):
+            filters.append(("release_year", ">=", float(match.group(1))))
+            filters.append(("release_year", "<=", float(match.group(2))))
+        for match in YEAR_FILTER.finditer(YEAR_RANGE.sub(" ", text_without_counts)):
+            filters.append(("release_year", YEAR_OPERATORS[match.group(1)], float(match.group(2))))
+
+    if "rating" in typed.numbers:
+        for rank, pattern in RATING_LABEL_PATTERNS:
+            if pattern.search(text):
+                filters.append(("rating", "==", float(rank)))
+                break
+        else:
+            if HIGH_RATING_PATTERN.search(text):
+                filters.append(("rating", ">=", float(HIGH_RATING)))
+            elif LOW_RATING_PATTERN.search(text):
+                filters.append(("rating", "<=", float(LOW_RATING)))
+
+    boosts = []
+    if typed.genre_pattern is not None:
+        for match in typed.genre_pattern.finditer(text):
+            genre = match.group(1)
+            requested = (
+                match.group(0) != genre
+                or GENRE_REQUEST_AFTER.match(text, match.end())
+                or GENRE_REQUEST_BEFORE.search(text, 0, match.start())
+            )
+            if requested and ("genres", "has", genre) not in filters:
+                filters.append(("genres", "has", genre))
+            elif not requested and genre not in boosts:
+                boosts.append(genre)
+        boosts = [genre for genre in boosts if ("genres", "has", genre) not in filters]
+
+    sort = None
+    for pattern, order in SORT_PATTERNS:
+        if order[0] in typed.numbers and pattern.search(text):
+            sort = order
+            break
+
+    limit = None
+    match = LIMIT_PATTERN.search(text_without_counts)
+    if match:
+        word = match.group(1) or match.group(2)
+        limit = int(word) if word.isdigit() else NUMBER_WORDS[word]
+        limit = min(limit, MAX_PLAN_LIMIT) if limit > 0 else None
+
+    return QueryPlan(filters, sort, limit, boosts)
+
+
+def select_rows(plan, typed, scores, top_n=3):
+    """
+    Row ids to answer a query from, best first.
+
+    Rows are first narrowed down to those passing the plan's filters. With a sort order the
+    rows come from the pre-built order of that column, restricted to the ones relevant to the
+    query unless none are (a plain "newest games"); otherwise they are ranked by their
+    relevance scores, raised for the rows tagged with the plan's boosts, and when fewer than
+    the limit are relevant the most reviewed rows passing the filters fill up the rest.
+    Boosts never move the most relevant row, usually the game the query names, from the top.
+    If nothing passes the filters they are ignored, since they were extracted from free
+    text and may be wrong.
+    """
+    top_n = min(plan.limit or top_n, MAX_PLAN_LIMIT)
+    mask = plan.mask(typed)
+    if mask is not None and not mask.any():
+        logger.info(f"No rows pass the filters of {plan}, ranking all rows.")
+        mask = None
+
+    if plan.sort is not None:
+        order = typed.order(*plan.sort)
+        scores = np.asarray(scores)
+        keep = (scores > 0) & (scores >= SORT_RELEVANCE * scores.max(initial=0))
+        if mask is not None:
+            keep &= mask
+        if not keep.any():
+            keep = mask
+        if keep is not None:
+            order = order[keep[order]]
+        return order[:top_n].tolist()
+
+    if mask is None:
+        rows = [row for row, _ in top_scores(_boosted(plan, typed, scores), top_n)]
+        best = top_scores(scores, 1)
+        if best and rows[0] != best[0][0]:
+            rows = [best[0][0]] + [row for row in rows if row != best[0][0]][:top_n - 1]
+        return rows
+    rows = [row for row, _ in top_scores(np.where(mask, _boosted(plan, typed, scores), 0), top_n)]
+    if len(rows) < top_n and "reviews" in typed.numbers:
+        order = typed.order("reviews", True)
+        for row in order[mask[order]].tolist():
+            if len(rows) >= top_n:
+                break
+            if row not in rows:
+                rows.append(row)
+    return rows
+
+
+def _boosted(plan, typed, scores):
+    """Relevance scores raised for the rows tagged with the plan's boosts, by the share of them each row has."""
+    if not plan.boosts:
+        return scores
+    tagged = sum(typed.predicate("genres", "has", genre).astype(np.float64) for genre in plan.boosts)
+    return scores * (1 + GENRE_BOOST * tagged / len(plan.boosts))
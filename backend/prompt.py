@@ -0,0 +1,299 @@
+import logging
+import math
+import os
+import re
+
+from keyword_index import STOPWORDS, tokenize
+from stats import LIST_ITEM_PATTERN
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on the tokens of each generation prompt
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", 6000))
+
+# Longest a single recent exchange may be in the prompt, longer answers are truncated
+TURN_TOKEN_CAP = int(os.environ.get("PROMPT_TURN_TOKEN_CAP", 300))
+
+# Fewest tokens of a labelled section worth adding, a section cut shorter tells GPT-4o nothing
+MIN_SECTION_TOKENS = 8
+
+try:
+    import tiktoken
+
+    # GPT-4o's tokenizer; the Docker image downloads its vocabulary at build time
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:
+    # tiktoken missing or its vocabulary can't be fetched: fall back to an approximation
+    _encoding = None
+
+# Approximates BPE tokens: words split into pieces of up to 4 characters, and each punctuation mark
+_APPROX_TOKEN = re.compile(r"\w{1,4}|[^\w\s]")
+
+# Row fields in the order they are added, with the most tokens each may take (None for no limit).
+# Short fields of every row are added before the long ones so each retrieved game is represented.
+ROW_FIELDS = [
+    ("name", "Game", None),
+    ("short_description", "Short Description", 120),
+    ("genres", "Genres", 80),
+    ("release_date", "Release Date", None),
+    ("developer", "Developer", 40),
+    ("publisher", "Publisher", 40),
+    ("overall_player_rating", "Overall Player Rating", None),
+    ("number_of_reviews_from_purchased_people", "Number of Reviews from Purchased People", None),
+    ("number_of_english_reviews", "Number of English Reviews", None),
+    ("link", "Link", None),
+]
+LONG_ROW_FIELDS = [
+    ("long_description", "Long Description", 350),
+    ("minimum_system_requirement", "Minimum System Requirement", 150),
+    ("recommend_system_requirement", "Recommended System Requirement", 150),
+]
+
+# Order of the fields within a row's block, as in the dataset
+FIELD_ORDER = [
+    "name", "short_description", "long_description", "genres", "minimum_system_requirement",
+    "recommend_system_requirement", "release_date", "developer", "publisher", "overall_player_rating",
+    "number_of_reviews_from_purchased_people", "number_of_english_reviews", "link",
+]
+
+# Fields in each level of a row's context block, every level adding to the previous one
+CONTEXT_LEVELS = {
+    "compact": ["name", "short_description", "genres", "release_date", "overall_player_rating"],
+    "standard": [column for column, _, _ in ROW_FIELDS],
+    "full": [column for column, _, _ in ROW_FIELDS + LONG_ROW_FIELDS],
+}
+
+# Between the blocks of two rows in a prompt
+BLOCK_SEPARATOR = "\n\n"
+
+# List-like columns and how their values are joined in the prompt
+LIST_FIELD_SEPARATORS = {
+    "genres": ", ",
+    "developer": ", ",
+    "publisher": ", ",
+    "minimum_system_requirement": "; ",
+    "recommend_system_requirement": "; ",
+}
+
+# Text the Steam store page puts in front of or inside fields that tells GPT-4o nothing
+BOILERPLATE = re.compile(r"^About This (?:Game|Content|Software)\b\s*", re.IGNORECASE)
+BOILERPLATE_ITEMS = {"requires a 64-bit processor and operating system"}
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(_APPROX_TOKEN.findall(text))
+
+
+def truncate_tokens(text, max_tokens):
+    """Cut text to at most max_tokens tokens, marking the cut with an ellipsis."""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _encoding is not None:
+        tokens = _encoding.encode(text, disallowed_special=())
+        return _encoding.decode(tokens[:max(max_tokens - 1, 0)]) + "…"
+    matches = list(_APPROX_TOKEN.finditer(text))
+    return text[:matches[max(max_tokens - 1, 0)].start()].rstrip() + "…"
+
+
+def excerpt(text, max_tokens, query=""):
+    """
+    Shorten a long field to max_tokens, preferring sentences that mention the query's terms.
+    Whitespace is collapsed first; the selected sentences keep their original order.
+    """
+    text = " ".join(str(text).split())
+    if count_tokens(text) <= max_tokens:
+        return text
+    terms = {term for term in tokenize(query) if term not in STOPWORDS}
+    sentences = re.split(r"(?<=[.!?•])\s+", text)
+    ranked = sorted(
+        range(len(sentences)),
+        key=lambda i: (-len(terms.intersection(tokenize(sentences[i]))), i),
+    )
+    chosen, used = [], 0
+    for i in ranked:
+        tokens = count_tokens(sentences[i])
+        if used + tokens > max_tokens:
+            continue
+        chosen.append(i)
+        used += tokens
+    if not chosen:
+        return truncate_tokens(text, max_tokens)
+    return " ".join(sentences[i] for i in sorted(chosen))
+
+
+def clean_field(column, value):
+    """
+    A field's value as it goes into the prompt: whitespace collapsed, the store page's
+    boilerplate removed, list-like cells joined and tracking parameters cut from links.
+    Empty for missing values.
+    """
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    text = " ".join(str(value).split())
+    if column in LIST_FIELD_SEPARATORS:
+        items = [(a or b).strip() for a, b in re.findall(LIST_ITEM_PATTERN, text)]
+        if items:
+            text = LIST_FIELD_SEPARATORS[column].join(
+                item for item in items if item and item.lower() not in BOILERPLATE_ITEMS
+            )
+    elif column == "long_description":
+        text = BOILERPLATE.sub("", text)
+    elif column == "link":
+        text = text.split("?", 1)[0]
+    return text
+
+
+def _field_line(column, value, label, cap, long, query=""):
+    value = clean_field(column, value)
+    if not value:
+        return None
+    if long:
+        return f"{label}: {excerpt(value, cap, query)}"
+    line = f"{label}: {value}"
+    return truncate_tokens(line, cap) if cap is not None else line
+
+
+def render_context(row):
+    """
+    Render a row's context blocks once, for every level of CONTEXT_LEVELS: {level: (text, tokens)}.
+    Long fields are excerpted from their start, as there is no query to pick sentences for.
+    """
+    lines = {}
+    for fields, long in ((ROW_FIELDS, False), (LONG_ROW_FIELDS, True)):
+        for column, label, cap in fields:
+            line = _field_line(column, row.get(column), label, cap, long)
+            if line is not None:
+                lines[column] = (line, count_tokens(line) + 1)
+    blocks = {}
+    for level, columns in CONTEXT_LEVELS.items():
+        kept = [column for column in FIELD_ORDER if column in columns and column in lines]
+        blocks[level] = ("\n".join(lines[column][0] for column in kept), sum(lines[column][1] for column in kept))
+    return blocks
+
+
+class RowContext(dict):
+    """
+    A retrieved row: its record, plus the context blocks rendered for it when the dataset
+    snapshot was built ({level: (text, tokens)}), so prompts don't format it again.
+    """
+
+    def __init__(self, record, blocks):
+        super().__init__(record)
+        self.blocks = blocks
+
+
+class PromptBuilder:
+    """
+    Tracks a prompt's token budget while its sections are filled in priority order,
+    and records how many tokens each section took.
+    """
+
+    def __init__(self, budget=PROMPT_TOKEN_BUDGET):
+        self.budget = budget
+        self.used = 0
+        self.sections = {}
+
+    @property
+    def remaining(self):
+        return max(self.budget - self.used, 0)
+
+    def _take(self, name, tokens):
+        self.used += tokens
+        self.sections[name] = self.sections.get(name, 0) + tokens
+
+    def require(self, name, text):
+        """Add text that must be in the prompt whatever the budget, truncated to the budget at most."""
+        text = truncate_tokens(text, self.budget)
+        self._take(name, count_tokens(text))
+        return text
+
+    def fit(self, name, text, max_tokens=None):
+        """Add as much of text as the remaining budget (and max_tokens) allows, returns what was kept."""
+        limit = self.remaining if max_tokens is None else min(self.remaining, max_tokens)
+        text = truncate_tokens(text, limit)
+        self._take(name, count_tokens(text))
+        return text
+
+    def fit_section(self, name, label, text, end="\n\n"):
+        """
+        Add label + text + end, with text cut to the remaining budget, if at least MIN_SECTION_TOKENS
+        of text fit after the label and end. Returns the section, or "" if there is no text or no room.
+        """
+        if not text:
+            return ""
+        overhead = count_tokens(label) + count_tokens(end)
+        if self.remaining < overhead + MIN_SECTION_TOKENS:
+            return ""
+        self._take(name, overhead)
+        return f"{label}{self.fit(name, text)}{end}"
+
+    def add_turns(self, name, exchanges):
+        """Add exchanges newest first while they fit, returns them formatted in chronological order."""
+        kept = []
+        for exchange in reversed(exchanges):
+            assistant = truncate_tokens(str(exchange['assistant']), TURN_TOKEN_CAP)
+            text = f"User: {exchange['user']}\nAssistant: {assistant}\n"
+            tokens = count_tokens(text)
+            if tokens > self.remaining:
+                break
+            self._take(name, tokens)
+            kept.append(text)
+        return "".join(reversed(kept))
+
+    def add_rows(self, name, rows, query=""):
+        """
+        Add retrieved rows (most relevant first) as text blocks. Short fields of all rows
+        are added first, then excerpts of the long fields, while the budget lasts.
+
+        Rows with pre-rendered context blocks (RowContext) are added a level at a time
+        instead: every row's compact block, then its standard one, then its full one.
+        """
+        if rows and all(isinstance(row, RowContext) for row in rows):
+            return self._add_blocks(name, rows)
+        separator = count_tokens(BLOCK_SEPARATOR)
+        blocks = [{} for _ in rows]
+        for fields, long in ((ROW_FIELDS, False), (LONG_ROW_FIELDS, True)):
+            for row, block in zip(rows, blocks):
+                for column, label, cap in fields:
+                    line = _field_line(column, row.get(column), label, cap, long, query)
+                    if line is None:
+                        continue
+                    tokens = count_tokens(line) + 1
+                    # The first line of a row's block also takes the separator from the blocks before it
+                    if not block and any(blocks):
+                        tokens += separator
+                    if tokens > self.remaining:
+                        continue
+                    self._take(name, tokens)
+                    block[column] = line
+        # Lay each block out in the dataset's column order
+        return BLOCK_SEPARATOR.join(
+            "\n".join(block[column] for column in FIELD_ORDER if column in block) for block in blocks if block
+        )
+
+    def _add_blocks(self, name, rows):
+        separator = count_tokens(BLOCK_SEPARATOR)
+        chosen = [None] * len(rows)
+        for level in CONTEXT_LEVELS:
+            for i, row in enumerate(rows):
+                text, tokens = row.blocks[level]
+                if not text:
+                    continue
+                # A row's larger block replaces its smaller one, its first one also takes the separator
+                if chosen[i]:
+                    extra = tokens - chosen[i][1]
+                else:
+                    extra = tokens + (separator if any(chosen) else 0)
+                if extra <= self.remaining:
+                    self._take(name, extra)
+                    chosen[i] = (text, tokens)
+        return BLOCK_SEPARATOR.join(text for text, _ in filter(None, chosen))
+
+    def report(self):
+        return {"budget": self.budget, "total": self.used, "sections": dict(self.sections)}
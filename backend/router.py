@@ -0,0 +1,368 @@
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from keyword_index import tokenize
+from metrics import ROUTER_AGREEMENT, ROUTER_DECISIONS
+from planner import plan_query_text
+from stats import FOLLOW_UP_WORDS
+
+logger = logging.getLogger(__name__)
+
+# Serialized classifier shipped with the app, trained with `python router.py train`
+ROUTER_MODEL = os.environ.get("ROUTER_MODEL", os.path.join(os.path.dirname(os.path.abspath(__file__)), "router_model.npz"))
+
+# Labeled example queries the classifier is trained on
+ROUTER_EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "router_examples.jsonl")
+
+# Probability of the more likely label above which the local decision is used instead of asking GPT-4o
+ROUTER_CONFIDENCE = float(os.environ.get("ROUTER_CONFIDENCE", 0.9))
+
+# Set to 0 to classify every query with GPT-4o, as before the router
+ROUTER_ENABLED = os.environ.get("ROUTER_ENABLED", "1") == "1"
+
+# Fraction of confident local decisions also classified by GPT-4o in the background, to measure agreement
+ROUTER_SHADOW_RATE = float(os.environ.get("ROUTER_SHADOW_RATE", 0.05))
+
+# JSON lines file every decision is appended to (with GPT-4o's label when there is one). Empty to not keep them.
+ROUTER_LOG = os.environ.get("ROUTER_LOG", "")
+
+# Size of the hashed feature space of the classifier
+FEATURE_DIM = 2**12
+
+# Longest game title (in words) looked for in a query
+MAX_TITLE_WORDS = 8
+
+METADATA = "Metadata"
+ROW_SPECIFIC = "Row-specific"
+
+# Phrasings that only make sense about the dataset's structure and size, or only about particular games
+DATASET_NAMES = r"(the|your|this) (dataset|data set|data|knowledge base|database)"
+METADATA_RULES = re.compile(
+    r"\b(columns?|fields?|schema|data ?types?)\b"
+    r"|\b(types?|kinds?|sorts?) of (data|information)\b"
+    r"|\bwhat (data|information) (do|does|can|is)\b"
+    r"|\b(does|do) " + DATASET_NAMES + r" (have|contain|include|cover|hold|store)\b"
+    r"|\bwhat('s| is) in " + DATASET_NAMES + r"\b"
+    r"|\b(about|describe|summari[sz]e|structure of|size of|how big is) " + DATASET_NAMES + r"\b"
+    r"|\bhow many (games|titles|developers|publishers|genres) (are there|are in|are listed|do you|does|is there)\b"
+    r"|\bhow many (rows|records|entries)\b"
+)
+ROW_RULES = re.compile(
+    r"\b(tell me about|recommend|suggest|similar to|games? like|system requirements?|requirements for|specs for"
+    r"|who (developed|published|made)|what is .+ about|find me|show me)\b"
+)
+
+# Superlatives ranking games ("the best rated game", "the most reviews") ask for rows even about the whole dataset
+SUPERLATIVE_RULES = re.compile(
+    r"\b(best|worst|greatest)\b|\bmost (reviewed|reviews|popular|played|liked)\b"
+    r"|\b(highest|lowest|top)[\s-](rated|reviewed|selling)\b"
+)
+
+# Counts and statistics are about the dataset as a whole even when they filter or sort ("how many games released in 2020")
+AGGREGATE_RULES = re.compile(
+    r"\bhow many\b|\bwhat (percentage|proportion|fraction|share)\b|\bnumber of\b"
+    r"|\b(average|median|distribution)\b|\bmost common\b|\b(oldest|newest|earliest|latest) (release )?dates?\b"
+)
+
+# Words ending company names that queries leave out ("FromSoftware, Inc." is asked about as "FromSoftware")
+COMPANY_SUFFIXES = frozenset("inc ltd llc co corp corporation limited gmbh ag sa srl ab oy".split())
+
+# Words right before a developer or publisher name in questions about its games ("games by Valve", "did FromSoftware make")
+STUDIO_CUES = frozenset("by from did does has have".split())
+
+# Rules are trusted this much; a follow-up inherits the previous query's confidence scaled by this
+RULE_PROBABILITY = 0.99
+FOLLOW_UP_DISCOUNT = 0.95
+
+_shadow_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="router-shadow")
+_log_lock = threading.Lock()
+
+
+class RouteDecision:
+    """
+    Local classification of a query: the probability that it is about Metadata, where
+    that came from ("rule", "follow_up", "model" or "none") and the label, which is
+    None when the router isn't confident enough and GPT-4o has to decide.
+    """
+
+    def __init__(self, query, previous, probability, source, confidence=ROUTER_CONFIDENCE):
+        self.query = query
+        self.previous = previous
+        self.probability = float(probability)
+        self.source = source
+        if self.probability >= confidence:
+            self.label = METADATA
+        elif self.probability <= 1 - confidence:
+            self.label = ROW_SPECIFIC
+        else:
+            self.label = None
+
+    @property
+    def guess(self):
+        """The more likely label, even when it isn't confident."""
+        return METADATA if self.probability >= 0.5 else ROW_SPECIFIC
+
+    def __repr__(self):
+        return f"RouteDecision(label={self.label}, probability={self.probability:.3f}, source={self.source})"
+
+
+def features(query, previous=""):
+    """Hashed unigrams and bigrams of the query, and unigrams of the previous turn, as (ids, values)."""
+    tokens = tokenize(query)
+    terms = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    terms += [f"previous:{token}" for token in tokenize(previous)]
+    if not terms:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    ids = np.array([zlib.crc32(term.encode()) % FEATURE_DIM for term in terms], dtype=np.int64)
+    ids, counts = np.unique(ids, return_counts=True)
+    return ids, np.ones(len(ids), dtype=np.float32) / np.sqrt(len(terms)) * np.minimum(counts, 2)
+
+
+class RouterModel:
+    """Logistic regression over hashed query features, P(Metadata) = sigmoid(w . x + b)."""
+
+    def __init__(self, weights=None, bias=0.0):
+        self.weights = np.zeros(FEATURE_DIM, dtype=np.float32) if weights is None else weights
+        self.bias = float(bias)
+
+    def probability(self, query, previous=""):
+        ids, values = features(query, previous)
+        return float(1 / (1 + np.exp(-(self.weights[ids] @ values + self.bias))))
+
+    def fit(self, examples, iterations=2000, learning_rate=1.0, l2=1e-4):
+        """Train on (query, previous, label) examples with full-batch gradient descent."""
+        matrix = np.zeros((len(examples), FEATURE_DIM), dtype=np.float32)
+        for row, (query, previous, _) in enumerate(examples):
+            ids, values = features(query, previous)
+            matrix[row, ids] = values
+        targets = np.array([label == METADATA for _, _, label in examples], dtype=np.float32)
+        weights = np.zeros(FEATURE_DIM, dtype=np.float32)
+        bias = 0.0
+        for _ in range(iterations):
+            predictions = 1 / (1 + np.exp(-(matrix @ weights + bias)))
+            error = predictions - targets
+            weights -= learning_rate * (matrix.T @ error / len(examples) + l2 * weights)
+            bias -= learning_rate * float(error.mean())
+        self.weights, self.bias = weights.astype(np.float32), bias
+        return self
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, weights=self.weights, bias=np.array(self.bias), dim=np.array(FEATURE_DIM))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=ROUTER_MODEL):
+        """The serialized model, or None if it is missing or was trained for another feature size."""
+        try:
+            with np.load(path) as state:
+                if int(state["dim"]) != FEATURE_DIM:
+                    logger.warning(f"Router model {path} has another feature size, ignoring it")
+                    return None
+                return cls(state["weights"].astype(np.float32), float(state["bias"]))
+        except (OSError, KeyError, ValueError):
+            logger.warning(f"No router model at {path}, routing with rules only")
+            return None
+
+
+_model = RouterModel.load() if ROUTER_ENABLED else None
+
+def game_titles(names):
+    """Tokenized game names ("Baldur's Gate 3" -> "baldur s gate 3") to spot titles in queries."""
+    return frozenset(
+        title for title in (" ".join(tokenize(name)) for name in names)
+        if len(title) > 3 and len(title.split()) <= MAX_TITLE_WORDS
+    )
+
+
+def mentions_title(query, titles):
+    """Whether any run of words in the query is the name of a game in the dataset."""
+    tokens = tokenize(query)
+    return any(
+        " ".join(tokens[start:start + length]) in titles
+        for start in range(len(tokens))
+        for length in range(1, min(MAX_TITLE_WORDS, len(tokens) - start) + 1)
+    )
+
+
+def studio_names(names):
+    """Tokenized developer and publisher names without their company suffix ("FromSoftware, Inc." -> "fromsoftware")."""
+    studios = []
+    for name in names:
+        tokens = tokenize(name)
+        while tokens and tokens[-1] in COMPANY_SUFFIXES:
+            tokens.pop()
+        studios.append(" ".join(tokens))
+    return game_titles(studios)
+
+
+def mentions_studio(query, studios):
+    """Whether the query names a developer or publisher of the dataset after one of the STUDIO_CUES or as "<studio>'s"."""
+    tokens = tokenize(query)
+    for start in range(len(tokens)):
+        for length in range(1, min(MAX_TITLE_WORDS, len(tokens) - start) + 1):
+            end = start + length
+            if " ".join(tokens[start:end]) in studios and (
+                (start > 0 and tokens[start - 1] in STUDIO_CUES) or (end < len(tokens) and tokens[end] == "s")
+            ):
+                return True
+    return False
+
+
+def _rule_probability(text, titles, studios=frozenset(), typed=None):
+    """
+    P(Metadata) from the rules, or None when they don't fire or contradict each other.
+    Asking for particular games by name, studio, superlative or a filter the planner reads
+    from the query overrides the dataset structure rules.
+    """
+    metadata = METADATA_RULES.search(text) is not None
+    row = ROW_RULES.search(text) is not None
+    specific = (
+        SUPERLATIVE_RULES.search(text) is not None
+        or mentions_title(text, titles)
+        or mentions_studio(text, studios)
+    )
+    if not specific and typed is not None and AGGREGATE_RULES.search(text) is None:
+        plan = plan_query_text(text, typed)
+        specific = bool(plan.filters or plan.sort)
+    if specific or (row and not metadata):
+        return 1 - RULE_PROBABILITY, "rule"
+    if metadata and not row:
+        return RULE_PROBABILITY, "rule"
+    return None, None
+
+
+#classify a query as Metadata or Row-specific locally, from rules, the previous turn and the trained model
+def route_query(query, conversation, titles=frozenset(), model=None, confidence=ROUTER_CONFIDENCE, studios=frozenset(), typed=None):
+    """
+    Scores the query (and the previous user turn, like query_type does) without calling GPT-4o.
+
+    Rules decide first: questions about the dataset's structure ("what columns", "how many games
+    are there") mean Metadata, asking for particular games ("tell me about", a title from the
+    dataset) means Row-specific. Naming a game or studio, a superlative ("the best rated") or a
+    filter ("released after 2020") means Row-specific even about the whole dataset. A follow-up
+    ("tell me more about it") takes the label of the previous query. Anything else is scored by
+    the trained model. The decision's label is None when none of them is confident enough.
+    `titles` are the game_titles of the dataset, `studios` its studio_names and `typed` its
+    TypedColumns, for reading filters from the query.
+    """
+    previous = conversation[-1]['user'] if conversation else ""
+    model = _model if model is None else model
+    text = " ".join(str(query).lower().split())
+
+    probability, source = _rule_probability(text, titles, studios, typed)
+    if probability is None and previous and FOLLOW_UP_WORDS.intersection(tokenize(text)):
+        previous_probability, _ = _rule_probability(" ".join(previous.lower().split()), titles, studios, typed)
+        if previous_probability is None and model is not None:
+            previous_probability = model.probability(previous)
+        if previous_probability is not None:
+            probability = 0.5 + (previous_probability - 0.5) * FOLLOW_UP_DISCOUNT
+            source = "follow_up"
+    if probability is None and model is not None:
+        probability, source = model.probability(query, previous), "model"
+    if probability is None:
+        probability, source = 0.5, "none"
+    return RouteDecision(query, previous, probability, source, confidence)
+
+
+#keep a decision for measuring the router against gpt 4o: metrics, the decisions log and sometimes a shadow call
+def record_decision(decision, llm_label=None, classify=None):
+    """
+    Counts the decision, and its agreement with GPT-4o when GPT-4o classified the query too.
+    With probability ROUTER_SHADOW_RATE a confident decision is also classified in the
+    background by `classify()` (GPT-4o's label for the query), recorded the same way.
+    """
+    source = "llm" if decision.label is None else decision.source
+    ROUTER_DECISIONS.labels(source, llm_label or decision.label).inc()
+    if llm_label is not None:
+        ROUTER_AGREEMENT.labels(decision.source, "agree" if decision.guess == llm_label else "disagree").inc()
+    _log_decision(decision, llm_label)
+
+    if llm_label is None and classify is not None and random.random() < ROUTER_SHADOW_RATE:
+        _shadow_executor.submit(_shadow, decision, classify)
+
+
+def _shadow(decision, classify):
+    try:
+        llm_label = classify()
+    except Exception as e:
+        logger.info(f"Shadow classification failed: {e}")
+        return
+    ROUTER_AGREEMENT.labels(decision.source, "agree" if decision.guess == llm_label else "disagree").inc()
+    _log_decision(decision, llm_label, shadow=True)
+
+
+def _log_decision(decision, llm_label=None, shadow=False):
+    logger.debug(f"{decision} for {decision.query!r}, GPT-4o: {llm_label}")
+    if not ROUTER_LOG:
+        return
+    record = {
+        "query": decision.query,
+        "previous": decision.previous,
+        "probability": round(decision.probability, 4),
+        "source": decision.source,
+        "label": decision.label,
+        "llm_label": llm_label,
+        "shadow": shadow,
+    }
+    with _log_lock, open(ROUTER_LOG, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def load_examples(path):
+    """(query, previous, label) from a JSON lines file of examples or logged decisions (which need llm_label)."""
+    examples = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            label = record["llm_label"] if "llm_label" in record else record.get("label")
+            if label in (METADATA, ROW_SPECIFIC):
+                examples.append((record["query"], record.get("previous", ""), label))
+    return examples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or evaluate the local query router.")
+    parser.add_argument("command", choices=["train", "evaluate"])
+    parser.add_argument("--examples", nargs="+", default=[ROUTER_EXAMPLES],
+                        help="example files; logged decisions train on GPT-4o's label")
+    parser.add_argument("--log", help="decisions log to evaluate (default ROUTER_LOG)")
+    parser.add_argument("--output", default=ROUTER_MODEL)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "train":
+        examples = [example for path in args.examples for example in load_examples(path)]
+        model = RouterModel().fit(examples)
+        correct = sum((model.probability(q, p) >= 0.5) == (label == METADATA) for q, p, label in examples)
+        model.save(args.output)
+        print(f"Trained on {len(examples)} examples ({correct / len(examples):.1%} correct), saved to {args.output}")
+    else:
+        path = args.log or ROUTER_LOG
+        if not path:
+            parser.error("Pass --log or set ROUTER_LOG")
+        totals = {}
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get("llm_label") is None:
+                    continue
+                guess = METADATA if record["probability"] >= 0.5 else ROW_SPECIFIC
+                confident = record["label"] is not None
+                total = totals.setdefault((record["source"], confident), [0, 0])
+                total[0] += guess == record["llm_label"]
+                total[1] += 1
+        for (source, confident), (agree, count) in sorted(totals.items()):
+            kind = "confident" if confident else "uncertain"
+            print(f"{source:<10} {kind:<10} {agree}/{count} agree with GPT-4o ({agree / count:.1%})")
@@ -0,0 +1,353 @@
+import argparse
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from keyword_index import KeywordIndex
+from planner import TypedColumns
+from prompt import CONTEXT_LEVELS, render_context
+from router import game_titles, studio_names
+from stats import build_profile, parse_list_column
+from vectors import VECTOR_EMBEDDER, VECTOR_SEARCH, build_vectors, content_version
+
+try:
+    import fcntl
+except ImportError:  # Windows, where workers aren't forked by gunicorn
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Directory holding the binary snapshots of the dataset csvs, one per csv version
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "dataset_snapshot")
+
+# Version of the snapshot file layout, snapshots written with another one are rebuilt
+SNAPSHOT_FORMAT = 5
+
+# Text columns with fewer distinct values than this fraction of rows are decoded as categoricals
+CATEGORY_RATIO = 0.5
+
+
+class StringColumn:
+    """
+    Strings packed into one UTF-8 heap: value i is heap[offsets[i]:offsets[i + 1]], or None
+    where missing[i] is set. Values are decoded one at a time when indexed, so a memory-mapped
+    column only reads the bytes of the values asked for. Sorted columns work with bisect.
+    """
+
+    def __init__(self, offsets, heap, missing=None):
+        self.offsets = offsets
+        self.heap = heap
+        self.missing = missing
+
+    @classmethod
+    def encode(cls, values):
+        values = pd.Series(list(values), dtype=object)
+        missing = values.isna().to_numpy()
+        encoded = [b"" if absent else str(value).encode("utf-8") for value, absent in zip(values, missing)]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        heap = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(offsets, heap, missing if missing.any() else None)
+
+    def arrays(self):
+        arrays = {"offsets": self.offsets, "heap": self.heap}
+        if self.missing is not None:
+            arrays["missing"] = self.missing
+        return arrays
+
+    @classmethod
+    def load(cls, base):
+        """Memory-map the column saved at base (base.offsets.npy, base.heap.npy and base.missing.npy if any)."""
+        missing = f"{base}.missing.npy"
+        return cls(
+            np.load(f"{base}.offsets.npy", mmap_mode="r"),
+            np.load(f"{base}.heap.npy", mmap_mode="r"),
+            np.load(missing, mmap_mode="r") if os.path.exists(missing) else None,
+        )
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.heap.nbytes + (self.missing.nbytes if self.missing is not None else 0)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if self.missing is not None and self.missing[i]:
+            return None
+        return bytes(self.heap[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def take(self, rows):
+        return [self[row] for row in rows]
+
+    def tolist(self):
+        """All values, decoded in one pass over the heap."""
+        raw = self.heap.tobytes()
+        offsets = self.offsets.tolist()
+        values = [raw[start:end].decode("utf-8") for start, end in zip(offsets, offsets[1:])]
+        if self.missing is not None:
+            for row in np.flatnonzero(self.missing):
+                values[row] = None
+        return values
+
+
+class SnapshotTable:
+    """
+    One version of a dataset csv opened from its snapshot directory: the csv's columns plus
+    the arrays derived from them (keyword index, typed columns, game titles and studios, prompt
+    context blocks, row vectors), all memory-mapped.
+
+    Opening reads only meta.json. A column is decoded on first use, and records() decodes
+    just the cells of the rows asked for, so answering a query touches the few pages holding
+    its rows and index terms. Columns can be read as table[name] like a DataFrame's.
+    """
+
+    def __init__(self, directory, meta, arrays):
+        self.directory = directory
+        self.meta = meta
+        self.columns = [column["name"] for column in meta["columns"]]
+        self.rows = meta["rows"]
+        self.nbytes = sum(int(values.nbytes) for values in arrays.values())
+        self._arrays = arrays
+        self._decoded = {}
+        self._frame = None
+
+    @classmethod
+    def load(cls, directory):
+        """Open a snapshot directory, or return None if it's missing, incomplete or of another format."""
+        try:
+            with open(os.path.join(directory, "meta.json")) as f:
+                meta = json.load(f)
+            if meta.get("format") != SNAPSHOT_FORMAT:
+                return None
+            # Every file is mapped up front, so the snapshot stays readable if a newer version replaces it
+            arrays = {
+                name: StringColumn.load(os.path.join(directory, name)) if kind == "strings"
+                else np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                for name, kind in meta["arrays"].items()
+            }
+        except (OSError, KeyError, ValueError):
+            return None
+        return cls(directory, meta, arrays)
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    def array(self, name):
+        return self._arrays[name]
+
+    def arrays(self, prefix):
+        """Saved state of one derived structure, e.g. arrays("index"), keyed without the prefix."""
+        prefix = f"{prefix}."
+        return {name[len(prefix):]: values for name, values in self._arrays.items() if name.startswith(prefix)}
+
+    def column(self, name):
+        """A column decoded as a Series, as pd.read_csv would have parsed it."""
+        series = self._decoded.get(name)
+        if series is None:
+            if name not in self.columns:
+                raise KeyError(name)
+            i = self.columns.index(name)
+            values = self._arrays[f"column{i}"]
+            if isinstance(values, StringColumn):
+                series = pd.Series(values.tolist(), name=name)
+            else:
+                series = pd.Series(np.array(values), name=name)
+            if self.meta["columns"][i]["category"]:
+                series = series.astype("category")
+            self._decoded[name] = series
+        return series
+
+    def frame(self):
+        """The whole dataset as a DataFrame, decoded on first use."""
+        if self._frame is None:
+            self._frame = pd.DataFrame({name: self.column(name) for name in self.columns})
+        return self._frame
+
+    def records(self, rows):
+        """Rows as dictionaries (like DataFrame.to_dict(orient="records")), decoding only their cells."""
+        columns = []
+        for i, name in enumerate(self.columns):
+            values = self._arrays[f"column{i}"]
+            if isinstance(values, StringColumn):
+                columns.append([np.nan if value is None else value for value in values.take(rows)])
+            else:
+                columns.append(np.asarray(values)[rows].tolist())
+        return [dict(zip(self.columns, cells)) for cells in zip(*columns)]
+
+
+def _is_category(series):
+    return series.nunique(dropna=True) < CATEGORY_RATIO * max(len(series), 1)
+
+
+def _snapshot_dir(path, version, directory):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(directory, f"{stem}-{version}")
+
+
+def _write(target, arrays, meta):
+    """Save arrays (lists of strings as StringColumns) and meta.json to target, via a temporary directory."""
+    tmp = f"{target}.tmp{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    kinds = {}
+    for name, values in arrays.items():
+        if isinstance(values, np.ndarray):
+            np.save(os.path.join(tmp, f"{name}.npy"), values)
+            kinds[name] = "array"
+        else:
+            for part, part_values in StringColumn.encode(values).arrays().items():
+                np.save(os.path.join(tmp, f"{name}.{part}.npy"), part_values)
+            kinds[name] = "strings"
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(dict(meta, arrays=kinds), f)
+    # A snapshot of an older format is replaced, readers never see a half-written directory
+    shutil.rmtree(target, ignore_errors=True)
+    try:
+        os.rename(tmp, target)
+    except OSError:
+        # Another process wrote the same version first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def build_snapshot(path, raw, version, directory=SNAPSHOT_DIR):
+    """
+    Parse the csv's content (raw bytes) and write its snapshot: every column (text as a
+    StringColumn, numbers as an array), the keyword index, typed columns, game titles and
+    studio names, the rows' prompt context blocks and vectors, and the dataset profile. Snapshots of the csv's
+    other versions are removed.
+    """
+    start = time.perf_counter()
+    df = pd.read_csv(io.BytesIO(raw))
+
+    arrays, columns = {}, []
+    for i, col in enumerate(df.columns):
+        series = df[col]
+        if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+            arrays[f"column{i}"] = series.to_numpy()
+            columns.append({"name": col, "category": False})
+        else:
+            arrays[f"column{i}"] = series.tolist()
+            columns.append({"name": col, "category": bool(_is_category(series))})
+            if columns[-1]["category"]:
+                df[col] = series.astype("category")
+
+    # Lowercased text of every column for the keyword index
+    search = {
+        col: df[col].astype(object).where(df[col].notna(), "").astype(str).str.lower()
+        for col in df.columns
+    }
+    for prefix, state in (("index", KeywordIndex(search).state()), ("typed", TypedColumns(df).state())):
+        arrays.update({f"{prefix}.{name}": values for name, values in state.items()})
+    arrays["titles"] = sorted(game_titles(df["name"].dropna().astype(str))) if "name" in df.columns else []
+    studios = [parse_list_column(df[col]).explode().dropna() for col in ("developer", "publisher") if col in df.columns]
+    arrays["studios"] = sorted(studio_names(pd.concat(studios).astype(str).unique())) if studios else []
+
+    # Every row's prompt context rendered once, at each level, with its token count
+    contexts = [render_context(row) for row in df.to_dict(orient="records")]
+    for level in CONTEXT_LEVELS:
+        arrays[f"context.{level}"] = [context[level][0] for context in contexts]
+    arrays["context.tokens"] = np.array(
+        [[context[level][1] for level in CONTEXT_LEVELS] for context in contexts], dtype=np.int32,
+    ).reshape(len(contexts), len(CONTEXT_LEVELS))
+
+    # Row embeddings and the fitted embedder for semantic retrieval, keyword retrieval only if they fail
+    vectors = None
+    if VECTOR_SEARCH:
+        try:
+            matrix, state, vectors = build_vectors(df)
+        except Exception:
+            logger.exception("Vector index not built, using keyword retrieval only")
+        else:
+            arrays["vectors"] = matrix
+            arrays.update({f"embedder.{name}": np.asarray(values) for name, values in state.items()})
+
+    meta = {
+        "format": SNAPSHOT_FORMAT,
+        "version": version,
+        "source": os.path.basename(path),
+        "rows": len(df),
+        "columns": columns,
+        "profile": build_profile(df),
+        "embedder": VECTOR_EMBEDDER if VECTOR_SEARCH else None,
+        "vectors": vectors,
+        "build_seconds": round(time.perf_counter() - start, 3),
+    }
+    os.makedirs(directory, exist_ok=True)
+    target = _snapshot_dir(path, version, directory)
+    _write(target, arrays, meta)
+
+    # Snapshots of older versions of this csv are never read again
+    stem = os.path.basename(target)[:-len(version) - 1]
+    for name in os.listdir(directory):
+        if name != os.path.basename(target) and re.fullmatch(re.escape(stem) + r"-[0-9a-f]{12}", name):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    logger.info(f"Built snapshot of {path} version {version}: {len(df)} rows in {meta['build_seconds']}s")
+    return SnapshotTable.load(target)
+
+
+def load_snapshot(path, version, directory=SNAPSHOT_DIR):
+    """The snapshot of a csv version, or None if it hasn't been built (or not with the configured embedder)."""
+    table = SnapshotTable.load(_snapshot_dir(path, version, directory))
+    if table is not None and VECTOR_SEARCH and table.meta.get("embedder") != VECTOR_EMBEDDER:
+        return None
+    return table
+
+
+@contextmanager
+def _build_lock(path, directory):
+    """Exclusive lock on building a csv's snapshots, held across every process using the directory."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    with open(os.path.join(directory, f".{stem}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def load_or_build_snapshot(path, raw, version, directory=SNAPSHOT_DIR):
+    """
+    The snapshot of a csv version, built from its content (raw bytes) if it doesn't exist yet.
+    When several workers see the same new version, one builds it and the others open its snapshot.
+    """
+    table = load_snapshot(path, version, directory)
+    if table is None:
+        with _build_lock(path, directory):
+            table = load_snapshot(path, version, directory) or build_snapshot(path, raw, version, directory)
+        if table is None:
+            raise OSError(f"Snapshot of {path} could not be written to {directory}")
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the binary snapshot of the games dataset offline.")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--csv", default="games_description.csv")
+    parser.add_argument("--directory", default=SNAPSHOT_DIR)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with open(args.csv, "rb") as f:
+        raw = f.read()
+    version = content_version(raw)
+    if load_snapshot(args.csv, version, args.directory) is None:
+        build_snapshot(args.csv, raw, version, args.directory)
+    else:
+        logger.info(f"Snapshot of version {version} is up to date")
@@ -0,0 +1,179 @@
+import re
+
+import pandas as pd
+
+# Values quoted inside list-like cells, e.g. "['Game Science', 'FromSoftware, Inc.']"
+LIST_ITEM_PATTERN = r"'((?:[^'\\]|\\.)*)'|\"((?:[^\"\\]|\\.)*)\""
+
+# Columns holding lists of values
+LIST_COLUMNS = ["genres", "developer", "publisher"]
+
+# Columns holding review counts, e.g. "(654,820)" or "(81% of 62,791) All Time"
+COUNT_COLUMNS = ["number_of_reviews_from_purchased_people", "number_of_english_reviews"]
+
+# Format of release_date, e.g. "19 Aug, 2024"
+RELEASE_DATE_FORMAT = "%d %b, %Y"
+
+# Number of most common values kept per column
+TOP_K = 10
+
+# Words that refer back to an earlier answer; such questions need the conversation and aren't answered locally
+FOLLOW_UP_WORDS = {"it", "its", "them", "they", "those", "these", "that", "this", "he", "she"}
+
+
+def parse_list_column(series):
+    """Parse list-like cells into Python lists of stripped strings (empty list for missing cells)."""
+    matches = series.astype(object).where(series.notna(), "").astype(str).str.findall(LIST_ITEM_PATTERN)
+    return matches.map(lambda items: [(a or b).strip() for a, b in items if (a or b).strip()])
+
+
+def parse_count_column(series):
+    """Parse the last number in each cell ("(81% of 62,791) All Time" -> 62791) as floats, NaN if absent."""
+    digits = series.astype(object).where(series.notna(), "").astype(str).str.extract(r"([\d,]+)\D*$")[0]
+    return pd.to_numeric(digits.str.replace(",", "", regex=False), errors="coerce")
+
+
+def parse_date_column(series):
+    return pd.to_datetime(series.astype(object), format=RELEASE_DATE_FORMAT, errors="coerce")
+
+
+def _top(counts, k=TOP_K):
+    return [(str(value), int(count)) for value, count in counts.head(k).items()]
+
+
+def build_profile(df):
+    """
+    Compute statistics of the games dataframe with vectorized pandas operations:
+    distinct counts, null rates and top values per column, the parsed values of
+    list-like columns, review count ranges and the release date range.
+    """
+    rows = len(df)
+    columns = {}
+    for col in df.columns:
+        series = df[col]
+        columns[col] = {
+            "distinct": int(series.nunique(dropna=True)),
+            "null_rate": round(float(series.isna().mean()), 4) if rows else 0.0,
+        }
+
+    lists = {}
+    for col in LIST_COLUMNS:
+        if col not in df.columns:
+            continue
+        values = parse_list_column(df[col]).explode().dropna()
+        counts = values.value_counts()
+        lists[col] = {
+            "distinct": int(len(counts)),
+            "top": _top(counts),
+            # Lowercased value -> (value, number of games), for answering "how many <genre> games"
+            "counts": {str(value).lower(): (str(value), int(count)) for value, count in counts.items()},
+        }
+        columns[col]["top"] = lists[col]["top"]
+
+    if "overall_player_rating" in df.columns:
+        columns["overall_player_rating"]["top"] = _top(df["overall_player_rating"].value_counts())
+
+    numbers = {}
+    for col in COUNT_COLUMNS:
+        if col not in df.columns:
+            continue
+        values = parse_count_column(df[col]).dropna()
+        if len(values):
+            numbers[col] = {
+                "min": int(values.min()),
+                "max": int(values.max()),
+                "median": float(values.median()),
+                "sum": int(values.sum()),
+            }
+
+    dates = {}
+    if "release_date" in df.columns:
+        released = parse_date_column(df["release_date"])
+        valid = released.dropna()
+        if len(valid):
+            names = df["name"] if "name" in df.columns else pd.Series(range(rows))
+            dates = {
+                "min": valid.min().strftime("%Y-%m-%d"),
+                "max": valid.max().strftime("%Y-%m-%d"),
+                "oldest": str(names[valid.idxmin()]),
+                "newest": str(names[valid.idxmax()]),
+                "by_year": {int(year): int(count) for year, count in valid.dt.year.value_counts().sort_index().items()},
+            }
+
+    return {
+        "rows": rows,
+        "column_names": df.columns.tolist(),
+        "columns": columns,
+        "lists": lists,
+        "numbers": numbers,
+        "dates": dates,
+    }
+
+
+def load_profile(profile):
+    """A profile read back from JSON (see snapshot.py), with the years it counts games by as ints again."""
+    if profile.get("dates"):
+        profile["dates"]["by_year"] = {int(year): count for year, count in profile["dates"]["by_year"].items()}
+    return profile
+
+
+def profile_facts(profile):
+    """Compact, exact facts about the dataset for the metadata prompt."""
+    facts = [f"Total games: {profile['rows']}"]
+    for col, info in profile["lists"].items():
+        top = ", ".join(f"{value} ({count})" for value, count in info["top"][:5])
+        facts.append(f"Distinct {col}: {info['distinct']}; most common: {top}")
+    for col, info in profile["columns"].items():
+        if col not in profile["lists"] and info["null_rate"] > 0:
+            facts.append(f"Missing {col}: {info['null_rate']:.1%}")
+    if profile["dates"]:
+        dates = profile["dates"]
+        facts.append(f"Release dates: {dates['min']} ({dates['oldest']}) to {dates['max']} ({dates['newest']})")
+    for col, info in profile["numbers"].items():
+        facts.append(f"{col}: min {info['min']:,}, median {info['median']:,.0f}, max {info['max']:,}")
+    return "\n".join(facts)
+
+
+def _plural(count, word):
+    return f"{count:,} {word}" if count == 1 else f"{count:,} {word}s"
+
+
+def answer_from_profile(query, profile):
+    """
+    Answer common aggregate questions ("How many games are in the dataset?",
+    "How many developers...", "How many RPG games...", "What columns...") from
+    the profile. Returns None when the question isn't one of those, so it goes to GPT-4o.
+    """
+    text = " ".join(re.findall(r"[a-z0-9+'-]+", query.lower()))
+    if not text or FOLLOW_UP_WORDS.intersection(text.split()):
+        return None
+
+    if re.fullmatch(r"(what|which) (columns|fields) (are|do you have|does the dataset have)( in (the|your) (dataset|data|knowledge base))?", text):
+        return "The dataset has these columns: " + ", ".join(profile["column_names"]) + "."
+
+    match = re.fullmatch(r"how many (games|titles) (were|was|got|have been) released (in|during) (\d{4})( in (the|your) (dataset|data|knowledge base|database))?", text)
+    if match and profile["dates"]:
+        year = int(match.group(4))
+        count = profile["dates"]["by_year"].get(year, 0)
+        return f"{_plural(count, 'game')} in the dataset {'was' if count == 1 else 'were'} released in {year}."
+
+    match = re.fullmatch(r"how many (?:(.+?) )?(games|titles|developers|publishers|genres)( are| do you| does the dataset| is)?( there| know about| have| know| contain| listed)?( in (the|your) (dataset|data|knowledge base|database))?", text)
+    if not match:
+        return None
+    qualifier, noun = match.group(1), match.group(2)
+
+    generic = (None, "different", "unique", "distinct", "total")
+    if noun in ("developers", "publishers", "genres") and qualifier in generic + ("game",):
+        column = {"developers": "developer", "publishers": "publisher", "genres": "genres"}[noun]
+        if column in profile["lists"]:
+            return f"There are {_plural(profile['lists'][column]['distinct'], noun[:-1])} in the dataset."
+        return None
+
+    if noun in ("games", "titles"):
+        if qualifier in generic:
+            return f"There are {_plural(profile['rows'], 'game')} in the dataset."
+        genre_counts = profile["lists"].get("genres", {}).get("counts", {})
+        if qualifier in genre_counts:
+            genre, count = genre_counts[qualifier]
+            return f"There are {_plural(count, 'game')} tagged {genre} in the dataset."
+    return None
@@ -0,0 +1,270 @@
+import hashlib
+import logging
+import os
+import time
+import zlib
+from collections import Counter
+
+import numpy as np
+
+from keyword_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+# Embedder used for rows and queries: "lsa" (TF-IDF + truncated SVD) or "hashing"
+VECTOR_EMBEDDER = os.environ.get("VECTOR_EMBEDDER", "lsa")
+
+# Set to 0 to disable semantic retrieval
+VECTOR_SEARCH = os.environ.get("VECTOR_SEARCH", "1") == "1"
+
+# Weight of the normalized BM25 score when combined with cosine similarity (1 = lexical only)
+HYBRID_ALPHA = float(os.environ.get("HYBRID_ALPHA", 0.6))
+
+# Cosine similarity a row needs to count as similar to a query, and to be retrieved without any keyword hit
+MIN_SIMILARITY = float(os.environ.get("VECTOR_MIN_SIMILARITY", 0.2))
+
+# Columns embedded for each row, with how many times each is repeated to weight it
+EMBED_COLUMNS = [("name", 2), ("short_description", 1), ("genres", 1), ("long_description", 1)]
+
+# Rows embedded per dense block while building, bounds memory to BLOCK_ROWS x hash dimensions
+BLOCK_ROWS = 512
+
+
+def content_version(raw):
+    """Version of a csv's content, computed the same way as data.DatasetStore's snapshot versions."""
+    return hashlib.sha1(raw).hexdigest()[:12]
+
+
+def row_texts(df):
+    """Text embedded for each row."""
+    parts = []
+    for col, repeat in EMBED_COLUMNS:
+        if col in df.columns:
+            text = df[col].astype(object).where(df[col].notna(), "").astype(str)
+            parts.extend([text] * repeat)
+    if not parts:
+        return [""] * len(df)
+    joined = parts[0]
+    for part in parts[1:]:
+        joined = joined + " " + part
+    return joined.tolist()
+
+
+def hashed_features(text, dim):
+    """
+    Signed feature hashing of a text's unigrams and bigrams with sublinear term frequency.
+    Returns (feature ids, values); ids may repeat when features collide.
+    """
+    tokens = tokenize(text)
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    counts = Counter(zlib.crc32(gram.encode("utf-8")) for gram in grams)
+    if not counts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    hashes = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    tf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+    signs = np.where(hashes & (1 << 31), -1.0, 1.0).astype(np.float32)
+    return hashes % dim, signs * (1 + np.log(tf))
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+class HashingEmbedder:
+    """Embeds text as an L2-normalized hashed bag of unigrams and bigrams. Needs no fitting."""
+
+    name = "hashing"
+
+    def __init__(self, dim=1024):
+        self.dim = dim
+
+    def fit(self, texts):
+        return self
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            ids, values = hashed_features(text, self.dim)
+            np.add.at(vectors[i], ids, values)
+        return _normalize(vectors)
+
+    def state(self):
+        return {"dim": np.array(self.dim)}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(dim=int(state["dim"]))
+
+
+class LsaEmbedder:
+    """
+    Latent semantic analysis: hashed TF-IDF vectors projected onto their top singular
+    directions, so words that occur in the same games ("monkey", "wukong") end up close.
+    The SVD is a randomized one over dense blocks of rows, so memory stays bounded.
+    """
+
+    name = "lsa"
+
+    def __init__(self, dim=128, hash_dim=2**14, oversample=16, power_iterations=2, seed=0):
+        self.dim = dim
+        self.hash_dim = hash_dim
+        self.oversample = oversample
+        self.power_iterations = power_iterations
+        self.seed = seed
+        self.idf = None
+        self.components = None
+
+    def _blocks(self, features):
+        """Yield (start, dense normalized TF-IDF block) over the rows' features."""
+        for start in range(0, len(features), BLOCK_ROWS):
+            chunk = features[start:start + BLOCK_ROWS]
+            block = np.zeros((len(chunk), self.hash_dim), dtype=np.float32)
+            for i, (ids, values) in enumerate(chunk):
+                np.add.at(block[i], ids, values * self.idf[ids])
+            yield start, _normalize(block)
+
+    def fit(self, texts):
+        features = [hashed_features(text, self.hash_dim) for text in texts]
+        rows = len(features)
+        document_frequency = np.zeros(self.hash_dim, dtype=np.float64)
+        for ids, _ in features:
+            document_frequency[np.unique(ids)] += 1
+        self.idf = (np.log((1 + rows) / (1 + document_frequency)) + 1).astype(np.float32)
+
+        rank = max(min(self.dim + self.oversample, rows, self.hash_dim), 1)
+        rng = np.random.default_rng(self.seed)
+
+        def multiply(right):
+            # X @ right, X being the (rows x hash_dim) TF-IDF matrix
+            out = np.zeros((rows, right.shape[1]), dtype=np.float32)
+            for start, block in self._blocks(features):
+                out[start:start + len(block)] = block @ right
+            return out
+
+        def multiply_transposed(left):
+            # X.T @ left
+            out = np.zeros((self.hash_dim, left.shape[1]), dtype=np.float32)
+            for start, block in self._blocks(features):
+                out += block.T @ left[start:start + len(block)]
+            return out
+
+        q, _ = np.linalg.qr(multiply(rng.standard_normal((self.hash_dim, rank)).astype(np.float32)))
+        for _ in range(self.power_iterations):
+            z, _ = np.linalg.qr(multiply_transposed(q))
+            q, _ = np.linalg.qr(multiply(z))
+        # B = Q.T @ X is small (rank x hash_dim), its right singular vectors span X's top directions
+        _, _, vt = np.linalg.svd(multiply_transposed(q).T, full_matrices=False)
+        self.components = np.ascontiguousarray(vt[:min(self.dim, len(vt))], dtype=np.float32)
+        return self
+
+    def embed(self, texts):
+        features = [hashed_features(text, self.hash_dim) for text in texts]
+        vectors = np.zeros((len(features), len(self.components)), dtype=np.float32)
+        for start, block in self._blocks(features):
+            vectors[start:start + len(block)] = block @ self.components.T
+        return _normalize(vectors)
+
+    def embed_query(self, text):
+        # Only the query's few features are touched, the result is normalized so TF-IDF scaling doesn't matter
+        ids, values = hashed_features(text, self.hash_dim)
+        vector = self.components[:, ids] @ (values * self.idf[ids])
+        length = np.linalg.norm(vector)
+        return vector / length if length else vector
+
+    def state(self):
+        return {
+            "dim": np.array(self.dim),
+            "hash_dim": np.array(self.hash_dim),
+            "idf": self.idf,
+            "components": self.components,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        embedder = cls(dim=int(state["dim"]), hash_dim=int(state["hash_dim"]))
+        embedder.idf = state["idf"]
+        embedder.components = state["components"]
+        return embedder
+
+
+EMBEDDERS = {
+    HashingEmbedder.name: HashingEmbedder,
+    LsaEmbedder.name: LsaEmbedder,
+}
+
+
+def _embed_query(embedder, text):
+    if hasattr(embedder, "embed_query"):
+        return embedder.embed_query(text)
+    return embedder.embed([text])[0]
+
+
+class VectorIndex:
+    """
+    Row vectors of one dataset version, saved in its snapshot (see snapshot.py) and
+    memory-mapped read-only so every worker process shares a single copy through the page cache.
+    """
+
+    def __init__(self, vectors, embedder, meta):
+        self.vectors = vectors
+        self.embedder = embedder
+        self.meta = meta
+
+    @classmethod
+    def from_snapshot(cls, table):
+        """Open the index saved in a snapshot table, or return None if it has none or semantic retrieval is off."""
+        meta = table.meta.get("vectors")
+        if not VECTOR_SEARCH or meta is None:
+            return None
+        embedder = EMBEDDERS[meta["embedder"]].from_state(table.arrays("embedder"))
+        return cls(table.array("vectors"), embedder, meta)
+
+    def scores(self, text):
+        """Cosine similarity of every row to the text."""
+        return np.asarray(self.vectors @ _embed_query(self.embedder, text))
+
+    def scores_many(self, texts):
+        """Cosine similarity of every row to each text, as a (texts, rows) array from one matrix product."""
+        queries = np.stack([_embed_query(self.embedder, text) for text in texts]).astype(np.float32)
+        return np.asarray(self.vectors @ queries.T).T
+
+
+def build_vectors(df, embedder_name=VECTOR_EMBEDDER):
+    """Embed every row. Returns (row vectors, embedder state, meta), saved in the dataset's snapshot."""
+    start = time.perf_counter()
+    texts = row_texts(df)
+    embedder = EMBEDDERS[embedder_name]().fit(texts)
+    vectors = embedder.embed(texts).astype(np.float32)
+    meta = {
+        "embedder": embedder_name,
+        "rows": len(df),
+        "dim": int(vectors.shape[1]),
+        "build_seconds": round(time.perf_counter() - start, 3),
+    }
+    logger.info(f"Embedded {meta['rows']} rows with {embedder_name} in {meta['build_seconds']}s")
+    return vectors, embedder.state(), meta
+
+
+def _scaled(scores):
+    """Scores divided by their best row, per query when there is one row of scores per query."""
+    if scores.shape[-1] == 0:
+        return scores
+    top = scores.max(axis=-1, keepdims=True)
+    return np.divide(scores, top, out=np.zeros_like(scores, dtype=np.float64), where=top > 0)
+
+
+def hybrid_scores(lexical, semantic, alpha=HYBRID_ALPHA, min_similarity=MIN_SIMILARITY):
+    """
+    Combine BM25 scores, scaled by their best row, with cosine similarities counted from
+    min_similarity up. Similarities aren't scaled by the best row: when no row is really
+    similar to the query, the closest one shouldn't outweigh strong keyword matches.
+    Rows without a keyword hit are only kept when they are similar enough to the query
+    on their own. Takes one query's scores or a (queries, rows) array of them.
+    """
+    semantic = np.asarray(semantic, dtype=np.float64)
+    similarity = np.clip((semantic - min_similarity) / (1 - min_similarity), 0, None)
+    combined = alpha * _scaled(lexical) + (1 - alpha) * similarity
+    combined[(lexical <= 0) & (semantic < min_similarity)] = 0
+    return combined
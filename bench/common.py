@@ -0,0 +1,98 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, "backend")
+DATASET = os.path.join(ROOT, "games_description.csv")
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BACKEND)
+
+
+def synthetic_dataset(rows, path, seed=0):
+    """
+    Write a games csv of `rows` rows made from the real one: rows are sampled with
+    replacement, names are made unique and description words shuffled so documents differ.
+    """
+    rng = np.random.default_rng(seed)
+    source = pd.read_csv(DATASET)
+    df = source.iloc[rng.integers(0, len(source), rows)].reset_index(drop=True)
+    df["name"] = df["name"].astype(str) + " " + pd.Series(range(rows)).astype(str)
+    for col in ("short_description", "long_description"):
+        df[col] = [
+            " ".join(rng.permutation(str(text).split())) if isinstance(text, str) else text
+            for text in df[col]
+        ]
+    df.to_csv(path, index=False)
+    return path
+
+
+def synthetic_summaries(columns):
+    """Column summaries in the format of column_summary_info.csv, for the metadata prompt."""
+    return [
+        {
+            "Column Name": col,
+            "Description": f"The {col} column of the games dataset. " + "It describes each game in a few words. " * 8,
+            "Total Rows": 1000,
+        }
+        for col in columns
+    ]
+
+
+def synthetic_conversation(turns):
+    return [
+        {
+            "user": f"Tell me about game number {i} and what makes it special?",
+            "assistant": f"Game number {i} is an action adventure game with a rich story. " * 6,
+        }
+        for i in range(turns)
+    ]
+
+
+def percentiles(samples):
+    """Summary of latencies in seconds, reported in milliseconds."""
+    if not samples:
+        return {"n": 0}
+    values = np.asarray(samples) * 1000
+    return {
+        "n": len(values),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=10
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ""
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def save_results(kind, config, results, output=None):
+    """Write a run's results as JSON (to bench/results/<kind>-<time>.json by default) and return the path."""
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, "w") as f:
+        json.dump({"kind": kind, "environment": environment(), "config": config, "results": results}, f, indent=2)
+    return output
@@ -0,0 +1,57 @@
+import argparse
+import json
+
+# Compare two benchmark runs of the same kind, e.g. before and after a change:
+#
+#   python bench/compare.py bench/results/load-20241101-120000.json bench/results/load-20241102-090000.json
+#
+# Prints every latency percentile and throughput of both runs with the relative change.
+
+METRICS = ("p50_ms", "p95_ms", "p99_ms", "mean_ms", "rps", "seconds")
+
+
+def flatten(results, prefix=""):
+    """{"load": {"1000": {"seconds": 1.2}}} -> {"load/1000/seconds": 1.2}, keeping the compared metrics only."""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}/"))
+        elif key in METRICS and isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10, help="flag changes worse than this many percent")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline["kind"] != candidate["kind"]:
+        parser.error(f"Can't compare a {baseline['kind']} run with a {candidate['kind']} run")
+    print(f"baseline  {baseline['environment'].get('commit')} {baseline['environment'].get('timestamp')}")
+    print(f"candidate {candidate['environment'].get('commit')} {candidate['environment'].get('timestamp')}")
+
+    before = flatten(baseline["results"])
+    after = flatten(candidate["results"])
+    width = max((len(name) for name in before), default=10)
+    regressions = 0
+    for name in sorted(before.keys() & after.keys()):
+        old, new = before[name], after[name]
+        change = (new - old) / old * 100 if old else 0.0
+        # Throughput is better higher, everything else (latencies, seconds) lower
+        worse = -change if name.endswith("rps") else change
+        flag = "  <-- regression" if worse > args.threshold else ""
+        regressions += bool(flag)
+        print(f"{name:<{width}}  {old:>12.3f}  {new:>12.3f}  {change:>+8.1f}%{flag}")
+    print(f"{regressions} regression(s) over {args.threshold}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import requests
+
+from common import BACKEND, DATASET, percentiles, save_results, synthetic_dataset
+from fake_openai import FakeOpenAI
+
+# Concurrent load on /query (or /query/stream) of the API served by gunicorn, with GPT-4o replaced by
+# the fake server answering after --latency seconds at --token-rate tokens per second:
+#
+#   python bench/load.py --concurrency 16 --requests 500 --latency 0.5 --token-rate 50
+#
+# Each client has its own session, so its own conversation. Pass --url to load an API that is
+# already running (e.g. the Docker container), the fake server settings then don't apply.
+
+QUERIES = [
+    "What is a game related to Monkeys?",
+    "Which games are about space exploration?",
+    "Recommend a multiplayer shooter to play with friends",
+    "Can you tell me more about it?",
+    "How many games do you know about?",
+    "What columns does the dataset have?",
+    "What is the highest rated game?",
+    "Which games are free to play?",
+]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url, process, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"The API exited with code {process.returncode} while starting")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError(f"The API did not answer on {url} within {timeout}s")
+
+
+def start_api(workdir, port, fake_url, args):
+    """Serve the API from workdir with gunicorn, as the Docker image does."""
+    env = dict(
+        os.environ,
+        PORT=str(port),
+        OPENAI_BASE_URL=fake_url,
+        SECRET_KEY="bench",
+        CONVERSATION_STORE="sqlite",
+        CONVERSATION_DB=os.path.join(workdir, "conversations.db"),
+        PROMETHEUS_MULTIPROC_DIR=os.path.join(workdir, "metrics"),
+        WEB_CONCURRENCY=str(args.workers),
+        GUNICORN_THREADS=str(args.threads),
+    )
+    env["openai-api-key"] = "bench"
+    log = open(os.path.join(workdir, "gunicorn.log"), "w")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", os.path.join(BACKEND, "gunicorn.conf.py"),
+         "--pythonpath", BACKEND, "main:app"],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    return process, log
+
+
+class Budget:
+    def __init__(self, total):
+        self.left = total
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self.left <= 0:
+                return False
+            self.left -= 1
+            return True
+
+
+class Results:
+    def __init__(self):
+        self.latencies = []
+        self.first_bytes = []
+        self.statuses = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, seconds, first_byte, status):
+        with self._lock:
+            self.statuses[status] += 1
+            if status == "200":
+                self.latencies.append(seconds)
+                if first_byte is not None:
+                    self.first_bytes.append(first_byte)
+
+
+class Client(threading.Thread):
+    """Sends queries in turn over one session until the shared request budget or the duration runs out."""
+
+    def __init__(self, number, url, endpoint, budget, deadline, unique, results):
+        super().__init__(daemon=True)
+        self.number = number
+        self.url = url + endpoint
+        self.stream = endpoint.endswith("/stream")
+        self.budget = budget
+        self.deadline = deadline
+        self.unique = unique
+        self.results = results
+        self.session = requests.Session()
+
+    def run(self):
+        i = self.number
+        while time.monotonic() < self.deadline and self.budget.take():
+            query = QUERIES[i % len(QUERIES)]
+            if self.unique:
+                # Defeats the answer cache, every call then goes to the fake server
+                query = f"{query} #{self.number}-{i}"
+            i += 1
+            start = time.perf_counter()
+            try:
+                response = self.session.post(self.url, json={"query": query}, timeout=180, stream=self.stream)
+                first_byte = None
+                if self.stream:
+                    for _ in response.iter_content(chunk_size=None):
+                        if first_byte is None:
+                            first_byte = time.perf_counter() - start
+                else:
+                    response.content
+                self.results.add(time.perf_counter() - start, first_byte, str(response.status_code))
+            except requests.RequestException as e:
+                self.results.add(time.perf_counter() - start, None, type(e).__name__)
+
+
+def run_load(url, endpoint, concurrency, total, duration, unique):
+    budget = Budget(total)
+    results = Results()
+    deadline = time.monotonic() + duration
+    clients = [Client(n, url, endpoint, budget, deadline, unique, results) for n in range(concurrency)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+
+    completed = sum(results.statuses.values())
+    summary = {
+        "requests": completed,
+        "seconds": round(elapsed, 3),
+        "rps": round(completed / elapsed, 2) if elapsed else 0.0,
+        "ok_rps": round(len(results.latencies) / elapsed, 2) if elapsed else 0.0,
+        "statuses": dict(results.statuses),
+        "latency": percentiles(results.latencies),
+    }
+    if results.first_bytes:
+        summary["first_byte"] = percentiles(results.first_bytes)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent load test of /query against a fake GPT-4o.")
+    parser.add_argument("--url", help="API to load, by default one is started with gunicorn")
+    parser.add_argument("--endpoint", default="/query", choices=["/query", "/query/stream"])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="concurrent clients, one run each")
+    parser.add_argument("--requests", type=int, default=200, help="requests per run")
+    parser.add_argument("--duration", type=float, default=120, help="most seconds per run")
+    parser.add_argument("--warmup", type=int, default=10, help="untimed requests before the runs")
+    parser.add_argument("--unique", action="store_true", help="make every query unique so no answer is cached")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds before the fake GPT-4o answers")
+    parser.add_argument("--token-rate", type=float, default=50, help="completion tokens per second of the fake GPT-4o")
+    parser.add_argument("--rows", type=int, help="serve a synthetic dataset of this many rows")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    fake = process = log = None
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    url = args.url
+    try:
+        if url is None:
+            fake = FakeOpenAI(latency=args.latency, token_rate=args.token_rate).start()
+            dataset = os.path.join(workdir, "games_description.csv")
+            if args.rows:
+                synthetic_dataset(args.rows, dataset)
+            else:
+                shutil.copy(DATASET, dataset)
+            port = free_port()
+            url = f"http://127.0.0.1:{port}"
+            process, log = start_api(workdir, port, fake.url, args)
+            # Startup builds the column summaries and indexes of the dataset
+            wait_until_up(url, process, timeout=600)
+        else:
+            wait_until_up(url, None, timeout=30)
+
+        if args.warmup:
+            run_load(url, args.endpoint, 1, args.warmup, args.duration, args.unique)
+
+        results = {}
+        for concurrency in args.concurrency:
+            results[str(concurrency)] = summary = run_load(
+                url, args.endpoint, concurrency, args.requests, args.duration, args.unique
+            )
+            latency = summary["latency"]
+            print(
+                f"concurrency {concurrency}: {summary['rps']} req/s, p50 {latency.get('p50_ms')} ms, "
+                f"p95 {latency.get('p95_ms')} ms, p99 {latency.get('p99_ms')} ms, statuses {summary['statuses']}"
+            )
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=60)
+            log.close()
+        if fake is not None:
+            fake.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    config = {
+        key: getattr(args, key)
+        for key in ("url", "endpoint", "concurrency", "requests", "duration", "unique", "rows", "workers", "threads")
+    }
+    if args.url is None:
+        config.update(latency=args.latency, token_rate=args.token_rate)
+    print(f"Results written to {save_results('load', config, results, args.output)}")
+
+
+if __name__ == "__main__":
+    main()
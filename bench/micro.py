@@ -0,0 +1,120 @@
+import argparse
+import os
+import tempfile
+import time
+
+from common import (
+    ROOT, percentiles, save_results, synthetic_conversation, synthetic_dataset, synthetic_summaries,
+)
+from fake_openai import FakeOpenAI
+
+# Microbenchmarks of the query hot path on synthetic datasets, with GPT-4o replaced by the fake server:
+#
+#   python bench/micro.py --sizes 1000 10000 100000 --turns 10 100 1000
+#
+# Results are written as JSON to bench/results/ (or --output), compare runs with bench/compare.py.
+
+QUERIES = [
+    ("space survival crafting game", ["space", "survival", "crafting"]),
+    ("monkey king mythology action", ["monkey", "king", "mythology"]),
+    ("multiplayer shooter to play with friends", ["multiplayer", "shooter", "friends"]),
+]
+
+
+def measure(fn, repeat, setup=None, warmup=1):
+    """Latency percentiles of fn over `repeat` runs, calling setup (untimed) before each."""
+    for _ in range(warmup):
+        if setup:
+            setup()
+        fn()
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the query hot path on synthetic datasets.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="synthetic dataset rows")
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 1000], help="conversation lengths")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    fake = FakeOpenAI().start()
+    os.environ["openai-api-key"] = "bench"
+    os.environ["OPENAI_BASE_URL"] = fake.url
+    os.environ.setdefault("SNAPSHOT_DIR", os.path.join(workdir, "dataset_snapshot"))
+    # Answers are cached on the version of the csv in the working directory
+    os.chdir(ROOT)
+
+    import data
+    import gpt
+    from conversation import MemoryConversationStore
+
+    def clear_cache():
+        gpt.llm_cache.backend.clear()
+
+    results = {"load": {}, "retrieve_rows_for_keywords": {}, "retrieve_relevant_rows": {}}
+    for rows in args.sizes:
+        path = synthetic_dataset(rows, os.path.join(workdir, f"games-{rows}.csv"))
+        start = time.perf_counter()
+        snapshot = data.get_dataset(path)
+        seconds = time.perf_counter() - start
+        # A new worker only opens the snapshot built above
+        start = time.perf_counter()
+        data.DatasetStore(path).get()
+        results["load"][str(rows)] = {
+            "seconds": round(seconds, 3),
+            "cold_start_ms": round((time.perf_counter() - start) * 1000, 2),
+            "memory_bytes": snapshot.memory_bytes,
+            "terms": len(snapshot.index),
+            "vectors": snapshot.vectors is not None,
+        }
+        print(f"{rows} rows loaded in {results['load'][str(rows)]['seconds']}s, reopened in {results['load'][str(rows)]['cold_start_ms']} ms")
+
+        for query, keywords in QUERIES:
+            label = f"{rows}:{query}"
+            results["retrieve_rows_for_keywords"][label] = measure(
+                lambda: data.retrieve_rows_for_keywords(keywords, path, query=query), args.repeat
+            )
+            # Includes the keyword call to the fake server; the answer cache is cleared before each run
+            results["retrieve_relevant_rows"][label] = measure(
+                lambda: data.retrieve_relevant_rows(query, path), args.repeat, setup=clear_cache
+            )
+            print(f"  {query}: {results['retrieve_rows_for_keywords'][label]['p50_ms']} ms")
+
+    # Prompt building and summaries depend on the conversation length, not on the dataset size
+    path = os.path.join(workdir, f"games-{args.sizes[0]}.csv")
+    relevant = data.retrieve_rows_for_keywords(QUERIES[0][1], path, top_n=3)
+    summaries = synthetic_summaries(data.get_dataset(path).columns)
+    results.update({"generate_prompt_row": {}, "generate_prompt_col": {}, "summarize_conversation": {}})
+    for turns in args.turns:
+        # As loaded from the store, with exchanges beyond the recent ones folded into its summary
+        store = MemoryConversationStore()
+        for exchange in synthetic_conversation(turns):
+            store.append("bench", exchange["user"], exchange["assistant"])
+        conversation = store.load("bench")
+        results["generate_prompt_row"][str(turns)] = measure(
+            lambda: gpt.generate_prompt_row(conversation, QUERIES[0][0], relevant), args.repeat
+        )
+        results["generate_prompt_col"][str(turns)] = measure(
+            lambda: gpt.generate_prompt_col(conversation, "How many columns are there?", summaries), args.repeat
+        )
+        results["summarize_conversation"][str(turns)] = measure(
+            lambda: gpt.summarize_conversation(conversation), args.repeat
+        )
+        print(f"{turns} turns: prompt_row {results['generate_prompt_row'][str(turns)]['p50_ms']} ms")
+
+    fake.stop()
+    config = {"sizes": args.sizes, "turns": args.turns, "repeat": args.repeat}
+    print(f"Results written to {save_results('micro', config, results, args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+# The backend modules read these on import: gpt.py creates its OpenAI client (the offline tests never
+# call it) and datasets loaded by the tests get their snapshots in a scratch directory
+os.environ.setdefault("openai-api-key", "test")
+_scratch = tempfile.mkdtemp(prefix="tests-")
+atexit.register(shutil.rmtree, _scratch, ignore_errors=True)
+os.environ.setdefault("SNAPSHOT_DIR", os.path.join(_scratch, "dataset_snapshot"))
@@ -0,0 +1,189 @@
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the OpenAI chat completions API, for tests and benchmarks without an API key.
+# Point the API at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1
+#
+#   python fake_openai.py --port 8089 --latency 0.3 --token-rate 50
+#
+# Faults are injected with POST /_fake/faults, e.g. {"status": 429, "count": 2, "retry_after": 1}
+# or {"delay": 5, "count": 1}; GET /_fake/stats returns the number of completions served.
+
+
+def fake_answer(messages):
+    """Answer like GPT-4o would for the API's prompts: keywords or batch plans as JSON, a query type, or some text."""
+    system = messages[0]["content"] if messages else ""
+    content = messages[-1]["content"] if messages else ""
+    if "Generate keywords" in system:
+        terms = [word for word in re.findall(r"[a-z0-9]+", content.lower()) if len(word) > 3]
+        return json.dumps({"keywords": terms[:5] or ["game"]})
+    if "planning retrieval for several" in system:
+        queries = json.loads(content)["queries"]
+        return json.dumps({"results": [
+            {
+                "id": item["id"],
+                "type": "Metadata" if re.search(r"\b(how many|columns|dataset)\b", item["query"].lower()) else "Row-specific",
+                "keywords": [word for word in re.findall(r"[a-z0-9]+", item["query"].lower()) if len(word) > 3][:5] or ["game"],
+            }
+            for item in queries
+        ]})
+    if "determining whether" in system:
+        query = content.split('Query: "')[-1].split('"')[0].lower()
+        return "Metadata" if re.search(r"\b(how many|columns|dataset)\b", query) else "Row-specific"
+    return f"This is a fake answer to a prompt of {len(content)} characters. " * 4
+
+
+def count_tokens(text):
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+class FakeOpenAI:
+    """Threaded HTTP server speaking enough of the OpenAI API for the chat completions the API makes."""
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, token_rate=0.0):
+        # Seconds before the first token, and completion tokens generated per second (0 for instant answers)
+        self.latency = latency
+        self.token_rate = token_rate
+        self.completions = 0
+        self._faults = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def fail(self, status=500, count=1, retry_after=None, delay=0.0):
+        """Answer the next `count` completions with `status` (or just slow them down by `delay` if status is None)."""
+        with self._lock:
+            self._faults.extend([{"status": status, "retry_after": retry_after, "delay": delay}] * count)
+
+    def generation_seconds(self, text):
+        return count_tokens(text) / self.token_rate if self.token_rate > 0 else 0.0
+
+    def _next_fault(self):
+        with self._lock:
+            self.completions += 1
+            return self._faults.pop(0) if self._faults else None
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _json(self, status, body, headers=None):
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length", 0))
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def do_GET(self):
+                if self.path == "/_fake/stats":
+                    return self._json(200, {"completions": fake.completions})
+                self._json(404, {"error": {"message": "Not found"}})
+
+            def do_POST(self):
+                body = self._body()
+                if self.path == "/_fake/faults":
+                    fields = {key: body[key] for key in ("status", "count", "retry_after", "delay") if key in body}
+                    fake.fail(**fields)
+                    return self._json(200, {"faults": len(fake._faults)})
+                if not self.path.endswith("/chat/completions"):
+                    return self._json(404, {"error": {"message": "Not found"}})
+
+                fault = fake._next_fault()
+                time.sleep(fake.latency + (fault["delay"] if fault else 0))
+                if fault and fault["status"]:
+                    headers = {"Retry-After": str(fault["retry_after"])} if fault["retry_after"] is not None else {}
+                    error = {"message": f"Injected {fault['status']}", "type": "fake_error", "code": None}
+                    return self._json(fault["status"], {"error": error}, headers)
+
+                messages = body.get("messages", [])
+                answer = fake_answer(messages)
+                prompt_tokens = sum(count_tokens(str(m.get("content", ""))) for m in messages)
+                completion_tokens = count_tokens(answer)
+                usage = {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                }
+                base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": body.get("model", "gpt-4o")}
+                if body.get("stream"):
+                    include_usage = (body.get("stream_options") or {}).get("include_usage")
+                    return self._stream(base, answer, usage if include_usage else None)
+                time.sleep(fake.generation_seconds(answer))
+                self._json(200, dict(
+                    base,
+                    object="chat.completion",
+                    choices=[{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                    usage=usage,
+                ))
+
+            def _stream(self, base, answer, usage=None):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                pieces = re.findall(r"\S*\s*", answer)
+                for piece in [p for p in pieces if p] + [None]:
+                    delta = {"content": piece} if piece is not None else {}
+                    chunk = dict(base, object="chat.completion.chunk", choices=[
+                        {"index": 0, "delta": delta, "finish_reason": None if piece is not None else "stop"}
+                    ])
+                    self._chunk(f"data: {json.dumps(chunk)}\n\n")
+                    time.sleep(fake.generation_seconds(piece or ""))
+                if usage is not None:
+                    chunk = dict(base, object="chat.completion.chunk", choices=[], usage=usage)
+                    self._chunk(f"data: {json.dumps(chunk)}\n\n")
+                self._chunk("data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _chunk(self, text):
+                data = text.encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI chat completions server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each completion is answered")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="completion tokens per second, 0 for instant")
+    args = parser.parse_args()
+    server = FakeOpenAI(args.host, args.port, args.latency, args.token_rate)
+    print(f"Fake OpenAI API on {server.url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        server._server.server_close()
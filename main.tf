@@ -68,6 +68,8 @@ resource "aws_lb" "games_api_lb" {
   load_balancer_type = "application"
   security_groups    = [aws_security_group.lb_security_group.id]
   subnets            = var.subnet_ids
+  # /query/stream sends a keep-alive comment every SSE_HEARTBEAT_SECONDS (15s), well within this timeout
+  idle_timeout       = 60
 }
 
 # Target Group
@@ -77,6 +79,8 @@ resource "aws_lb_target_group" "games_api_target_group" {
   protocol    = "HTTP"
   vpc_id      = var.vpc_id
   target_type = "ip"
+  # Matches gunicorn's graceful_timeout, in-flight requests finish before the task is stopped
+  deregistration_delay = 30
 }
 
 # Listener for Load Balancer
@@ -109,6 +113,8 @@ resource "aws_ecs_task_definition" "games_api_task" {
           hostPort      = 6000
         }
       ]
+      # Seconds between SIGTERM and SIGKILL, gunicorn's graceful_timeout (25s) fits within it
+      stopTimeout = 30
       logConfiguration = {
         logDriver = "awslogs"
         options = {
@@ -1,3 +1,5 @@
+import json
+
 import requests
 
 BASE_URL = "http://127.0.0.1:6000"
@@ -43,6 +45,13 @@ def test_non_string_query():
     assert "error" in response.json()
     assert response.json()["error"] == "Query must be a string."
 
+# Test a JSON body that isn't an object is rejected like a bad query
+def test_non_object_body():
+    for body in (["What is Hades?"], "What is Hades?", 12345):
+        response = requests.post(f"{BASE_URL}/query", json=body)
+        assert response.status_code == 400
+        assert response.json()["error"] == "Query must be a string."
+
 # Test special characters in query (to see how the API handles them)
 def test_special_characters_query():
     response = requests.post(f"{BASE_URL}/query", json={"query": "@#$%^&*()"})
@@ -104,4 +113,64 @@ def test_reset_after_multiple_queries():
 # Test unexpected endpoints (error handling for non-existing routes)
 def test_non_existent_endpoint():
     response = requests.post(f"{BASE_URL}/nonexistent")
-    assert response.status_code == 404
\ No newline at end of file
+    assert response.status_code == 404
+
+# Test streaming query endpoint returns Server-Sent Events ending with the full answer
+def test_stream_query_endpoint():
+    response = requests.post(f"{BASE_URL}/query/stream", json={"query": "What is a game related to Monkeys"}, stream=True)
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/event-stream")
+    body = response.text
+    assert "event: done" in body
+    assert "event: error" not in body
+
+# Test streaming query endpoint validates input like /query
+def test_stream_empty_query():
+    response = requests.post(f"{BASE_URL}/query/stream", json={"query": ""})
+    assert response.status_code == 400
+    assert response.json()["error"] == "Query field is required and cannot be empty."
+
+# Test cache statistics endpoint reports hit/miss counts
+def test_cache_stats():
+    # Answered by GPT-4o (not from the dataset statistics), so the second query reuses cached keywords.
+    # One keep-alive connection keeps the requests on the same worker process, each has its own cache.
+    with requests.Session() as client:
+        client.post(f"{BASE_URL}/query", json={"query": "Which games are about space exploration?"})
+        client.post(f"{BASE_URL}/query", json={"query": "Which games are about space exploration?"})
+        response = client.get(f"{BASE_URL}/cache/stats")
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["hits"] > 0
+    assert 0 <= stats["hit_ratio"] <= 1
+
+# Test metrics endpoint exports request and stage latencies in the Prometheus format
+def test_metrics():
+    query = requests.post(f"{BASE_URL}/query", json={"query": "What is a game related to Monkeys"})
+    assert "total;dur=" in query.headers["Server-Timing"]
+    response = requests.get(f"{BASE_URL}/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+    assert 'api_requests_total{endpoint="/query"' in response.text
+    assert 'api_stage_seconds_count{stage="retrieval"}' in response.text
+
+# Test batch endpoint answers every query (duplicates once) as one JSON line each, plus a final summary line
+def test_batch_query():
+    queries = ["What is a game related to Monkeys", "what is a game related to monkeys?", "How many games do you know about?"]
+    response = requests.post(f"{BASE_URL}/query/batch", json={"queries": queries, "stateless": True})
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    results = sorted(lines[:-1], key=lambda line: line["index"])
+    assert [line["index"] for line in results] == [0, 1, 2]
+    assert all(isinstance(line["response"], str) for line in results)
+    assert results[0]["response"] == results[1]["response"]
+    assert lines[-1] == {"done": True, "queries": 3, "distinct": 2, "answered": 3, "failed": 0}
+
+# Test batch endpoint rejects anything but a non-empty list of non-empty strings
+def test_batch_invalid_queries():
+    response = requests.post(f"{BASE_URL}/query/batch", json={"queries": ["Tell me about Hades", ""]})
+    assert response.status_code == 400
+    assert response.json()["error"] == "Query 1 must be a non-empty string."
+    response = requests.post(f"{BASE_URL}/query/batch", json=["Tell me about Hades"])
+    assert response.status_code == 400
+    assert response.json()["error"] == "Queries must be a non-empty list of strings."
@@ -0,0 +1,140 @@
+import json
+import os
+import sys
+
+import pandas as pd
+import pytest
+from prometheus_client.parser import text_string_to_metric_families
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+GAMES = pd.DataFrame({
+    "name": ["Hades", "ELDEN RING"],
+    "short_description": [
+        "Defy the god of the dead as you hack and slash out of the Underworld.",
+        "Rise, Tarnished, and become an Elden Lord in the Lands Between.",
+    ],
+    "genres": ["['Action', 'Roguelike']", "['Action', 'RPG']"],
+})
+
+
+@pytest.fixture(scope="module")
+def main(tmp_path_factory):
+    # The app reads the dataset and its column summaries from the working directory when imported
+    directory = tmp_path_factory.mktemp("app")
+    GAMES.to_csv(directory / "games_description.csv", index=False)
+    pd.DataFrame({
+        "Column Name": list(GAMES.columns),
+        "Description": [f"The {column} of each game." for column in GAMES.columns],
+    }).to_csv(directory / "column_summary_info.csv", index=False)
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(directory)
+        patch.setenv("SECRET_KEY", "test")
+        import main
+        yield main
+
+
+@pytest.fixture
+def client(main):
+    main.app.config["TESTING"] = True
+    return main.app.test_client()
+
+
+def session_history(main, client):
+    with client.session_transaction() as session:
+        return main.conversation_store.load(session["sid"])
+
+
+def sse_events(response):
+    events = []
+    for message in response.get_data(as_text=True).split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in message.splitlines() if not line.startswith(":"))
+        if "event" in lines:
+            events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def metric_samples(client):
+    text = client.get("/metrics").get_data(as_text=True)
+    return {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for family in text_string_to_metric_families(text) for sample in family.samples
+    }
+
+
+@pytest.fixture
+def stub_pipeline(main, monkeypatch):
+    def plan_query(user_input, conversation_history, csv):
+        with main.metrics.stage("route"):
+            pass
+        with main.metrics.stage("retrieval"):
+            return "Row-specific", [{"name": "Hades"}]
+
+    def generator_rag_rowbase(conversation_history, user_input, relevant_data):
+        with main.metrics.stage("generator_rag_rowbase"):
+            return f"Answer to {user_input}"
+
+    monkeypatch.setattr(main, "plan_query", plan_query)
+    monkeypatch.setattr(main, "generator_rag_rowbase", generator_rag_rowbase)
+
+
+# Test a query lists its stages in the Server-Timing header and in the /metrics histograms
+def test_server_timing_and_metrics(main, client, stub_pipeline):
+    before = metric_samples(client)
+    response = client.post("/query", json={"query": "Tell me about Hades"})
+    assert response.get_json() == {"response": "Answer to Tell me about Hades"}
+    timings = [entry.split(";dur=") for entry in response.headers["Server-Timing"].split(", ")]
+    assert [name for name, _ in timings] == [
+        "load_history", "local_answer", "route", "retrieval", "generator_rag_rowbase", "store_history", "total",
+    ]
+    assert all(float(duration) >= 0 for _, duration in timings)
+
+    after = metric_samples(client)
+
+    def increase(name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        return after.get(key, 0) - before.get(key, 0)
+
+    assert increase("api_request_seconds_count", endpoint="/query") == 1
+    assert increase("api_request_seconds_bucket", endpoint="/query", le="+Inf") == 1
+    assert increase("api_requests_total", endpoint="/query", method="POST", status="200") == 1
+    for stage in ("route", "retrieval", "generator_rag_rowbase", "store_history"):
+        assert increase("api_stage_seconds_count", stage=stage) == 1
+    assert increase("api_request_seconds_count", endpoint="/metrics") == 0
+
+
+# Test SERVER_TIMING=0 leaves the header out, the metrics are still recorded
+def test_server_timing_disabled(main, client, stub_pipeline, monkeypatch):
+    monkeypatch.setattr(main.metrics, "SERVER_TIMING", False)
+    before = metric_samples(client)
+    response = client.post("/query", json={"query": "Tell me about Hades"})
+    assert response.status_code == 200 and "Server-Timing" not in response.headers
+    key = ("api_request_seconds_count", (("endpoint", "/query"),))
+    assert metric_samples(client)[key] == before.get(key, 0) + 1
+
+
+# Test a streamed answer is stored in the session's history once done, and a failed one is not
+def test_stream_stores_finished_answers(main, client, monkeypatch):
+    def stream_answer(user_input, conversation_history, summary_data, csv, heartbeat):
+        if "broken" in user_input:
+            yield "token", "Half an"
+            yield "error", RuntimeError("upstream failed")
+            return
+        yield "heartbeat", None
+        yield "token", "Hades is "
+        yield "token", "a roguelike."
+        yield "done", "Hades is a roguelike."
+
+    monkeypatch.setattr(main, "stream_answer", stream_answer)
+    response = client.post("/query/stream", json={"query": "Tell me about Hades"})
+    assert ": keep-alive" in response.get_data(as_text=True)
+    assert sse_events(response) == [
+        ("token", {"text": "Hades is "}), ("token", {"text": "a roguelike."}), ("done", {"response": "Hades is a roguelike."}),
+    ]
+    assert [(turn["user"], turn["assistant"]) for turn in session_history(main, client)] == [
+        ("Tell me about Hades", "Hades is a roguelike."),
+    ]
+
+    response = client.post("/query/stream", json={"query": "Tell me about the broken game"})
+    assert sse_events(response)[-1] == ("error", {"error": "An internal error occurred. Please try again later."})
+    assert len(session_history(main, client)) == 1
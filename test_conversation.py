@@ -0,0 +1,133 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+import conversation
+from conversation import (
+    ConversationHistory, MemoryConversationStore, SQLiteConversationStore, _splice, _truncate_summary, compact,
+    schedule_compression,
+)
+
+
+def exchange(i):
+    return {"user": f"Tell me about game {i}?", "assistant": f"Game {i} is a roguelike. It has many runs."}
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteConversationStore(str(tmp_path / "conversations.db"))
+    return MemoryConversationStore()
+
+
+# Test exchanges leaving the turn window are folded once into the summary as short Q/A lines
+def test_compact_turns():
+    history = compact(ConversationHistory([exchange(i) for i in range(12)]), max_turns=10)
+    assert history == [exchange(i) for i in range(2, 12)]
+    assert history.summary == "Q: Tell me about game 0? A: Game 0 is a roguelike. Q: Tell me about game 1? A: Game 1 is a roguelike."
+
+    unchanged = ConversationHistory([exchange(i) for i in range(10)], "earlier")
+    assert compact(unchanged, max_turns=10) is unchanged
+
+
+# Test the oldest exchanges are folded while the history is over the byte cap, keeping at least one
+def test_compact_bytes():
+    turns = [{"user": f"q{i}", "assistant": "x" * 100} for i in range(5)]
+    history = compact(ConversationHistory(turns), max_turns=10, max_bytes=300)
+    assert history == turns[3:]
+    assert history.summary.startswith("Q: q0 A: xxx")
+
+    history = compact(ConversationHistory(turns[:1]), max_turns=10, max_bytes=10)
+    assert history == turns[:1]
+
+
+# Test the summary keeps its most recent end, cut at a word boundary
+def test_truncate_summary():
+    assert _truncate_summary("short", 10) == "short"
+    assert _truncate_summary("one two three four", 10) == "three four"
+    history = compact(ConversationHistory([exchange(i) for i in range(30)], "x" * 50), max_turns=10, max_summary_chars=120)
+    assert len(history.summary) <= 120
+    assert history.summary.endswith("Game 19 is a roguelike.")
+
+
+# Test a compressed summary replaces only the part it was made from
+def test_splice():
+    assert _splice("Q: a A: b Q: c A: d", "Q: a A: b", "Asked about a.") == "Asked about a. Q: c A: d"
+    assert _splice("Q: a A: b", "Q: a A: b", "Asked about a.") == "Asked about a."
+    assert _splice("Q: c A: d", "Q: a A: b", "Asked about a.") is None
+
+
+# Test appends compact the stored history and a compression made meanwhile keeps newer folds
+def test_store_replace_summary(store):
+    for i in range(11):
+        store.append("sid", exchange(i)["user"], exchange(i)["assistant"])
+    old = store.load("sid").summary
+    assert old.startswith("Q: Tell me about game 0?")
+
+    store.append("sid", exchange(11)["user"], exchange(11)["assistant"])
+    assert store.replace_summary("sid", old, "Asked about game 0.")
+    history = store.load("sid")
+    assert history.summary == "Asked about game 0. Q: Tell me about game 1? A: Game 1 is a roguelike."
+    assert len(history) == 10
+
+    assert not store.replace_summary("sid", old, "stale")
+    assert not store.replace_summary("missing", old, "stale")
+    store.reset("sid")
+    assert store.load("sid") == [] and store.load("sid").summary == ""
+
+
+# Test concurrent appends to one session through separate connections don't lose exchanges
+def test_sqlite_concurrent_appends(tmp_path):
+    path = str(tmp_path / "conversations.db")
+    stores = [SQLiteConversationStore(path) for _ in range(4)]
+
+    def append(store, worker):
+        for i in range(5):
+            store.append("sid", f"worker {worker} question {i}", "answer.")
+
+    threads = [threading.Thread(target=append, args=(store, worker)) for worker, store in enumerate(stores)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    history = stores[0].load("sid")
+    assert len(history) == 10
+    assert history.summary.count("Q: ") == 10
+
+
+# Test sessions idle for longer than the TTL are deleted
+def test_idle_expiry(monkeypatch, tmp_path):
+    monkeypatch.setattr(conversation, "EXPIRY_INTERVAL", 0)
+    for store in (MemoryConversationStore(idle_ttl=0), SQLiteConversationStore(str(tmp_path / "c.db"), idle_ttl=0)):
+        store.append("sid", "question", "answer.")
+        store.load("other")
+        assert store.load("sid") == []
+
+
+# Test long summaries are compressed in the background, once per session, and kept when compression fails
+def test_schedule_compression(monkeypatch):
+    store = MemoryConversationStore()
+    for i in range(11):
+        store.append("sid", exchange(i)["user"], exchange(i)["assistant"])
+    summary = store.load("sid").summary
+    assert schedule_compression(store, "sid", summary, enabled=False, min_chars=0) is None
+    assert schedule_compression(store, "sid", summary, enabled=True, min_chars=len(summary)) is None
+
+    release = threading.Event()
+    monkeypatch.setattr(conversation, "compress_summary", lambda text: release.wait(5) and "Asked about game 0.")
+    future = schedule_compression(store, "sid", summary, enabled=True, min_chars=0)
+    assert schedule_compression(store, "sid", summary, enabled=True, min_chars=0) is None
+    release.set()
+    future.result(5)
+    assert store.load("sid").summary == "Asked about game 0."
+
+    def fail(text):
+        raise RuntimeError("upstream down")
+
+    monkeypatch.setattr(conversation, "compress_summary", fail)
+    schedule_compression(store, "sid", "Asked about game 0.", enabled=True, min_chars=0).result(5)
+    assert store.load("sid").summary == "Asked about game 0."
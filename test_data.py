@@ -0,0 +1,123 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+import data
+from data import DatasetStore, retrieve_rows_for_keyword_batch, retrieve_rows_for_keywords
+
+GAMES_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "games_description.csv")
+
+
+class FakeSnapshot:
+    def __init__(self, version):
+        self.version = version
+        self.rows = 0
+        self.load_seconds = 0.0
+        self.memory_bytes = 0
+
+
+# Test get() keeps serving the loaded snapshot while a changed csv is rebuilt in the background
+def test_get_does_not_block_on_rebuild(tmp_path, monkeypatch):
+    path = tmp_path / "games.csv"
+    path.write_text("name\nHades\n")
+    building = threading.Event()
+    release = threading.Event()
+
+    def open_snapshot(csv, raw, version):
+        if data.content_version(raw) != first:
+            building.set()
+            release.wait(10)
+        return FakeSnapshot(version)
+
+    first = data.content_version(path.read_bytes())
+    monkeypatch.setattr(data, "_open_snapshot", open_snapshot)
+    store = DatasetStore(str(path), check_interval=0)
+    assert store.get().version == first
+
+    path.write_text("name\nHades\nHades II\n")
+    assert store.get().version == first
+    assert building.wait(5)
+    start = time.monotonic()
+    for _ in range(100):
+        assert store.get().version == first
+    assert time.monotonic() - start < 1
+
+    release.set()
+    for _ in range(100):
+        if store.get().version != first:
+            break
+        time.sleep(0.05)
+    assert store.get().version == data.content_version(path.read_bytes())
+    assert store.loads == 2
+
+
+# Test queries naming a game by what it's about find it, alone and in a batch
+def test_paraphrase_retrieval():
+    names = [row["name"] for row in retrieve_rows_for_keywords(["monkey", "king"], GAMES_CSV, query="monkey king game")]
+    assert "Black Myth: Wukong" in names
+    batch = retrieve_rows_for_keyword_batch(
+        [["monkey", "king"], ["hades"]], GAMES_CSV, queries=["monkey king game", "Tell me about Hades"],
+    )
+    assert [row["name"] for row in batch[0]] == names
+    assert batch[1][0]["name"] == "Hades"
+
+
+# Test columns are split into chunks within the prompt budget, sampling values evenly past the chunk limit
+def test_column_chunks_bounds():
+    values = [f"value {i:04d}" for i in range(1000)] + [None, "", "value 0000"]
+    chunks = data.column_chunks(values, chunk_chars=200, max_chunks=3)
+    assert len(chunks) == 3
+    assert all(sum(len(value) + 2 for value in chunk) <= 200 for chunk in chunks)
+    flat = [value for chunk in chunks for value in chunk]
+    assert len(flat) == len(set(flat)) and flat[0] == "value 0000" and flat[-1] > "value 0900"
+    assert data.column_chunks(["a  long\n description"], value_chars=6) == [["a long"]]
+    assert data.column_chunks(["a", "b"], chunk_chars=200, max_chunks=3) == [["a", "b"]]
+    assert data.column_chunks([None, " "]) == []
+
+
+class SummaryDataset:
+    def __init__(self, version):
+        self.version = version
+        self.df = data.pd.DataFrame({"name": ["Hades", "Celeste"], "genres": ["Roguelike", "Platformer"], "price": [25, 20]})
+
+
+# Test an interrupted summary run resumes from its checkpoint, and a changed csv discards the checkpoint
+def test_summary_checkpoint(tmp_path, monkeypatch):
+    output = str(tmp_path / "summary.csv")
+    dataset = SummaryDataset("v1")
+    calls = []
+    failing = {"price"}
+
+    def summarise_cols(name, values):
+        calls.append(name)
+        if name in failing:
+            failing.discard(name)
+            raise RuntimeError("rate limited")
+        return f"{name} summary"
+
+    monkeypatch.setattr(data, "get_dataset", lambda csv: dataset)
+    # data only has gpt's functions when it was imported first, gpt importing data doesn't give them to it
+    monkeypatch.setattr(data, "summarise_cols", summarise_cols, raising=False)
+
+    with pytest.raises(RuntimeError):
+        data.data_info_col("games.csv", output_csv=output, workers=1)
+    assert sorted(calls) == ["genres", "name", "price"]
+    assert os.path.exists(f"{output}.checkpoint.json")
+
+    calls.clear()
+    assert data.data_info_col("games.csv", output_csv=output, workers=1)[1] == 2
+    assert calls == ["price"]
+    assert not os.path.exists(f"{output}.checkpoint.json")
+    assert data.pd.read_csv(output)["Description"].tolist() == ["name summary", "genres summary", "price summary"]
+
+    data._save_checkpoint(f"{output}.checkpoint.json", "v1", {"name": "stale", "genres": "stale"})
+    dataset = SummaryDataset("v2")
+    calls.clear()
+    data.data_info_col("games.csv", output_csv=output, workers=1)
+    assert sorted(calls) == ["genres", "name", "price"]
+    assert "stale" not in data.pd.read_csv(output)["Description"].tolist()
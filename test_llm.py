@@ -0,0 +1,259 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+from openai import InternalServerError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+import gpt
+import llm
+from coalesce import SingleFlight
+from fake_openai import FakeOpenAI
+from gpt import fallback_keywords, generate_keywords, parse_keywords, parse_query_type
+from llm import CircuitBreaker, LLMGateway, LLMTimeout, LLMUnavailable
+from llm_cache import LLMCache, MemoryBackend
+
+MESSAGES = [{"role": "user", "content": "Tell me about Hades"}]
+
+
+@pytest.fixture
+def fake():
+    server = FakeOpenAI().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    # Keep retries fast, the backoff itself is not what these tests are about
+    monkeypatch.setattr(llm, "backoff_delay", lambda attempt, error=None: 0.01)
+
+
+def make_gateway(fake, **kwargs):
+    return LLMGateway(api_key="test", base_url=fake.url, **kwargs)
+
+
+# Test a completion through the gateway against the fake server
+def test_complete(fake):
+    gateway = make_gateway(fake)
+    answer = gateway.complete("generator_rag_rowbase", "gpt-4o", MESSAGES)
+    assert answer.startswith("This is a fake answer")
+    assert gateway.stats()["calls"] == 1
+
+# Test rate limited calls are retried
+def test_retries_rate_limit(fake):
+    fake.fail(status=429, count=2, retry_after=0)
+    gateway = make_gateway(fake)
+    assert gateway.complete("query_type", "gpt-4o", MESSAGES)
+    assert gateway.retries == 2
+    assert fake.completions == 3
+
+# Test the last error is raised once the attempts are used up
+def test_gives_up_after_attempts(fake):
+    fake.fail(status=500, count=5)
+    gateway = make_gateway(fake, policies={"query_type": (10, 2)})
+    with pytest.raises(InternalServerError):
+        gateway.complete("query_type", "gpt-4o", MESSAGES)
+    assert fake.completions == 2
+
+# Test the circuit opens after consecutive failures, fails fast, and closes again after a successful trial call
+def test_circuit_breaker(fake):
+    fake.fail(status=503, count=3)
+    breaker = CircuitBreaker(failures=3, reset_seconds=0.2)
+    gateway = make_gateway(fake, breaker=breaker, policies={"query_type": (10, 3)})
+    with pytest.raises(InternalServerError):
+        gateway.complete("query_type", "gpt-4o", MESSAGES)
+    assert breaker.state == "open"
+
+    with pytest.raises(LLMUnavailable):
+        gateway.complete("query_type", "gpt-4o", MESSAGES)
+    assert fake.completions == 3
+
+    time.sleep(0.25)
+    assert gateway.complete("query_type", "gpt-4o", MESSAGES)
+    assert breaker.state == "closed"
+
+# Test a slow upstream fails with a timeout once the call type's deadline passes
+def test_deadline(fake):
+    fake.fail(status=None, delay=2, count=3)
+    gateway = make_gateway(fake, policies={"query_type": (0.3, 3)})
+    start = time.monotonic()
+    with pytest.raises(LLMTimeout):
+        gateway.complete("query_type", "gpt-4o", MESSAGES)
+    assert time.monotonic() - start < 1.5
+
+# Test calls beyond the concurrency limit are rejected rather than queued past their deadline
+def test_concurrency_limit(fake):
+    fake.fail(status=None, delay=1, count=1)
+    gateway = make_gateway(fake, max_concurrency=1, policies={"query_type": (0.2, 1)})
+    slow = threading.Thread(target=gateway.complete, args=("generator_rag_rowbase", "gpt-4o", MESSAGES))
+    slow.start()
+    time.sleep(0.2)
+    with pytest.raises(LLMUnavailable):
+        gateway.complete("query_type", "gpt-4o", MESSAGES)
+    slow.join()
+    assert gateway.rejected == 1
+
+# Test streamed answers arrive in pieces and add up to the full answer
+def test_stream(fake):
+    gateway = make_gateway(fake)
+    pieces = list(gateway.stream("generator_rag_rowbase", "gpt-4o", MESSAGES))
+    assert len(pieces) > 1
+    assert "".join(pieces).startswith("This is a fake answer")
+
+
+# Test concurrent identical calls are made once and share the answer, or the error
+def test_coalescing(fake):
+    fake.latency = 0.3
+    gateway = make_gateway(fake)
+    flights = SingleFlight(wait=5, enabled=True)
+    answers, errors = [], []
+
+    def ask():
+        try:
+            answers.append(flights.do("generator_rag_rowbase", "key", lambda: gateway.complete("generator_rag_rowbase", "gpt-4o", MESSAGES)))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=ask) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(answers) == 8 and len(set(answers)) == 1
+    assert gateway.stats()["calls"] == 1
+    assert flights.saved == 7
+    assert flights.stats()["in_flight"] == 0
+
+    fake.fail(status=500, count=100)
+    threads = [threading.Thread(target=ask) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 4 and all(isinstance(e, InternalServerError) for e in errors)
+    # One call's attempts, not one call per thread
+    assert gateway.stats()["calls"] == 1 + llm.CALL_POLICIES["generator_rag_rowbase"][1]
+
+
+# Test a waiter makes its own call when the identical one takes longer than the wait
+def test_coalescing_wait():
+    flights = SingleFlight(wait=0.05, enabled=True)
+    release = threading.Event()
+    leader = threading.Thread(target=lambda: flights.do("query_type", "key", lambda: release.wait(5) and "Metadata"))
+    leader.start()
+    time.sleep(0.02)
+    assert flights.do("query_type", "key", lambda: "Row-specific") == "Row-specific"
+    assert flights.timeouts == 1
+    release.set()
+    leader.join()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+# Test cached answers expire after their TTL
+def test_cache_ttl():
+    clock = Clock()
+    cache = LLMCache(MemoryBackend(clock=clock), ttl=60)
+    key = cache.key("query_type", "gpt-4o", MESSAGES)
+    cache.set(key, "Row-specific")
+    clock.now = 59.9
+    assert cache.get(key) == "Row-specific"
+    clock.now = 60
+    assert cache.get(key) is None
+    assert len(cache.backend) == 0 and cache.backend.bytes == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+# Test the least recently used answers are evicted first, by entry count and by size
+def test_cache_lru():
+    backend = MemoryBackend(max_entries=2, clock=Clock())
+    backend.set("a", "1", 60)
+    backend.set("b", "2", 60)
+    assert backend.get("a") == "1"
+    backend.set("c", "3", 60)
+    assert backend.get("b") is None
+    assert (backend.get("a"), backend.get("c")) == ("1", "3")
+
+    backend = MemoryBackend(max_bytes=20, clock=Clock())
+    backend.set("a", "x" * 9, 60)
+    backend.set("b", "y" * 9, 60)
+    assert backend.bytes == 20
+    backend.set("c", "z" * 9, 60)
+    assert backend.get("a") is None and backend.get("c") == "z" * 9
+    assert backend.bytes == 20
+    backend.set("d", "w" * 20, 60)
+    assert backend.get("d") is None and len(backend) == 2
+
+
+# Test answers are keyed on the dataset version and cleared from memory when it changes
+def test_cache_version():
+    version = ["v1"]
+    cache = LLMCache(MemoryBackend(clock=Clock()), version=lambda: version[0])
+    key = cache.key("query_type", "gpt-4o", MESSAGES)
+    cache.set(key, "Row-specific")
+    assert cache.key("query_type", "gpt-4o", [{"role": "user", "content": "  tell me about HADES?"}]) == key
+    assert cache.get(key) == "Row-specific"
+
+    version[0] = "v2"
+    new_key = cache.key("query_type", "gpt-4o", MESSAGES)
+    assert new_key != key
+    assert cache.get(new_key) is None
+    assert len(cache.backend) == 0
+    assert cache.stats()["version"] == "v2"
+
+
+# Test keyword answers are read from JSON, fenced JSON or plain lists, lowercased and deduplicated
+@pytest.mark.parametrize("answer, keywords", [
+    ('{"keywords": ["Hades", "roguelike"]}', ["hades", "roguelike"]),
+    ('["Hades", "Supergiant Games"]', ["hades", "supergiant games"]),
+    ('```json\n{"keywords": ["Hades", "Greek  Mythology"]}\n```', ["hades", "greek mythology"]),
+    ("Hades, roguelike; Greek mythology", ["hades", "roguelike", "greek mythology"]),
+    ("Keywords:\n1. Hades\n2. Roguelike\n- \"Underworld\"", ["hades", "roguelike", "underworld"]),
+    ("Hades, HADES, hades , Roguelike", ["hades", "roguelike"]),
+    ('{"keywords": ["Hades", 3, null, ""]}', ["hades"]),
+    ('{"keywords": "Hades, roguelike"}', ["hades", "roguelike"]),
+    ("", []),
+    ('{"answer": "Hades"}', []),
+])
+def test_parse_keywords(answer, keywords):
+    assert parse_keywords(answer) == keywords
+
+
+# Test an empty, unusable or failed keyword answer falls back to the terms of the query
+@pytest.mark.parametrize("answer", ["", "{}", '{"keywords": []}', RuntimeError("upstream failed")])
+def test_keywords_fall_back_to_query(monkeypatch, answer):
+    def chat_completion(call, messages, **params):
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    monkeypatch.setattr(gpt, "chat_completion", chat_completion)
+    assert generate_keywords("What is the best roguelike by Supergiant?") == ["best", "roguelike", "supergiant"]
+    assert fallback_keywords("What is the best roguelike by Supergiant?") == ["best", "roguelike", "supergiant"]
+
+
+# Test the query type label is found in answers with extra wording, formatting or another case
+@pytest.mark.parametrize("answer, label", [
+    ("Metadata", "Metadata"),
+    ("**Metadata**", "Metadata"),
+    ("metadata.", "Metadata"),
+    ("The query is asking for METADATA about the dataset.", "Metadata"),
+    ("Row-specific", "Row-specific"),
+    ("row specific", "Row-specific"),
+    ("This is a row-based question, not metadata.", "Row-specific"),
+    ("Answer: Row-Specific (the user asks about one game's metadata)", "Row-specific"),
+    ("", "Row-specific"),
+    ("I'm not sure.", "Row-specific"),
+])
+def test_parse_query_type(answer, label):
+    assert parse_query_type(answer) == label
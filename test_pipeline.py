@@ -0,0 +1,206 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+import gpt
+import pipeline
+from coalesce import SingleFlight
+from llm_cache import LLMCache, MemoryBackend
+from pipeline import answer_batch, answer_locally, plan_query, stream_answer
+
+GAMES = pd.DataFrame({
+    "name": ["Hades", "Hades II", "ELDEN RING", "DARK SOULS III", "Baldur's Gate 3", "Stardew Valley"],
+    "short_description": [
+        "Defy the god of the dead as you hack and slash out of the Underworld.",
+        "Battle beyond the Underworld using dark sorcery to take on the Titan of Time.",
+        "Rise, Tarnished, and become an Elden Lord in the Lands Between.",
+        "As fires fade and the world falls into ruin, journey into a universe filled with colossal enemies.",
+        "Gather your party and return to the Forgotten Realms in a tale of fellowship and betrayal.",
+        "You've inherited your grandfather's old farm plot in Stardew Valley.",
+    ],
+    "genres": [
+        "['Action', 'Indie', 'Roguelike']", "['Action', 'Roguelike']", "['Action', 'RPG']",
+        "['Action', 'RPG']", "['Adventure', 'RPG', 'Strategy']", "['Indie', 'RPG', 'Simulation']",
+    ],
+    "release_date": ["17 Sep, 2020", "6 May, 2024", "24 Feb, 2022", "11 Apr, 2016", "3 Aug, 2023", "26 Feb, 2016"],
+    "developer": [
+        "['Supergiant Games']", "['Supergiant Games']", "['FromSoftware, Inc.']",
+        "['FromSoftware, Inc.']", "['Larian Studios']", "['ConcernedApe']",
+    ],
+    "publisher": [
+        "['Supergiant Games']", "['Supergiant Games']", "['FromSoftware, Inc.', 'Bandai Namco Entertainment']",
+        "['FromSoftware, Inc.', 'Bandai Namco Entertainment']", "['Larian Studios']", "['ConcernedApe']",
+    ],
+    "overall_player_rating": [
+        "Overwhelmingly Positive", "Very Positive", "Very Positive",
+        "Very Positive", "Overwhelmingly Positive", "Overwhelmingly Positive",
+    ],
+    "number_of_reviews_from_purchased_people": ["(250,512)", "(45,210)", "(712,004)", "(210,377)", "(620,145)", "(590,033)"],
+})
+
+
+@pytest.fixture(scope="module")
+def games_csv(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("dataset") / "games.csv")
+    GAMES.to_csv(path, index=False)
+    return path
+
+
+# Test aggregate questions are answered with the exact counts of the dataset
+@pytest.mark.parametrize("query, answer", [
+    ("How many games are in the dataset?", "There are 6 games in the dataset."),
+    ("how many titles do you have", "There are 6 games in the dataset."),
+    ("How many developers are there?", "There are 4 developers in the dataset."),
+    ("How many publishers are in the dataset?", "There are 5 publishers in the dataset."),
+    ("How many genres are there?", "There are 7 genres in the dataset."),
+    ("How many RPG games are there?", "There are 4 games tagged RPG in the dataset."),
+    ("How many roguelike games are in the dataset?", "There are 2 games tagged Roguelike in the dataset."),
+    ("How many games were released in 2016?", "2 games in the dataset were released in 2016."),
+    ("How many games were released in 2024?", "1 game in the dataset was released in 2024."),
+    ("How many games were released in 2019?", "0 games in the dataset were released in 2019."),
+])
+def test_answer_locally(games_csv, query, answer):
+    assert answer_locally(query, games_csv) == answer
+
+
+# Test questions the statistics can't answer exactly fall through to GPT-4o
+@pytest.mark.parametrize("query", [
+    "How many games did FromSoftware make?",
+    "How many of them are RPGs?",
+    "Which RPG in the dataset has the most reviews?",
+    "How many puzzle games are there?",
+])
+def test_falls_through_to_llm(games_csv, query):
+    assert answer_locally(query, games_csv) is None
+
+
+class StubGateway:
+    """Answers plan_queries, query_type and generate_keywords from the query and generations with the query, counting calls in flight."""
+
+    def __init__(self, delay=0.05, fail="broken"):
+        self.delay = delay
+        self.fail = fail
+        self.calls = Counter()
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def complete(self, call, model, messages, **params):
+        with self._lock:
+            self.calls[call] += 1
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            time.sleep(self.delay)
+            content = messages[-1]["content"]
+            if call == "plan_queries":
+                return json.dumps({"results": [
+                    {
+                        "id": item["id"],
+                        "type": "Metadata" if "column" in item["query"].lower() else "Row-specific",
+                        "keywords": item["query"].lower().split()[-2:],
+                    }
+                    for item in json.loads(content)["queries"]
+                ]})
+            if call == "query_type":
+                query = content.split('Query: "', 1)[1].split('"\n', 1)[0]
+                return "Metadata" if "column" in query.lower() else "Row-specific"
+            if call == "generate_keywords":
+                return json.dumps({"keywords": content.lower().split()[-2:]})
+            query = content.rsplit("User: ", 1)[1].split("\nAssistant:")[0]
+            if self.fail in query:
+                raise RuntimeError(f"upstream failed on {query}")
+            return f"Answer to {query}"
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def stream(self, call, model, messages, **params):
+        answer = self.complete(call, model, messages, **params)
+        for word in answer.split(" "):
+            yield word + " "
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    stub = StubGateway()
+    monkeypatch.setattr(gpt, "gateway", stub)
+    monkeypatch.setattr(gpt, "llm_cache", LLMCache(MemoryBackend()))
+    monkeypatch.setattr(gpt, "flights", SingleFlight(enabled=False))
+    monkeypatch.setattr(gpt, "dataset_facts", lambda: "")
+    return stub
+
+
+# Test duplicates are answered once, aggregates locally and the rest with one plan call and one generation each
+def test_batch_folds_duplicates(games_csv, gateway):
+    queries = [
+        "Tell me about Hades", "tell me about  HADES?", "How many games are in the dataset?",
+        "What does the genres column hold?", "Tell me about Hades",
+    ]
+    results = list(answer_batch(queries, [], [], csv=games_csv))
+    answers = {tuple(indices): (answer, error) for indices, answer, error in results}
+    assert answers == {
+        (0, 1, 4): ("Answer to Tell me about Hades", None),
+        (2,): ("There are 6 games in the dataset.", None),
+        (3,): ("Answer to What does the genres column hold?", None),
+    }
+    assert gateway.calls == {"plan_queries": 1, "generator_rag_rowbase": 1, "generator_rag_colbase": 1}
+
+
+# Test at most `window` calls are in flight, and a failed query is reported without stopping the others
+def test_batch_window_and_errors(games_csv, gateway):
+    queries = [f"Tell me about game number {i}" for i in range(8)] + ["Tell me about the broken game"]
+    results = list(answer_batch(queries, [], [], csv=games_csv, window=2))
+    assert sorted(index for indices, _, _ in results for index in indices) == list(range(9))
+    errors = {indices[0]: error for indices, _, error in results if error is not None}
+    assert list(errors) == [8] and isinstance(errors[8], RuntimeError)
+    assert all(answer == f"Answer to {queries[indices[0]]}" for indices, answer, error in results if error is None)
+    assert gateway.calls["generator_rag_rowbase"] == 9
+    assert gateway.peak == 2
+
+
+# Test Metadata queries retrieve nothing, and Row-specific ones classify and generate keywords at the same time
+def test_plan_query_overlaps_calls(games_csv, gateway, monkeypatch):
+    retrieved = []
+    retrieve_rows = pipeline.retrieve_rows_for_keywords
+
+    def retrieve(keywords, csv, top_n=3, query=None):
+        retrieved.append(keywords)
+        return retrieve_rows(keywords, csv, top_n=top_n, query=query)
+
+    monkeypatch.setattr(pipeline, "ROUTER_ENABLED", False)
+    monkeypatch.setattr(pipeline, "retrieve_rows_for_keywords", retrieve)
+
+    assert plan_query("What does the genres column hold?", [], games_csv) == ("Metadata", [])
+    assert retrieved == [] and gateway.calls["query_type"] == 1
+
+    gateway.delay = 0.3
+    gateway.peak = 0
+    start = time.perf_counter()
+    row_col, rows = plan_query("Tell me about Hades", [], games_csv)
+    assert time.perf_counter() - start < 0.55
+    assert gateway.peak == 2
+    assert row_col == "Row-specific" and retrieved == [["about", "hades"]]
+    assert rows[0]["name"] == "Hades"
+
+
+# Test heartbeats are sent while nothing arrives, and the answer ends with done or with an error
+def test_stream_answer_events(games_csv, gateway):
+    gateway.delay = 0.2
+    events = list(stream_answer("Tell me about Hades", [], [], games_csv, heartbeat=0.05))
+    assert events[0] == ("heartbeat", None)
+    tokens = [payload for event, payload in events if event == "token"]
+    assert tokens == ["Answer ", "to ", "Tell ", "me ", "about ", "Hades "]
+    assert events[-1] == ("done", "".join(tokens))
+
+    events = list(stream_answer("Tell me about the broken game", [], [], games_csv, heartbeat=0.05))
+    assert events[-1][0] == "error" and isinstance(events[-1][1], RuntimeError)
+    assert not any(event in ("token", "done") for event, _ in events)
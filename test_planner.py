@@ -0,0 +1,126 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+from planner import QueryPlan, TypedColumns, plan_query_text, select_rows
+
+GAMES = pd.DataFrame({
+    "name": ["Old RPG", "New RPG", "Popular Shooter", "Niche RPG", "Unrated Shooter"],
+    "genres": [
+        "['RPG', 'Fantasy']", "['RPG', 'Action RPG']", "['Shooter', 'Multiplayer']", "['RPG']", "['Shooter']",
+    ],
+    "release_date": ["1 Jan, 2015", "5 Mar, 2023", "21 Aug, 2012", "9 Sep, 2024", None],
+    "overall_player_rating": ["Very Positive", "Overwhelmingly Positive", "Mixed", "Very Positive", "7 user reviews"],
+    "number_of_reviews_from_purchased_people": ["(20,000)", "(81% of 62,791)\xa0All Time", "(1,200,000)", "(900)", None],
+    "number_of_english_reviews": ["15,000", "40,000", "800,000", "500", None],
+})
+
+
+def names(rows):
+    return [GAMES["name"][row] for row in rows]
+
+
+# Test typed columns parse dates, rating ranks and review counts, leaving unparseable cells missing
+def test_typed_columns():
+    typed = TypedColumns(GAMES)
+    assert typed.numbers["release_year"][:4].tolist() == [2015, 2023, 2012, 2024]
+    assert np.isnan(typed.numbers["release_year"][4])
+    assert typed.numbers["reviews"][1] == 62791
+    assert np.isnan(typed.numbers["rating"][4])
+    assert names(typed.order("reviews", descending=True)) == [
+        "Popular Shooter", "New RPG", "Old RPG", "Niche RPG", "Unrated Shooter",
+    ]
+
+# Test filters, sort order and limit are read from the query
+def test_plan_query_text():
+    typed = TypedColumns(GAMES)
+    plan = plan_query_text("Top 2 highly rated RPGs released after 2022 with over 10k reviews", typed)
+    assert ("release_year", ">", 2022) in plan.filters
+    assert ("reviews", ">", 10000) in plan.filters
+    assert ("rating", ">=", 7) in plan.filters
+    assert ("genres", "has", "rpg") in plan.filters
+    assert plan.limit == 2
+    assert plan_query_text("the most reviewed shooters", typed).sort == ("reviews", True)
+    assert not plan_query_text("Tell me about Hades", typed)
+
+
+# Test rating labels only filter next to a rating word
+@pytest.mark.parametrize("query, filters", [
+    ("games with mixed reviews", [("rating", "==", 4)]),
+    ("shooters rated very positive", [("rating", "==", 7)]),
+    ("overwhelmingly positive rated games", [("rating", "==", 8)]),
+    ("games with a rating of mostly negative", [("rating", "==", 3)]),
+    ("mixed martial arts games", []),
+    ("a game with a positive message", []),
+    ("Is the story of Hades very positive?", []),
+    ("games with negative consequences", []),
+])
+def test_rating_labels(query, filters):
+    plan = plan_query_text(query, TypedColumns(GAMES))
+    assert [f for f in plan.filters if f[0] == "rating"] == filters
+
+
+# Test rows passing the filters are chosen before relevance, and filters matching nothing are ignored
+def test_select_rows():
+    typed = TypedColumns(GAMES)
+    scores = np.array([0.0, 0.0, 5.0, 0.0, 1.0])
+    plan = plan_query_text("highly rated RPGs released after 2022 with over 10k reviews", typed)
+    assert names(select_rows(plan, typed, scores, top_n=3)) == ["New RPG"]
+    assert names(select_rows(plan_query_text("newest RPGs", typed), typed, scores)) == ["Niche RPG", "New RPG", "Old RPG"]
+    assert names(select_rows(QueryPlan([("release_year", ">", 2030)]), typed, scores, top_n=1)) == ["Popular Shooter"]
+
+
+# Test a sort order only ranks the rows relevant to the query, and all rows when none are
+def test_sorted_rows_keep_relevance():
+    typed = TypedColumns(GAMES)
+    scores = np.array([2.0, 0.0, 0.3, 1.8, 0.0])
+    assert names(select_rows(plan_query_text("newest fantasy game", typed), typed, scores)) == ["Niche RPG", "Old RPG"]
+    assert names(select_rows(plan_query_text("most reviewed fantasy game", typed), typed, scores)) == [
+        "Old RPG", "Niche RPG",
+    ]
+    assert names(select_rows(plan_query_text("most reviewed games", typed), typed, np.zeros(5))) == [
+        "Popular Shooter", "New RPG", "Old RPG",
+    ]
+
+TAGGED = pd.DataFrame({
+    "name": ["ELDEN RING", "Terraria", "Palworld", "Total War: WARHAMMER", "Epic Tales", "Concert Hero", "Calm Farm"],
+    "genres": [
+        "['Souls-like', 'RPG', 'Open World']", "['Sandbox', 'Survival', '2D']", "['Creature Collector', 'Survival']",
+        "['Strategy', 'War', 'Fantasy']", "['Epic', 'RPG']", "['Music', 'Rhythm']", "['Cute', 'Relaxing', 'Farming Sim']",
+    ],
+})
+
+
+# Test genres mentioned in passing only boost rows, so the game a query asks about is kept
+@pytest.mark.parametrize("query, game", [
+    ("Tell me about the epic story of Elden Ring", 0),
+    ("Does Terraria have music?", 1),
+    ("what is Palworld, is it a war game?", 2),
+])
+def test_genre_mention_keeps_game(query, game):
+    typed = TypedColumns(TAGGED)
+    plan = plan_query_text(query, typed)
+    assert not plan.filters and plan.boosts
+    scores = np.zeros(len(TAGGED))
+    scores[game] = 2.0
+    scores[3:6] = 1.5
+    rows = select_rows(plan, typed, scores)
+    assert rows[0] == game and len(rows) == 3
+
+
+# Test genres asked for as a kind of game filter the rows, soft adjectives are boosts
+def test_genre_requests():
+    typed = TypedColumns(TAGGED)
+    assert plan_query_text("war games", typed).filters == [("genres", "has", "war")]
+    assert plan_query_text("Which RPG has the best story?", typed).filters == [("genres", "has", "rpg")]
+    plan = plan_query_text("cute relaxing games", typed)
+    assert plan.filters == [("genres", "has", "relaxing")] and plan.boosts == ["cute"]
+    plan = plan_query_text("cute relaxing game", typed)
+    assert not plan.filters and plan.boosts == ["cute", "relaxing"]
+    scores = np.array([1.0, 0.0, 0.0, 0.0, 0.8, 0.0, 0.7])
+    assert [TAGGED["name"][row] for row in select_rows(plan, typed, scores)] == ["ELDEN RING", "Calm Farm", "Epic Tales"]
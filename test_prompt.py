@@ -0,0 +1,97 @@
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+import prompt
+from conversation import ConversationHistory
+from gpt import generate_prompt_col, generate_prompt_row
+from prompt import PromptBuilder, RowContext, count_tokens, render_context
+
+ROWS = [
+    {
+        "name": f"Underworld {i}",
+        "short_description": f"Underworld {i} is a roguelike about escaping the underworld. " * 3,
+        "long_description": f"Underworld {i} has a long story told over many runs. " * 40,
+        "genres": "['Action', 'Roguelike']",
+        "overall_player_rating": "Very Positive",
+    }
+    for i in range(6)
+]
+
+CONVERSATION = ConversationHistory(
+    [{"user": f"What about game {i}?", "assistant": f"Game {i} is worth playing for its story. " * 20} for i in range(10)],
+    summary="Q: Which roguelikes are there? A: Hades and Dead Cells. " * 20,
+)
+
+
+def build(budget):
+    builder = PromptBuilder(budget)
+    builder.require("user_input", "User: Which roguelike should I play?\nAssistant:")
+    builder.add_turns("recent_turns", CONVERSATION)
+    builder.add_rows("rows", ROWS)
+    builder.fit_section("summary", "Summary of previous conversation: ", CONVERSATION.summary)
+    return builder
+
+
+# Test sections are filled in priority order: low priority rows, older turns and the summary go first
+def test_budget_drops_low_priority():
+    full = build(100000)
+    assert full.sections["summary"] > 0
+    budget = full.sections["user_input"] + full.sections["recent_turns"] // 2 + 60
+    prompt_text = generate_prompt_row(CONVERSATION, "Which roguelike should I play?", ROWS, budget=budget)
+    assert "What about game 9?" in prompt_text
+    assert "What about game 0?" not in prompt_text
+    assert "Game: Underworld 0" in prompt_text
+    assert "Game: Underworld 5" not in prompt_text and "Long Description" not in prompt_text
+    assert "Summary of previous conversation" not in prompt_text
+
+    builder = build(budget)
+    assert builder.used <= builder.budget
+    assert "summary" not in builder.sections
+
+
+# Test whole prompts stay within their budget for small and large budgets
+@pytest.mark.parametrize("budget", [200, 800, 3000])
+def test_prompt_within_budget(budget):
+    prompt_text = generate_prompt_row(CONVERSATION, "Which roguelike should I play?", ROWS, budget=budget)
+    assert count_tokens(prompt_text) <= budget
+
+
+# Test the budget holds when counted with GPT-4o's own tokenizer
+@pytest.mark.skipif(prompt._encoding is None, reason="o200k_base vocabulary not available")
+@pytest.mark.parametrize("budget", [200, 800, 3000])
+def test_prompt_within_budget_o200k(budget):
+    assert prompt._encoding.name == "o200k_base"
+    prompt_text = generate_prompt_row(CONVERSATION, "Which roguelike should I play?", ROWS, budget=budget)
+    assert len(prompt._encoding.encode(prompt_text)) <= budget
+
+
+# Test retrieved rows stay within the budget at every boundary, counting the newlines between them as tokens
+@pytest.mark.parametrize("rendered", [False, True])
+def test_rows_within_budget_at_boundary(monkeypatch, rendered):
+    monkeypatch.setattr(prompt, "_encoding", None)
+    monkeypatch.setattr(prompt, "_APPROX_TOKEN", re.compile(r"\w{1,4}|[^\w ]"))
+    rows = [dict(row, short_description=row["name"]) for row in ROWS]
+    if rendered:
+        rows = [RowContext(row, render_context(row)) for row in rows]
+    for budget in range(1, 400):
+        builder = PromptBuilder(budget)
+        text = builder.add_rows("rows", rows)
+        assert count_tokens(text) <= builder.used <= budget
+    assert text.count("Game: Underworld") == len(rows)
+
+
+# Test the metadata prompt only states the row count of the dataset statistics, not the older one of the column summaries
+def test_column_prompt_row_count():
+    summaries = [
+        {"Column Name": "name", "Description": "The title of each game.", "Total Rows": 1000},
+        {"Column Name": "genres", "Description": "Steam tags of each game.", "Total Rows": 1000},
+    ]
+    prompt_text = generate_prompt_col([], "How many games are there?", summaries, facts="Total games: 1200")
+    assert "Total games: 1200" in prompt_text
+    assert "name: The title of each game." in prompt_text
+    assert "1000" not in prompt_text
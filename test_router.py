@@ -0,0 +1,69 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+from planner import TypedColumns
+from router import ROUTER_EXAMPLES, RouterModel, game_titles, load_examples, route_query, studio_names
+
+TITLES = game_titles(["Hades", "Baldur's Gate 3", "Black Myth: Wukong"])
+STUDIOS = studio_names(["FromSoftware, Inc.", "Supergiant Games", "Valve", "Rare Ltd."])
+TYPED = TypedColumns(pd.DataFrame({
+    "genres": ["['RPG', 'Action']", "['Roguelike']"],
+    "release_date": ["24 Feb, 2022", "17 Sep, 2020"],
+    "overall_player_rating": ["Very Positive", "Overwhelmingly Positive"],
+    "number_of_reviews_from_purchased_people": ["(712,004)", "(250,512)"],
+}))
+
+
+# Test rules route obvious queries without the model
+def test_rules():
+    assert route_query("What columns are in the dataset?", [], TITLES, model=RouterModel()).label == "Metadata"
+    assert route_query("Tell me about Cyberpunk 2077", [], TITLES, model=RouterModel()).label == "Row-specific"
+    assert route_query("is baldur's gate 3 worth it", [], TITLES, model=RouterModel()).source == "rule"
+
+# Test dataset words only mean Metadata for questions about the dataset's structure
+@pytest.mark.parametrize("query, label", [
+    ("Which RPG in the dataset has the most reviews?", "Row-specific"),
+    ("What is the best rated game in your knowledge base?", "Row-specific"),
+    ("How many games did FromSoftware make?", "Row-specific"),
+    ("Which games in the dataset came out after 2020?", "Row-specific"),
+    ("What columns are in the dataset?", "Metadata"),
+    ("What does the dataset contain?", "Metadata"),
+    ("How many games are in the dataset?", "Metadata"),
+    ("How many records are there?", "Metadata"),
+])
+def test_dataset_rules(query, label):
+    decision = route_query(query, [], TITLES, model=RouterModel(), studios=STUDIOS, typed=TYPED)
+    assert (decision.label, decision.source) == (label, "rule")
+
+# Test studio names only count where a query asks about a studio's games
+def test_studio_names():
+    assert "fromsoftware" in STUDIOS and "rare" in STUDIOS
+    assert route_query("games by Rare", [], TITLES, model=RouterModel(), studios=STUDIOS).label == "Row-specific"
+    assert route_query("Valve's shooters", [], TITLES, model=RouterModel(), studios=STUDIOS).source == "rule"
+    assert route_query("rare collectibles", [], TITLES, model=RouterModel(), studios=STUDIOS).label is None
+
+# Test a follow-up takes the label of the previous query
+def test_follow_up():
+    conversation = [{"user": "How many developers are there?", "assistant": "There are 250 developers."}]
+    decision = route_query("And what about those?", conversation, TITLES, model=RouterModel())
+    assert decision.source == "follow_up"
+    assert decision.label == "Metadata"
+
+# Test queries the router can't place are left to GPT-4o
+def test_uncertain():
+    decision = route_query("Hmm, interesting", [], TITLES, model=RouterModel())
+    assert decision.label is None
+    assert decision.guess in ("Metadata", "Row-specific")
+
+# Test the shipped model was trained on the examples and classifies them confidently
+def test_shipped_model():
+    model = RouterModel.load()
+    assert model is not None
+    examples = load_examples(ROUTER_EXAMPLES)
+    correct = sum((model.probability(query, previous) >= 0.5) == (label == "Metadata") for query, previous, label in examples)
+    assert correct / len(examples) > 0.95
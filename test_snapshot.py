@@ -0,0 +1,167 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+from keyword_index import KeywordIndex, tokenize, top_scores
+from prompt import PromptBuilder, RowContext, render_context
+from snapshot import StringColumn, build_snapshot, load_snapshot, load_or_build_snapshot
+from vectors import VectorIndex, build_vectors, content_version, hybrid_scores
+
+GAMES = pd.DataFrame({
+    "name": ["Hades", "Black Myth: Wukong", "Café Stella", "Hades II"],
+    "genres": ["['Action', 'Roguelike']", "['Action', 'RPG']", None, "['Action', 'Roguelike']"],
+    "overall_player_rating": ["Very Positive"] * 4,
+    "price": [24.5, 59.99, np.nan, 29.99],
+})
+
+
+def write_csv(tmp_path, df, name="games.csv"):
+    path = str(tmp_path / name)
+    df.to_csv(path, index=False)
+    with open(path, "rb") as f:
+        raw = f.read()
+    return path, raw, content_version(raw)
+
+
+# Test strings round-trip through the heap, including missing and non-ASCII values, and can be bisected
+def test_string_column():
+    column = StringColumn.encode(["apple", None, "Café", "", float("nan")])
+    assert len(column) == 5
+    assert column.tolist() == ["apple", None, "Café", "", None]
+    assert column.take([2, 0]) == ["Café", "apple"]
+    assert column.arrays()["heap"].tobytes() == "appleCafé".encode("utf-8")
+    assert StringColumn.encode(["a"]).missing is None
+
+
+# Test a snapshot decodes to what pd.read_csv parses, lazily and row by row
+def test_snapshot_matches_csv(tmp_path):
+    path, raw, version = write_csv(tmp_path, GAMES)
+    table = build_snapshot(path, raw, version, str(tmp_path / "snapshots"))
+    parsed = pd.read_csv(path)
+    assert table.columns == parsed.columns.tolist()
+    assert table.records([3, 1]) == [
+        {"name": "Hades II", "genres": "['Action', 'Roguelike']", "overall_player_rating": "Very Positive", "price": 29.99},
+        {"name": "Black Myth: Wukong", "genres": "['Action', 'RPG']", "overall_player_rating": "Very Positive", "price": 59.99},
+    ]
+    assert np.isnan(table.records([2])[0]["genres"])
+    assert table["overall_player_rating"].dtype == "category"
+    pd.testing.assert_frame_equal(table.frame().astype(object), parsed.astype(object), check_dtype=False)
+    assert table.array("titles").tolist() == ["black myth wukong", "café stella", "hades", "hades ii"]
+    assert table.meta["profile"]["rows"] == 4
+
+
+# Test the keyword index scores the same after being saved and memory-mapped
+def test_snapshot_index(tmp_path):
+    path, raw, version = write_csv(tmp_path, GAMES)
+    table = build_snapshot(path, raw, version, str(tmp_path / "snapshots"))
+    index = KeywordIndex.from_state(table.arrays("index"))
+    search = {col: GAMES[col].fillna("").astype(str).str.lower() for col in GAMES.columns}
+    built = KeywordIndex(search)
+    assert len(index) == len(built)
+    for keywords in (["hades"], ["action", "rpg"], ["rogue*"], ["missing"]):
+        np.testing.assert_allclose(index.scores(keywords), built.scores(keywords))
+
+
+# Test sparse search over the matched postings ranks like the dense scores, and non-ASCII titles are tokens
+def test_keyword_search():
+    assert tokenize("Café Stella: Action-RPG") == ["café", "stella", "action", "rpg"]
+    assert tokenize("黑神话：悟空") == ["黑神话", "悟空"]
+    search = {col: GAMES[col].fillna("").astype(str) for col in GAMES.columns}
+    search["name"] = pd.Series(["Hades", "黑神话：悟空", "Café Stella", "Hades II"])
+    index = KeywordIndex(search)
+    assert [row for row, _ in index.search(["café"])] == [2]
+    assert [row for row, _ in index.search(["悟空"])] == [1]
+    for keywords in (["hades"], ["action", "roguelike"], ["rogue*"], ["missing"]):
+        assert index.search(keywords, top_n=2) == top_scores(index.scores(keywords), top_n=2)
+
+
+# Test known words only expand to their plurals and rows matching a query's rare word rank above its common one
+def test_keyword_coverage():
+    names = ["War Thunder", "Star Wars", "Warhammer", "For The King", "Crusader Kings", "King of Kings", "Monkey Island"]
+    index = KeywordIndex({"name": pd.Series(names).str.lower()})
+    assert index.query_terms(["war"]) == {"war": 1.0, "wars": 0.5}
+    assert index.query_terms(["warh"]) == {"warhammer": 0.5}
+    assert [row for row, _ in index.search(["monkey", "king"], top_n=2)] == [6, 5]
+    assert [row for row, _ in index.search(["king"], top_n=1)] == [5]
+
+
+# Test a changed csv gets a new snapshot and the old version's is removed
+def test_snapshot_rebuilt_on_change(tmp_path):
+    directory = str(tmp_path / "snapshots")
+    path, raw, version = write_csv(tmp_path, GAMES)
+    assert load_snapshot(path, version, directory) is None
+    load_or_build_snapshot(path, raw, version, directory)
+    assert load_snapshot(path, version, directory) is not None
+
+    path, raw, new_version = write_csv(tmp_path, GAMES.iloc[:2])
+    table = load_or_build_snapshot(path, raw, new_version, directory)
+    assert table.rows == 2
+    assert load_snapshot(path, version, directory) is None
+    assert len([name for name in os.listdir(directory) if not name.startswith(".")]) == 1
+
+
+# Test rebuilding one csv's snapshot keeps the snapshots of other csvs in the same directory
+def test_snapshot_keeps_other_csvs(tmp_path):
+    directory = str(tmp_path / "snapshots")
+    other = load_or_build_snapshot(*write_csv(tmp_path, GAMES, "other.csv"), directory)
+    load_or_build_snapshot(*write_csv(tmp_path, GAMES), directory)
+    load_or_build_snapshot(*write_csv(tmp_path, GAMES.iloc[:2]), directory)
+    assert load_snapshot(other.meta["source"], other.meta["version"], directory) is not None
+    assert len([name for name in os.listdir(directory) if not name.startswith(".")]) == 2
+
+
+# Test the row vectors are built with the snapshot and embed like a freshly fitted embedder once memory-mapped
+def test_snapshot_vectors(tmp_path):
+    path, raw, version = write_csv(tmp_path, GAMES)
+    table = build_snapshot(path, raw, version, str(tmp_path / "snapshots"))
+    index = VectorIndex.from_snapshot(table)
+    vectors, _, meta = build_vectors(pd.read_csv(path))
+    assert index.meta["rows"] == 4 and index.meta["embedder"] == meta["embedder"]
+    np.testing.assert_allclose(index.vectors, vectors, atol=1e-6)
+    scores = index.scores("Hades roguelike")
+    np.testing.assert_allclose(index.scores_many(["Hades roguelike"])[0], scores, atol=1e-6)
+    assert int(np.argmax(scores)) in (0, 3)
+
+
+# Test weak similarities don't outweigh keyword matches and rows without either are dropped
+def test_hybrid_scores():
+    lexical = np.array([0.0, 4.0, 2.0, 0.0])
+    semantic = np.array([0.3, 0.0, 0.1, 0.1])
+    combined = hybrid_scores(lexical, semantic, alpha=0.5, min_similarity=0.2)
+    assert combined[1] > combined[2] > combined[0] > 0
+    assert combined[3] == 0
+    np.testing.assert_allclose(combined[1], 0.5)
+    batch = hybrid_scores(np.vstack([lexical, lexical * 2]), np.vstack([semantic, semantic]), alpha=0.5, min_similarity=0.2)
+    np.testing.assert_allclose(batch, [combined, combined])
+
+
+# Test context blocks are cleaned and rendered per level, and prompts take the largest ones that fit
+def test_context_blocks(tmp_path):
+    path, raw, version = write_csv(tmp_path, GAMES)
+    table = build_snapshot(path, raw, version, str(tmp_path / "snapshots"))
+    assert table.array("context.compact")[1] == "Game: Black Myth: Wukong\nGenres: Action, RPG\nOverall Player Rating: Very Positive"
+
+    game = {
+        "name": "Hades",
+        "long_description": "About This Game\n\t\t\tDefy the god of the dead.",
+        "developer": "['Supergiant Games']",
+        "link": "https://store.steampowered.com/app/1145360/Hades?snr=1_7_15",
+        "genres": float("nan"),
+    }
+    blocks = render_context(game)
+    assert blocks["compact"][0] == "Game: Hades"
+    assert blocks["full"][0] == (
+        "Game: Hades\nLong Description: Defy the god of the dead.\nDeveloper: Supergiant Games\n"
+        "Link: https://store.steampowered.com/app/1145360/Hades"
+    )
+    assert blocks["compact"][1] < blocks["standard"][1] < blocks["full"][1]
+
+    sequel = render_context(dict(game, name="Hades II"))
+    builder = PromptBuilder(budget=blocks["full"][1] + sequel["compact"][1])
+    context = builder.add_rows("rows", [RowContext(game, blocks), RowContext(game, sequel)])
+    assert context == blocks["full"][0] + "\n\n" + sequel["compact"][0]
+    assert builder.used == builder.budget